@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""Script name: bench_conversion.py
+
+Usage: "python3 benchmarks/bench_conversion.py --output bench.json"
+Description:    Benchmarks the FIT conversion pipeline of myWhoosh2Garmin.py
+                on synthetic MyWhoosh-like rides (1 Hz records with power,
+                cadence, heart rate, speed, distance and temperature, plus
+                laps, a session and an activity message).
+                Times cleanup_fit_file, get_most_recent_fit_file and the
+                whole cleanup_and_save_fit_file path and records wall time,
+                peak RSS and records per second. Every case runs in a fresh
+                process so the peak RSS belongs to that case alone.
+                Results are written as JSON; pass --compare with an earlier
+                result file to see the change per case.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import UTC, datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from mywhoosh import backups, fit_files, fit_protocol, fit_rewriter  # noqa: E402
+
+DEFAULT_DURATIONS = [30, 120, 360, 720]
+DEFAULT_REPEAT = 3
+DEFAULT_DIRECTORY_FILES = 1000
+LAP_LENGTH = 600
+# seconds between the Unix and the FIT epoch (1989-12-31 00:00:00 UTC)
+FIT_EPOCH_OFFSET = 631065600
+FIT_PROTOCOL_VERSION = 0x20
+FIT_PROFILE_VERSION = 2132
+FIT_MESG_ACTIVITY = 34
+FIT_FILE_TYPE_ACTIVITY = 4
+MANUFACTURER_DEVELOPMENT = 255
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger(__name__)
+
+# (field number, size, base type, struct format) per message
+FILE_ID_FIELDS = [(0, 1, 0x00, "B"), (1, 2, 0x84, "H"), (2, 2, 0x84, "H"), (4, 4, 0x86, "I"), (3, 4, 0x8C, "I")]
+RECORD_FIELDS = [
+    (253, 4, 0x86, "I"),  # timestamp
+    (5, 4, 0x86, "I"),  # distance, 1/100 m
+    (6, 2, 0x84, "H"),  # speed, 1/1000 m/s
+    (7, 2, 0x84, "H"),  # power
+    (3, 1, 0x02, "B"),  # heart rate
+    (4, 1, 0x02, "B"),  # cadence
+    (13, 1, 0x01, "b"),  # temperature
+]
+SUMMARY_FIELDS = [
+    (253, 4, 0x86, "I"),  # timestamp
+    (2, 4, 0x86, "I"),  # start time
+    (7, 4, 0x86, "I"),  # total elapsed time, 1/1000 s
+    (8, 4, 0x86, "I"),  # total timer time, 1/1000 s
+    (9, 4, 0x86, "I"),  # total distance, 1/100 m
+]
+# the averages MyWhoosh leaves invalid; fit_tool can only fill in fields that are defined
+LAP_FIELDS = [
+    *SUMMARY_FIELDS,
+    (13, 2, 0x84, "H"),  # avg speed, 1/1000 m/s
+    (15, 1, 0x02, "B"),  # avg heart rate
+    (17, 1, 0x02, "B"),  # avg cadence
+    (19, 2, 0x84, "H"),  # avg power
+]
+SESSION_FIELDS = [
+    *SUMMARY_FIELDS,
+    (14, 2, 0x84, "H"),  # avg speed, 1/1000 m/s
+    (16, 1, 0x02, "B"),  # avg heart rate
+    (18, 1, 0x02, "B"),  # avg cadence
+    (20, 2, 0x84, "H"),  # avg power
+]
+INVALID_AVERAGES = (0xFFFF, 0xFF, 0xFF, 0xFFFF)
+ACTIVITY_FIELDS = [(253, 4, 0x86, "I"), (1, 2, 0x84, "H")]
+
+
+def _definition(local_id: int, global_id: int, fields: list[tuple[int, int, int, str]]) -> tuple[bytes, struct.Struct]:
+    """Return a little-endian definition message and the struct packing its data messages."""
+    content = b"".join(struct.pack("<BBB", number, size, base_type) for number, size, base_type, _ in fields)
+    header = struct.pack("<BBBHB", fit_protocol.FIT_DEFINITION_MASK | local_id, 0, 0, global_id, len(fields))
+    return header + content, struct.Struct("<B" + "".join(fmt for *_, fmt in fields))
+
+
+def generate_ride(path: Path, seconds: int, lap_length: int = LAP_LENGTH) -> int:
+    """Write a synthetic MyWhoosh-like ride as a .fit file.
+
+    Args:
+        path (Path): The file to write.
+        seconds (int): Duration of the ride; one record is written per second.
+        lap_length (int): Duration of a lap in seconds.
+
+    Returns:
+        int: The number of record messages written.
+
+    """
+    start = int(datetime(2024, 11, 21, 9, 0, tzinfo=UTC).timestamp()) - FIT_EPOCH_OFFSET
+    chunks = []
+    for local_id, global_id, fields in [
+        (0, fit_protocol.FIT_MESG_FILE_ID, FILE_ID_FIELDS),
+        (1, fit_protocol.FIT_MESG_RECORD, RECORD_FIELDS),
+        (2, fit_protocol.FIT_MESG_LAP, LAP_FIELDS),
+        (3, fit_protocol.FIT_MESG_SESSION, SESSION_FIELDS),
+        (4, FIT_MESG_ACTIVITY, ACTIVITY_FIELDS),
+    ]:
+        definition, packer = _definition(local_id, global_id, fields)
+        chunks.append(definition)
+        if global_id == fit_protocol.FIT_MESG_FILE_ID:
+            chunks.append(packer.pack(local_id, FIT_FILE_TYPE_ACTIVITY, MANUFACTURER_DEVELOPMENT, 0, start, 1))
+        elif global_id == fit_protocol.FIT_MESG_RECORD:
+            record = packer
+        elif global_id == fit_protocol.FIT_MESG_LAP:
+            lap = packer
+        elif global_id == fit_protocol.FIT_MESG_SESSION:
+            session = packer
+        else:
+            activity = packer
+
+    distance = 0
+    lap_start = 0
+    lap_start_distance = 0
+    for second in range(seconds):
+        speed = 9000 + int(1500 * math.sin(second / 120))
+        distance += speed // 10
+        power = 200 + int(50 * math.sin(second / 30))
+        chunks.append(record.pack(1, start + second, distance, speed, power, 140 + second % 20, 85 + second % 10, 21))
+        if (second + 1) % lap_length == 0 or second == seconds - 1:
+            elapsed = (second + 1 - lap_start) * 1000
+            lap_distance = distance - lap_start_distance
+            chunks.append(
+                lap.pack(2, start + second, start + lap_start, elapsed, elapsed, lap_distance, *INVALID_AVERAGES)
+            )
+            lap_start, lap_start_distance = second + 1, distance
+    chunks.append(session.pack(3, start + seconds, start, seconds * 1000, seconds * 1000, distance, *INVALID_AVERAGES))
+    chunks.append(activity.pack(4, start + seconds, 1))
+
+    records = b"".join(chunks)
+    header = struct.pack(
+        "<BBHI4s",
+        fit_protocol.FIT_HEADER_SIZE,
+        FIT_PROTOCOL_VERSION,
+        FIT_PROFILE_VERSION,
+        len(records),
+        fit_protocol.FIT_SIGNATURE,
+    )
+    header += struct.pack("<H", fit_protocol.fit_crc16(header))
+    body = header + records
+    path.write_bytes(body + struct.pack("<H", fit_protocol.fit_crc16(body)))
+    return seconds
+
+
+def peak_rss() -> int | None:
+    """Return the peak resident set size of this process in bytes, None where it is unavailable."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _use_scratch_index(workdir: Path) -> None:
+    """Keep the FIT file index of the benchmark out of the script directory."""
+    fit_files.fit_file_index.cache_clear()
+    fit_files.fit_file_index = lambda: fit_files.FitFileIndex(workdir / "fit_file_index.json")  # type: ignore[assignment]
+
+
+def _run_case(case: dict) -> dict:
+    """Run one benchmark case in the current (fresh) process and return its measurements."""
+    logging.getLogger("mywhoosh").setLevel(logging.WARNING)
+    workdir = Path(case["workdir"])
+    _use_scratch_index(workdir)
+    source = workdir / "MyNewActivity-3.8.5.fit"
+    rss_before = peak_rss()
+    timings = []
+    # the first, untimed run pays for the lazy imports
+    for _ in range(case["repeat"] + 1):
+        if case["benchmark"] == "cleanup_fit_file":
+            output = workdir / "cleaned.fit"
+            begin = time.perf_counter()
+            fit_rewriter.cleanup_fit_file(source, output, streaming=case["streaming"])
+        elif case["benchmark"] == "get_most_recent_fit_file":
+            begin = time.perf_counter()
+            fit_files.get_most_recent_fit_file(workdir / "directory")
+        else:
+            backup = workdir / "backup"
+            backup.mkdir(exist_ok=True)
+            begin = time.perf_counter()
+            if not backups.cleanup_and_save_fit_file(workdir, backup, streaming=case["streaming"]).name:
+                msg = "cleanup_and_save_fit_file did not save a cleaned-up file"
+                raise RuntimeError(msg)
+        timings.append(time.perf_counter() - begin)
+    timings = timings[1:]
+    rss_after = peak_rss()
+    result = {
+        "wall_time_min": min(timings),
+        "wall_time_median": statistics.median(timings),
+        "wall_time_max": max(timings),
+        "peak_rss": rss_after,
+        "peak_rss_increase": None if rss_after is None or rss_before is None else rss_after - rss_before,
+    }
+    if case.get("records"):
+        result["records_per_second"] = case["records"] / result["wall_time_min"]
+    return result
+
+
+def run_benchmarks(durations: list[int], repeat: int, directory_files: int, *, legacy: bool) -> list[dict]:
+    """Generate the synthetic rides and run all benchmark cases, each in its own process.
+
+    Args:
+        durations (list[int]): Ride durations in minutes.
+        repeat (int): Number of timed runs per case.
+        directory_files (int): Number of .fit files in the directory for get_most_recent_fit_file.
+        legacy (bool): Also time the fit_tool based cleanup.
+
+    Returns:
+        list[dict]: One result per case.
+
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cases: list[dict] = []
+        for minutes in durations:
+            workdir = Path(tmp) / f"ride_{minutes}"
+            workdir.mkdir()
+            records = generate_ride(workdir / "MyNewActivity-3.8.5.fit", minutes * 60)
+            cases.extend(
+                {
+                    "benchmark": benchmark,
+                    "streaming": streaming,
+                    "minutes": minutes,
+                    "records": records,
+                    "repeat": repeat,
+                    "workdir": str(workdir),
+                }
+                for streaming in ([True, False] if legacy else [True])
+                for benchmark in ["cleanup_fit_file", "cleanup_and_save_fit_file"]
+            )
+        workdir = Path(tmp) / "listing"
+        (workdir / "directory").mkdir(parents=True)
+        for i in range(directory_files):
+            (workdir / "directory" / f"MyNewActivity-3.{i // 100}.{i % 100}.fit").touch()
+        # an hour old, like a real data directory between two rides
+        an_hour_ago = time.time() - 3600
+        os.utime(workdir / "directory", (an_hour_ago, an_hour_ago))
+        cases.append(
+            {
+                "benchmark": "get_most_recent_fit_file",
+                "files": directory_files,
+                "repeat": repeat,
+                "workdir": str(workdir),
+            }
+        )
+
+        for case in cases:
+            result = {key: value for key, value in case.items() if key != "workdir"}
+            with context.Pool(1) as pool:
+                try:
+                    result |= pool.apply(_run_case, (case,))
+                except Exception as e:  # noqa: BLE001
+                    result["error"] = f"{type(e).__name__}: {e}"
+            results.append(result)
+            logger.info(_format_result(result))
+    return results
+
+
+def _case_name(result: dict) -> str:
+    """Return a short name identifying a benchmark case."""
+    name = result["benchmark"]
+    if "minutes" in result:
+        name += f"[{result['minutes']}min{'' if result['streaming'] else ',legacy'}]"
+    if "files" in result:
+        name += f"[{result['files']} files]"
+    return name
+
+
+def _format_result(result: dict) -> str:
+    """Return a one-line summary of a benchmark result."""
+    if "error" in result:
+        return f"{_case_name(result):<45} failed: {result['error']}"
+    line = f"{_case_name(result):<45} {result['wall_time_min'] * 1000:10.2f} ms"
+    if "records_per_second" in result:
+        line += f" {result['records_per_second']:12,.0f} records/s"
+    if result["peak_rss"] is not None:
+        line += f" {result['peak_rss'] / 2**20:8.1f} MiB peak RSS"
+    return line
+
+
+def compare(results: list[dict], baseline_file: Path) -> None:
+    """Log the change in wall time of every case against an earlier result file."""
+    with baseline_file.open("r") as f:
+        baseline = {_case_name(result): result for result in json.load(f)["results"]}
+    for result in results:
+        before = baseline.get(_case_name(result))
+        if before is None or "error" in before or "error" in result:
+            continue
+        change = result["wall_time_min"] / before["wall_time_min"] - 1
+        msg = f"{_case_name(result):<45} {change:+8.1%} wall time"
+        logger.info(msg)
+
+
+def _git_revision() -> str | None:
+    """Return the git revision of the benchmarked code, if available."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],  # noqa: S607
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the FIT conversion pipeline on synthetic rides.")
+    parser.add_argument(
+        "--durations",
+        type=int,
+        nargs="+",
+        default=DEFAULT_DURATIONS,
+        help="ride durations in minutes (default: %(default)s)",
+    )
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="timed runs per case (default: %(default)s)")
+    parser.add_argument(
+        "--directory-files",
+        type=int,
+        default=DEFAULT_DIRECTORY_FILES,
+        help="number of .fit files for get_most_recent_fit_file (default: %(default)s)",
+    )
+    parser.add_argument("--legacy", action="store_true", help="also time the fit_tool based cleanup")
+    parser.add_argument("--output", type=Path, help="write the results as JSON to this file")
+    parser.add_argument("--compare", type=Path, help="compare with the results in this JSON file")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Run the benchmarks and write the results."""
+    args = parse_arguments()
+    results = run_benchmarks(args.durations, args.repeat, args.directory_files, legacy=args.legacy)
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        report = {
+            "revision": _git_revision(),
+            "created": datetime.now(tz=UTC).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with args.output.open("w") as f:
+            json.dump(report, f, indent=2)
+        msg = f"Results written to < {args.output} >."
+        logger.info(msg)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,59 +18,74 @@ Credits:        Garth by matin - for authenticating and uploading with
 from __future__ import annotations
 
 import argparse
+import builtins
 import importlib.util
 import json
 import logging
 import os
-import re
 import subprocess
 import sys
-import tkinter as tk
+import threading
+import time
 from datetime import datetime
-from getpass import getpass
 from importlib.util import find_spec
 from pathlib import Path
-from tkinter import filedialog
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Self
 
 from tzlocal import get_localzone
 
+from mywhoosh.backups import (
+    BACKUP_ARCHIVE_FORMATS,
+    BackupArchiver,
+    cleanup_and_save_fit_file,
+    cleanup_and_save_fit_files,
+)
+from mywhoosh.fit_files import fit_file_index, get_fit_files, get_most_recent_fit_file
+from mywhoosh.fit_profile import DEFAULT_TRANSFORM_PROFILE, FitTransformProfile, load_transform_profile
+from mywhoosh.fit_protocol import FIT_MAX_RECORD_INTERVAL
+from mywhoosh.fit_reader import repair_fit_data, verify_fit_data
+from mywhoosh.fit_rewriter import cleanup_fit_bytes
+from mywhoosh.garmin import GarminAccount, GarminSession, account_for, load_accounts, upload_fit_bytes
+from mywhoosh.ingest_server import IngestService, ingest_handler
+from mywhoosh.ride_index import RideIndex
+from mywhoosh.run_metrics import metrics
+from mywhoosh.upload_outbox import FitFileLedger, UploadOutbox, upload_fit_file_to_garmin
+
 if TYPE_CHECKING:
-    from collections.abc import Sequence
+    from collections.abc import Callable, Mapping, Sequence
+    from types import ModuleType
+
 
+STARTUP_TIME = time.perf_counter()
 SCRIPT_DIR = Path(__file__).resolve().parent
 LOG_FILE_PATH = SCRIPT_DIR / "myWhoosh2Garmin.log"
+METRICS_FILE_PATH = SCRIPT_DIR / "myWhoosh2Garmin.metrics.jsonl"
 JSON_FILE_PATH = SCRIPT_DIR / "backup_path.json"
-
 INSTALLED_PACKAGES_FILE = SCRIPT_DIR / "installed_packages.json"
-
-TOKENS_PATH = SCRIPT_DIR / ".garth"
+LEDGER_FILE_PATH = SCRIPT_DIR / "myWhoosh2Garmin.db"
 FILE_DIALOG_TITLE = "MyWhoosh2Garmin"
 # Fix for https://github.com/JayQueue/MyWhoosh2Garmin/issues/2
 MYWHOOSH_PREFIX_WINDOWS = "MyWhooshTechnologyService."
+# watch mode: how often to re-check the directory (rescan at least every idle interval even
+# with filesystem events) and how long a file must stay unchanged before it is processed
+WATCH_POLL_INTERVAL = 1.0
+WATCH_IDLE_INTERVAL = 60.0
+WATCH_SETTLE_TIME = 2.0
+# server mode listens on this host when --serve only gives a port
+SERVER_DEFAULT_HOST = "127.0.0.1"
 
 logger = logging.getLogger(__name__)
 
-# Check for 'garth'
-if find_spec("garth"):
-    import garth
-    from garth.exc import GarthException, GarthHTTPError
-else:
+# Heavy optional dependencies (garth, fit_tool, numpy, watchdog, tkinter) are only
+# imported by the code paths that need them, so startup stays fast.
+if find_spec("garth") is None:
     logger.warning("Optional dependency 'garth' is not installed.")
-
-# Check for 'fit_tool'
-if find_spec("fit_tool") is not None:
-    from fit_tool.fit_file import FitFile
-    from fit_tool.fit_file_builder import FitFileBuilder
-    from fit_tool.profile.messages.file_id_message import FileIdMessage
-    from fit_tool.profile.messages.lap_message import LapMessage
-    from fit_tool.profile.messages.record_message import (
-        RecordMessage,
-        RecordTemperatureField,
-    )
-    from fit_tool.profile.messages.session_message import SessionMessage
-else:
+if find_spec("fit_tool") is None:
     logger.warning("Optional dependency 'fit_tool' is not installed.")
+if find_spec("numpy") is None:
+    logger.warning("Optional dependency 'numpy' is not installed, lap and session statistics are limited.")
+if find_spec("watchdog") is None:
+    logger.debug("Optional dependency 'watchdog' is not installed, watch mode polls the directory.")
 
 
 def setup_logging(level: int = logging.DEBUG) -> logging.Logger:
@@ -82,6 +97,10 @@ def setup_logging(level: int = logging.DEBUG) -> logging.Logger:
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
     file_handler.setFormatter(formatter)
     my_logger.addHandler(file_handler)
+    # the library modules log to the "mywhoosh" logger hierarchy
+    library_logger = logging.getLogger("mywhoosh")
+    library_logger.setLevel(level)
+    library_logger.addHandler(file_handler)
     return my_logger
 
 
@@ -128,44 +147,57 @@ def install_package(package: str) -> None:
 
 
 def ensure_packages() -> None:
-    """Ensure all required packages are installed and tracked."""
-    required_packages = ["garth", "fit_tool"]
+    """Ensure all required packages are installed and tracked.
+
+    Packages are only looked up with ``find_spec``, which neither imports them
+    nor starts a subprocess; pip is only invoked for packages that are missing.
+    """
+    required_packages = ["garth", "fit_tool", "numpy"]
     installed_packages = load_installed_packages()
+    tracked_packages = set(installed_packages)
 
     for package in required_packages:
-        if package in installed_packages:
+        if package in installed_packages and importlib.util.find_spec(package):
             msg = f"Package < {package} > is already tracked as installed."
-            logger.info(msg)
+            logger.debug(msg)
             continue
 
         if not importlib.util.find_spec(package):
             msg = f"Package < {package} > not found.Attempting to install..."
             logger.info(msg)
             install_package(package)
-        try:
-            __import__(package)
-            msg = f"Successfully imported < {package} >."
+            importlib.invalidate_caches()
+        if importlib.util.find_spec(package):
+            msg = f"Package < {package} > is installed."
             logger.info(msg)
             installed_packages.add(package)
-        except ModuleNotFoundError:
-            msg = f"Failed to import < {package} > even after installation."
-            logger.exception(msg)
+        else:
+            msg = f"Failed to find < {package} > even after installation."
+            logger.error(msg)
+            installed_packages.discard(package)
 
-    save_installed_packages(installed_packages)
+    if installed_packages != tracked_packages:
+        save_installed_packages(installed_packages)
 
 
-# type: ignore[return]
 def get_fitfile_location() -> Path | None:
     """Get the location of the FIT file directory based on the operating system.
 
+    This is the default of ``--fit-file-location``. The resolved directory is
+    cached in the FIT file index, so the search through the installed
+    packages on Windows only happens once.
+
     Returns:
-        Path: The path to the FIT file directory.
+        Path | None: The path to the FIT file directory, None if it cannot be found.
 
     Raises:
         RuntimeError: If the operating system is unsupported.
         SystemExit: If the target path does not exist.
 
     """
+    index = fit_file_index()
+    if index.data_dir is not None and index.data_dir.is_dir():
+        return index.data_dir
     if os.name == "posix":  # macOS and Linux
         target_path = (
             Path.home()
@@ -181,6 +213,8 @@ def get_fitfile_location() -> Path | None:
             / "Data"
         )
         if target_path.is_dir():
+            index.data_dir = target_path
+            index.save()
             return target_path
         msg = f"Target path < {target_path} > does not exist. Check your MyWhoosh installation."
         logger.exception(msg)
@@ -188,10 +222,14 @@ def get_fitfile_location() -> Path | None:
     elif os.name == "nt":  # Windows
         try:
             base_path = Path.home() / "AppData" / "Local" / "Packages"
-            for directory in base_path.iterdir():
-                if directory.is_dir() and directory.name.startswith(MYWHOOSH_PREFIX_WINDOWS):
+            target_path = base_path
+            for directory in base_path.glob(f"{MYWHOOSH_PREFIX_WINDOWS}*"):
+                if directory.is_dir():
                     target_path = directory / "LocalCache" / "Local" / "MyWhoosh" / "Content" / "Data"
-            if target_path.is_dir():
+                    break
+            if target_path.is_dir() and target_path != base_path:
+                index.data_dir = target_path
+                index.save()
                 return target_path
             msg = f"No valid MyWhoosh directory found in < {target_path} >."
             raise FileNotFoundError(msg)
@@ -206,7 +244,7 @@ def get_fitfile_location() -> Path | None:
             logger.exception(msg)
     else:
         logger.exception("Unsupported OS")
-        return Path()
+    return None
 
 
 def get_backup_path(args: dict) -> Path | None:
@@ -246,6 +284,9 @@ def get_backup_path(args: dict) -> Path | None:
             logger.exception("Invalid backup path stored in JSON.")
             sys.exit(1)
         else:
+            import tkinter as tk  # noqa: PLC0415
+            from tkinter import filedialog  # noqa: PLC0415
+
             root = tk.Tk()
             root.withdraw()
             backup_path = filedialog.askdirectory(title=f"Select {FILE_DIALOG_TITLE} Backup Directory")
@@ -259,306 +300,706 @@ def get_backup_path(args: dict) -> Path | None:
     return Path(backup_path)
 
 
-def get_credentials_for_garmin(args: dict) -> None:
-    """Take command line arguments or prompt the user for Garmin credentials and authenticate using Garth.
+def open_outboxes(args: dict, accounts: Sequence[GarminAccount]) -> dict[str, UploadOutbox]:
+    """Open an upload outbox with its own Garmin session for the default account and every account.
 
     Args:
-        args (dict): command line arguments, optionally containing username and password
+        args (dict): command line arguments with the credentials of the default account
+        accounts (Sequence[GarminAccount]): The accounts from the accounts file.
 
     Returns:
-        None
-
-    Exits:
-        Exits with status 1 if authentication fails.
+        dict[str, UploadOutbox]: The outboxes by account name, "" for the default account.
 
     """
-    if "garmin_username" in args and args["garmin_username"] and "garmin_password" in args and args["garmin_password"]:
-        username = args["garmin_username"]
-        password = args["garmin_password"]
-    else:
-        username = input("Username: ")
-        password = getpass("Password: ")
-    logger.info("Authenticating...")
-    try:
-        garth.login(username, password)
-        garth.save(TOKENS_PATH.name)
-        logger.info("")
-        logger.info("Successfully authenticated!")
-    except GarthHTTPError:
-        logger.info("Wrong credentials. Please check username and password.")
-        sys.exit(1)
-
-
-def authenticate_to_garmin(args: dict) -> None:
-    """Authenticate the user to Garmin
-
-    Authenticate the user to Garmin by checking for existing tokens and resuming the session
-     or prompting for credentials if no session exists or the session is expired.
+    return {
+        account.name if account else "": UploadOutbox(LEDGER_FILE_PATH, GarminSession(args, account=account))
+        for account in [None, *accounts]
+    }
+
+
+def convert_and_upload_fit_file(
+    fit_file: Path,
+    backup_location: Path,
+    *,
+    streaming: bool = True,
+    repair: bool = False,
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+    ledger: FitFileLedger | None = None,
+    session: GarminSession | None = None,
+    outbox: UploadOutbox | None = None,
+    archiver: BackupArchiver | None = None,
+) -> None:
+    """Clean up a single .fit file and upload it, unless the ledger says it was already uploaded.
 
     Args:
-        args (dict): command line arguments, optionally containing username and password
+        fit_file (Path): The .fit file to clean up.
+        backup_location (Path): The directory for backup of .fit files.
+        streaming (bool): Use the single-pass streaming rewriter.
+        repair (bool): Repair a truncated or damaged file instead of skipping it.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+        ledger (FitFileLedger | None): If given, already processed files are skipped.
+        session (GarminSession | None): The session to upload with.
+        outbox (UploadOutbox | None): If given, the file is queued for a background upload
+            instead of being uploaded right away.
+        archiver (BackupArchiver | None): If given, a compressed copy of the new file is archived.
 
     Returns:
         None
 
-    Exits:
-        Exits with status 1 if authentication fails.
-
     """
-    try:
-        if TOKENS_PATH.exists():
-            try:
-                garth.resume(TOKENS_PATH.name)
-                msg = f"Authenticated as: {garth.client.username}"
-                logger.info(msg)
-            except GarthException:
-                logger.info("Session expired. Re-authenticating...")
-                get_credentials_for_garmin(args)
-        else:
-            logger.info("No existing session. Please log in.")
-            get_credentials_for_garmin(args)
-    except GarthException as e:
-        msg = f"Authentication error: {e}"
+    new_file_path = cleanup_and_save_fit_file(
+        fit_file,
+        backup_location,
+        streaming=streaming,
+        repair=repair,
+        profile=profile,
+        ledger=ledger,
+        archiver=archiver,
+    )
+    if not new_file_path.name:
+        return
+    if ledger is not None and ledger.is_uploaded(new_file_path):
+        msg = f"< {new_file_path.name} > was already uploaded."
         logger.info(msg)
-        sys.exit(1)
-
-
-def calculate_avg(values: Sequence[float | int]) -> float:
-    """Calculate the average of a list of values, returning 0 if the list is empty.
+        return
+    if outbox is not None:
+        outbox.enqueue(new_file_path)
+        return
+    upload_fit_file_to_garmin(new_file_path, ledger, session)
+
+
+class _WakeUpHandler:
+    """Filesystem event handler that only wakes up the watch loop."""
+
+    def __init__(self, wake_up: threading.Event) -> None:
+        """Remember the event to set on filesystem activity."""
+        self.wake_up = wake_up
+
+    def dispatch(self, _event: object) -> None:
+        """Handle any filesystem event by waking up the watch loop."""
+        self.wake_up.set()
+
+
+def _scan_fit_files(fitfile_location: Path) -> dict[Path, tuple[int, int]]:
+    """Return the size and modification time of every .fit file in a directory."""
+    snapshot = {}
+    with os.scandir(fitfile_location) as entries:
+        for entry in entries:
+            if entry.name.endswith(".fit") and entry.is_file():
+                stat = entry.stat()
+                snapshot[Path(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+def watch_fit_files(
+    fitfile_location: Path | Sequence[Path],
+    on_fit_file: Callable[[Path], None],
+    *,
+    settle_time: float = WATCH_SETTLE_TIME,
+    poll_interval: float = WATCH_POLL_INTERVAL,
+    stop: threading.Event | None = None,
+) -> None:
+    """Watch one or more directories and handle every .fit file once it has been written.
+
+    Filesystem notifications (inotify, FSEvents, ... through the optional
+    'watchdog' package) wake the loop up immediately; without them the
+    directory is polled. A file is handed to ``on_fit_file`` once its size
+    and modification time have not changed for ``settle_time`` seconds.
+    Files that already exist when watching starts are ignored until they change.
+    All directories are watched by the calling thread, so ``on_fit_file`` is
+    always called from it and may use its SQLite connections.
 
     Args:
-        values (Sequence[float | int]): The list of values to average.
+        fitfile_location (Path | Sequence[Path]): The directory or directories containing the .fit files.
+        on_fit_file (Callable[[Path], None]): Called with every finished .fit file.
+        settle_time (float): Seconds a file must stay unchanged before it is handled.
+        poll_interval (float): Seconds between directory checks while polling
+            or while a file is still being written.
+        stop (threading.Event | None): Set it to stop watching; runs until interrupted otherwise.
 
     Returns:
-        float: The average value or 0 if the list is empty.
+        None
 
     """
-    return sum(values) / len(values) if values else 0.0
+    directories = [fitfile_location] if isinstance(fitfile_location, Path) else list(fitfile_location)
+    stop = stop or threading.Event()
+    wake_up = threading.Event()
+    observer = None
+    if find_spec("watchdog") is not None:
+        from watchdog.observers import Observer  # noqa: PLC0415
+
+        observer = Observer()
+        for directory in directories:
+            # watchdog only calls dispatch(), so a plain handler object is enough
+            observer.schedule(_WakeUpHandler(wake_up), str(directory))  # type: ignore[arg-type]
+        observer.start()
+    for directory in directories:
+        msg = f"Watching < {directory} > for new .fit files ({'events' if observer else 'polling'})."
+        logger.info(msg)
 
+    def scan() -> dict[Path, tuple[int, int]]:
+        snapshot = {}
+        for directory in directories:
+            snapshot.update(_scan_fit_files(directory))
+        return snapshot
 
-def append_value(values: list[int], message: object, field_name: str) -> None:
-    """Appends a value to the 'values' list based on a field from 'message'.
+    known = scan()
+    pending: dict[Path, float] = {}
+    last_scan = time.monotonic()
+    try:
+        while not stop.is_set():
+            woken_up = wake_up.wait(poll_interval)
+            wake_up.clear()
+            now = time.monotonic()
+            idle = observer is not None and not woken_up and not pending
+            if idle and now - last_scan < WATCH_IDLE_INTERVAL:
+                continue
+            last_scan = now
+            current = scan()
+            for path, state in current.items():
+                if known.get(path) != state:
+                    known[path] = state
+                    pending[path] = now
+            for path, changed_at in list(pending.items()):
+                if path not in current:
+                    del pending[path]
+                elif now - changed_at >= settle_time:
+                    del pending[path]
+                    msg = f"< {path.name} > has been written, processing it."
+                    logger.info(msg)
+                    on_fit_file(path)
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    """Parse a ``[HOST:]PORT`` server address, the host defaults to localhost."""
+    host, _, port = value.rpartition(":")
+    try:
+        return host or SERVER_DEFAULT_HOST, int(port)
+    except ValueError:
+        msg = f"invalid address '{value}', expected [HOST:]PORT"
+        raise argparse.ArgumentTypeError(msg) from None
 
-    Args:
-        values (List[int]): The list to append the value to.
-        message (object): The object that holds the field value.
-        field_name (str): The name of the field to retrieve from the message.
 
-    Returns:
-        None
+class ImportProfiler:
+    """Measure how long each module takes to import while the profiler is active.
 
+    ``builtins.__import__`` is wrapped, and the time of every import that
+    loads a new module is recorded per module, excluding nested imports.
     """
-    value = getattr(message, field_name, None)
-    values.append(value if value else 0)
 
+    def __init__(self) -> None:
+        """Start with empty timings."""
+        self.timings: dict[str, float] = {}
+        self._nested: list[float] = []
+        self._original_import = builtins.__import__
+
+    def __enter__(self) -> Self:
+        """Start recording imports."""
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import  # type: ignore[assignment]
+        return self
+
+    def __exit__(self, *_exc_info: object) -> None:
+        """Stop recording imports."""
+        builtins.__import__ = self._original_import
+
+    def _import(
+        self,
+        name: str,
+        globals_: Mapping[str, object] | None = None,
+        locals_: Mapping[str, object] | None = None,
+        fromlist: Sequence[str] | None = (),
+        level: int = 0,
+    ) -> ModuleType:
+        """Import a module like ``__import__``, timing it if it is not loaded yet."""
+        module_name = name
+        if level and globals_:
+            package = globals_.get("__package__") or globals_.get("__name__")
+            module_name = importlib.util.resolve_name("." * level + name, str(package))
+        if module_name in sys.modules:
+            return self._original_import(name, globals_, locals_, fromlist, level)
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals_, locals_, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.timings[module_name] = self.timings.get(module_name, 0.0) + elapsed - nested
+
+    def report(self, limit: int = 10) -> list[str]:
+        """Return report lines with the import time per top-level package and the slowest modules."""
+        total = sum(self.timings.values())
+        packages: dict[str, float] = {}
+        for name, elapsed in self.timings.items():
+            package = name.partition(".")[0]
+            packages[package] = packages.get(package, 0.0) + elapsed
+        lines = [f"Imports during the run took {total * 1000:.1f} ms in total ({len(self.timings)} modules)."]
+        lines.append("Slowest packages:")
+        slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:limit]
+        lines.extend(f"  {elapsed * 1000:8.1f} ms  {name}" for name, elapsed in slowest)
+        lines.append("Slowest modules:")
+        slowest = sorted(self.timings.items(), key=lambda item: item[1], reverse=True)[:limit]
+        lines.extend(f"  {elapsed * 1000:8.1f} ms  {name}" for name, elapsed in slowest)
+        return lines
+
+
+def parse_since(value: str) -> datetime:
+    """Parse the --since argument, interpreting naive dates in the local timezone."""
+    try:
+        since = datetime.fromisoformat(value)
+    except ValueError as e:
+        msg = f"invalid date: {value!r}"
+        raise argparse.ArgumentTypeError(msg) from e
+    return since if since.tzinfo else since.replace(tzinfo=get_localzone())
 
-def reset_values() -> tuple[list[int], list[int], list[int], list[int]]:
-    """Resets and returns three empty lists for cadence, power and heart rate values.
 
-    Returns:
-        tuple: A tuple containing three empty lists
-        (laps, cadence, power, and heart rate).
+def parse_downsample(value: str) -> str:
+    """Check a ``--downsample`` value: "smart" or a number of seconds."""
+    try:
+        DEFAULT_TRANSFORM_PROFILE.downsampled(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+    return value
 
-    """
-    return [], [], [], []
 
+def parse_arguments() -> dict:
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description="Upload my whoosh fit file(s) from given directory to Garmin")
+    parser.add_argument(
+        "source",
+        metavar="INPUT",
+        nargs="?",
+        help="clean up a single fit file given as path, or '-' for stdin, instead of using --fit-file-location",
+    )
+    parser.add_argument(
+        "target",
+        metavar="OUTPUT",
+        nargs="?",
+        help="write the cleaned-up fit file to this path, or '-' for stdout, instead of uploading it",
+    )
+    parser.add_argument(
+        "--fit-file-location",
+        metavar="PATH",
+        help="the path to the fit file directory, defaults to the data directory of the MyWhoosh installation",
+    )
+    parser.add_argument(
+        "--backup-location",
+        metavar="PATH",
+        required=False,
+        help="the path to the backup directory",
+    )
+    parser.add_argument(
+        "--garmin-username",
+        metavar="USERNAME",
+        required=False,
+        help="the garmin username for upload",
+    )
+    parser.add_argument(
+        "--garmin-password",
+        metavar="PASSWORD",
+        required=False,
+        help="the garmin password for upload",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="clean up and upload all fit files in the fit file directory instead of the most recent one",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="DATE",
+        type=parse_since,
+        help="like --all, but only for fit files modified at or after DATE (ISO format, e.g. 2024-11-21)",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        help="the number of worker processes for --all/--since, defaults to the number of cores",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and clean up and upload every fit file as soon as MyWhoosh has finished writing it",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="ignore the ledger of already processed fit files and clean up and upload them again",
+    )
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="cut truncated or damaged fit files at the last complete message and close them, instead of skipping them",
+    )
+    parser.add_argument(
+        "--no-streaming",
+        dest="streaming",
+        action="store_false",
+        help="decode the whole fit file with fit_tool instead of using the streaming rewriter",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="update the ride index of the backup directory and list the rides matching --since and --min-avg-power",
+    )
+    parser.add_argument(
+        "--min-avg-power",
+        metavar="WATTS",
+        type=float,
+        help="with --index, only list rides with at least this average power",
+    )
+    parser.add_argument(
+        "--accounts",
+        metavar="PATH",
+        help="a JSON accounts file mapping source directories or file patterns to Garmin accounts, "
+        "each with its own token store; unmatched fit files are uploaded with the default account",
+    )
+    parser.add_argument(
+        "--transform-profile",
+        metavar="PATH",
+        help="a JSON transform profile with the fields and messages to drop and the fields (e.g. device ids) "
+        "to set, instead of the built-in cleanup",
+    )
+    parser.add_argument(
+        "--downsample",
+        metavar="smart|SECONDS",
+        type=parse_downsample,
+        help="shrink the cleaned-up file by keeping a record only when the values changed noticeably ('smart') "
+        f"or once every SECONDS (up to {FIT_MAX_RECORD_INTERVAL}); lap and session summaries use every record",
+    )
+    parser.add_argument(
+        "--archive",
+        choices=sorted(BACKUP_ARCHIVE_FORMATS),
+        help="also store a compressed copy of every new backup in the 'archive' subdirectory of the backup location",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="[HOST:]PORT",
+        type=parse_address,
+        help="run an HTTP server that cleans up fit files posted to /fit, and with --backup-location "
+        f"also backs them up and uploads them (?upload=1); the host defaults to {SERVER_DEFAULT_HOST}",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="report how long the imports took, broken down by module",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        default=METRICS_FILE_PATH,
+        help="append the timings and counters of the run as a JSON line to this file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        type=Path,
+        help="profile the run with cProfile and dump the statistics to this file",
+    )
+    parser.add_argument(
+        "--loglevel",
+        default="DEBUG",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Set the logging level",
+    )
+    args = parser.parse_args()
+    if args.backup_location is None:
+        for option in ("index", "watch", "all", "since"):
+            if getattr(args, option):
+                parser.error(f"--{option} requires --backup-location")
+    return vars(args)
 
-def cleanup_fit_file(fit_file_path: Path, new_file_path: Path) -> None:
-    """Clean up the FIT file by processing and removing unnecessary fields.
 
-    Clean up the FIT file by processing and removing unnecessary fields.
-    Also, calculate average values for cadence, power, and heart rate.
+def run(args: dict) -> None:
+    """Clean up and upload the FIT file(s) as selected by the command line arguments.
 
     Args:
-        fit_file_path (Path): The path to the input FIT file.
-        new_file_path (Path): The path to save the processed FIT file.
+        args (dict): command line arguments
 
     Returns:
         None
 
     """
-    builder = FitFileBuilder()
-    fit_file = FitFile.from_file(str(fit_file_path))
-    lap_values, cadence_values, power_values, heart_rate_values = reset_values()
-
-    for record in fit_file.records:
-        message = record.message
-        if isinstance(message, LapMessage):
-            append_value(lap_values, message, "start_time")
-            append_value(lap_values, message, "total_elapsed_time")
-            append_value(lap_values, message, "total_distance")
-            append_value(lap_values, message, "avg_speed")
-            append_value(lap_values, message, "max_speed")
-            append_value(lap_values, message, "avg_heart_rate")
-            append_value(lap_values, message, "max_heart_rate")
-            append_value(lap_values, message, "avg_cadence")
-            append_value(lap_values, message, "max_cadence")
-            append_value(lap_values, message, "total_calories")
-        if isinstance(message, RecordMessage):
-            message.remove_field(RecordTemperatureField.ID)
-            append_value(cadence_values, message, "cadence")
-            append_value(power_values, message, "power")
-            append_value(heart_rate_values, message, "heart_rate")
-        if isinstance(message, SessionMessage):
-            if not message.avg_cadence:
-                message.avg_cadence = int(calculate_avg(cadence_values))
-            if not message.avg_power:
-                message.avg_power = int(calculate_avg(power_values))
-            if not message.avg_heart_rate:
-                message.avg_heart_rate = int(calculate_avg(heart_rate_values))
-            if not message.avg_speed or message.avg_speed == 0:
-                message.avg_speed = message.total_distance / message.total_timer_time
-            lap_values, cadence_values, power_values, heart_rate_values = reset_values()
-        if isinstance(message, FileIdMessage):
-            # Override manufacturer/product but keep other fields
-            message.manufacturer = 1
-            message.product = 1836
-        builder.add(message)
-    builder.build().to_file(str(new_file_path))
-    msg = f"Cleaned-up file saved as < {SCRIPT_DIR}/{new_file_path.name} >."
-    logger.info(msg)
+    if args["source"] is not None:
+        run_stream(args)
+        return
+    if args["index"]:
+        run_index(args)
+        return
+    if args["serve"]:
+        run_serve(args)
+        return
 
+    # ensure packages
+    ensure_packages()
 
-def get_fit_files(fitfile_location: Path) -> list:
-    """Returns a list of all .fit files based in the fitfile location.
+    profile = transform_profile(args)
+    ledger = None if args["force"] else FitFileLedger(LEDGER_FILE_PATH)
+    accounts = load_accounts(Path(args["accounts"])) if args["accounts"] else []
+    outboxes = open_outboxes(args, accounts)
+    archiver = BackupArchiver(args["archive"]) if args["archive"] else None
+    fit_file_location = get_fitfile_location() if args["fit_file_location"] is None else Path(args["fit_file_location"])
+    if fit_file_location is None:
+        logger.error("Cannot find the MyWhoosh data directory, pass --fit-file-location.")
+        sys.exit(1)
+    backup_location = Path(args["backup_location"])
+    directories = [fit_file_location]
+    for account in accounts:
+        directories += [directory for directory in account.directories if directory not in directories]
 
-    Args:
-        fitfile_location (Path): location with .fit files to be processed
+    def outbox_for(fit_file: Path) -> UploadOutbox:
+        account = account_for(fit_file, accounts)
+        return outboxes[account.name if account else ""]
 
-    Returns:
-        list: list of all .fit files based in the fitfile location
+    try:
+        if args["watch"]:
+            for outbox in outboxes.values():
+                outbox.session.connect()
+                outbox.start()
+
+            def on_fit_file(fit_file: Path) -> None:
+                convert_and_upload_fit_file(
+                    fit_file,
+                    backup_location,
+                    streaming=args["streaming"],
+                    repair=args["repair"],
+                    profile=profile,
+                    ledger=ledger,
+                    outbox=outbox_for(fit_file),
+                    archiver=archiver,
+                )
 
-    """
-    return list(fitfile_location.glob("*.fit"))
+            try:
+                watch_fit_files(directories, on_fit_file)
+            except KeyboardInterrupt:
+                logger.info("Stopped watching.")
+            return
+        if args["all"] or args["since"]:
+            fit_files = {
+                fit_file for directory in directories for fit_file in get_fit_files(directory, since=args["since"])
+            }
+        elif fit_file_location.is_dir():
+            fit_file = get_most_recent_fit_file(fit_file_location)
+            fit_files = {fit_file} if fit_file else set()
+        else:
+            fit_files = {fit_file_location}
+        if not fit_files:
+            logger.info("No .fit files found.")
+
+        batches: dict[str, list[Path]] = {}
+        for fit_file in sorted(fit_files):
+            batches.setdefault(outbox_for(fit_file).account, []).append(fit_file)
+        new_file_paths = []
+        for name, batch in batches.items():
+            if args["all"] or args["since"]:
+                batch_paths = cleanup_and_save_fit_files(
+                    batch,
+                    backup_location,
+                    streaming=args["streaming"],
+                    repair=args["repair"],
+                    profile=profile,
+                    max_workers=args["workers"],
+                    ledger=ledger,
+                    archiver=archiver,
+                )
+            else:
+                new_file_path = cleanup_and_save_fit_file(
+                    batch[0],
+                    backup_location,
+                    streaming=args["streaming"],
+                    repair=args["repair"],
+                    profile=profile,
+                    ledger=ledger,
+                    archiver=archiver,
+                )
+                batch_paths = [new_file_path] if new_file_path.name else []
+            new_file_paths += batch_paths
+            if ledger is not None:
+                batch_paths = [path for path in batch_paths if not ledger.is_uploaded(path)]
+            for new_file_path in batch_paths:
+                outboxes[name].enqueue(new_file_path)
+
+        if new_file_paths:
+            rides = RideIndex(LEDGER_FILE_PATH)
+            try:
+                rides.refresh(new_file_paths, max_workers=args["workers"])
+            finally:
+                rides.close()
+        uploading = [outbox for outbox in outboxes.values() if outbox.pending()]
+        if not uploading:
+            logger.info("Nothing to upload, all .fit files were already uploaded.")
+            return
+        for outbox in uploading:
+            msg = f"Uploading {outbox.pending()} .fit file(s) to Garmin Connect"
+            msg += f" for account '{outbox.account}'..." if outbox.account else "..."
+            logger.info(msg)
+            outbox.session.connect()
+            outbox.start()
+        for outbox in uploading:
+            outbox.join()
+    finally:
+        if archiver is not None:
+            archiver.close()
+        for outbox in outboxes.values():
+            outbox.close()
+            outbox.session.close()
+        if ledger is not None:
+            ledger.close()
+
+
+def transform_profile(args: dict) -> FitTransformProfile:
+    """Return the transform profile selected on the command line, or the built-in cleanup."""
+    profile = DEFAULT_TRANSFORM_PROFILE
+    if args["transform_profile"] is not None:
+        profile = load_transform_profile(Path(args["transform_profile"]))
+        msg = f"Using the transform profile < {args['transform_profile']} >."
+        logger.info(msg)
+    return profile.downsampled(args["downsample"])
 
 
-def get_most_recent_fit_file(fitfile_location: Path) -> Path:
-    """Returns the most recent .fit file based on versioning in the filename.
+def run_index(args: dict) -> None:
+    """Update the ride index of the backup directory and print the matching rides.
 
     Args:
-        fitfile_location (Path): The directory containing the .fit files.
+        args (dict): command line arguments
 
     Returns:
-        Path: The path to the most recent .fit file
+        None
 
     """
-    fit_files = list(fitfile_location.glob("*.fit"))
-    fit_files = sorted(
-        fit_files,
-        key=lambda f: tuple(map(int, re.findall(r"(\d+)", f.stem.split("-")[-1]))),
-        reverse=True,
-    )
-    return fit_files[0] if fit_files else Path()
-
+    backup_location = Path(args["backup_location"])
+    rides = RideIndex(LEDGER_FILE_PATH)
+    try:
+        rides.update(backup_location, max_workers=args["workers"])
+        with metrics.span("query"):
+            summaries = rides.query(backup_location, since=args["since"], min_avg_power=args["min_avg_power"])
+    finally:
+        rides.close()
+    for ride in summaries:
+        print(  # noqa: T201
+            f"{ride.started:%Y-%m-%d %H:%M}  {(ride.duration or 0) / 60:5.0f} min  "
+            f"{(ride.distance or 0) / 1000:6.1f} km  {ride.avg_power or 0:4.0f}/{ride.max_power or 0:4.0f} W  "
+            f"{ride.avg_heart_rate or 0:3.0f}/{ride.max_heart_rate or 0:3.0f} bpm  {Path(ride.path).name}"
+        )
+    msg = f"{len(summaries)} matching rides."
+    logger.info(msg)
 
-def generate_new_filename(fit_file: Path) -> str:
-    """Generates a new filename with a timestamp."""
-    timestamp = datetime.now(tz=get_localzone()).strftime("%Y-%m-%d_%H%M%S")
-    return f"{fit_file.stem}_{timestamp}.fit"
 
+def run_serve(args: dict) -> None:
+    """Serve the clean-up pipeline over HTTP until interrupted.
 
-def cleanup_and_save_fit_file(fitfile_location: Path, backup_location: Path) -> Path:
-    """Clean up the most recent .fit file in a directory and save it with a timestamped filename.
+    With a backup location, received files can also be backed up and
+    uploaded with the Garmin session of their account, which is logged in
+    once when the server starts.
 
     Args:
-        fitfile_location (Path): The directory containing the .fit files.
-        backup_location (Path): The directory for backup of .fit files.
+        args (dict): command line arguments
 
     Returns:
-        Path: The path to the newly saved and cleaned .fit file,
-        or an empty Path if no .fit file is found or if the path is invalid.
+        None
 
     """
-    fit_file = fitfile_location
-    if fitfile_location.is_dir():
-        msg = f"Checking for .fit files in directory: < {fitfile_location} >."
-        logger.debug(msg)
-        fit_file = get_most_recent_fit_file(fitfile_location)
-
-    if not fit_file:
-        logger.info("No .fit files found.")
-        return Path()
-
-    msg = f"Found the most recent .fit file: < {fit_file.name} >."
-    logger.debug(msg)
-    new_filename = generate_new_filename(fit_file)
-
-    if not backup_location.exists():
-        msg = f"The backup directory < {backup_location} > does not exist. Did you delete it?"
-        logger.exception(msg)
-        return Path()
-
-    new_file_path = backup_location / new_filename
-    msg = f"Cleaning up {new_file_path}."
+    from http.server import ThreadingHTTPServer  # noqa: PLC0415
+
+    accounts = load_accounts(Path(args["accounts"])) if args["accounts"] else []
+    backup_location = Path(args["backup_location"]) if args["backup_location"] else None
+    outboxes = {}
+    if backup_location is not None:
+        ensure_packages()
+        outboxes = open_outboxes(args, accounts)
+        for outbox in outboxes.values():
+            outbox.session.connect()
+            outbox.start()
+    archiver = BackupArchiver(args["archive"]) if args["archive"] else None
+    service = IngestService(
+        backup_location,
+        outboxes,
+        accounts,
+        max_workers=args["workers"],
+        archiver=archiver,
+        profile=transform_profile(args),
+    )
+    server = ThreadingHTTPServer(args["serve"], ingest_handler(service))
+    server.daemon_threads = True
+    host, port = server.server_address[:2]
+    msg = f"Serving on http://{host!s}:{port} with {service.workers} worker(s), POST .fit files to /fit."
     logger.info(msg)
-
     try:
-        cleanup_fit_file(fit_file, new_file_path)
-    except Exception as e:
-        msg = f"Failed to process < {fit_file.name} >: {e}."
-        logger.exception(msg)
-        return Path()
-    msg = f"Successfully cleaned < {fit_file.name} > and saved it as < {new_file_path.name} >."
-    logger.info(msg)
-    return new_file_path
-
-
-def upload_fit_file_to_garmin(new_file_path: Path) -> None:
-    """Upload a .fit file to Garmin using the Garth client.
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopped serving.")
+    finally:
+        server.server_close()
+        service.close()
+        if archiver is not None:
+            archiver.close()
+        for outbox in outboxes.values():
+            outbox.close()
+            outbox.session.close()
+
+
+def run_stream(args: dict) -> None:
+    """Clean up a single fit file given on the command line without intermediate files.
+
+    The input is read from a path or stdin ('-') into memory, because it is
+    verified (and repaired with --repair) as a whole before it is rewritten;
+    the result is written to the output path or stdout ('-'), or, without an
+    output, uploaded to Garmin Connect straight from memory.
 
     Args:
-        new_file_path (Path): The path to the .fit file to upload.
+        args (dict): command line arguments
 
     Returns:
         None
 
+    Exits:
+        Exits with status 1 if the input cannot be read, is damaged or cannot be uploaded.
+
     """
+    source, target = args["source"], args["target"]
+    profile = transform_profile(args)
+    name = "stdin.fit" if source == "-" else Path(source).name
     try:
-        if new_file_path and new_file_path.exists():
-            with new_file_path.open("rb") as f:
-                uploaded = garth.client.upload(f)
-                logger.debug(uploaded)
-        else:
-            msg = f"Invalid file path: {new_file_path}."
+        data = sys.stdin.buffer.read() if source == "-" else Path(source).read_bytes()
+        with metrics.span("verify"):
+            problems = verify_fit_data(data)
+        if problems:
+            msg = f"< {name} > is damaged: {'; '.join(problems)}."
+            if not args["repair"]:
+                raise ValueError(msg + " Use --repair to cut it at the last complete message.")
+            logger.warning(msg)
+            data = repair_fit_data(data, name)
+        if target == "-":
+            cleanup_fit_bytes(data, sys.stdout.buffer, profile=profile)
+            return
+        if target is not None:
+            with Path(target).open("w+b") as f:
+                cleanup_fit_bytes(data, f, profile=profile)
+            msg = f"Cleaned-up file saved as < {target} >."
             logger.info(msg)
-    except GarthHTTPError:
-        logger.info("Duplicate activity found on Garmin Connect.")
-
+            return
+        cleaned = cleanup_fit_bytes(data, profile=profile)
+    except (OSError, ValueError) as e:
+        msg = f"Failed to process < {name} >: {e}"
+        logger.error(msg)  # noqa: TRY400
+        sys.exit(1)
 
-def parse_arguments() -> dict:
-    """Parse command-line arguments."""
-    parser = argparse.ArgumentParser(description="Upload my whoosh fit file(s) from given directory to Garmin")
-    parser.add_argument(
-        "--fit-file-location",
-        metavar="PATH",
-        required=True,
-        help="the path to the fit file directory",
-    )
-    parser.add_argument(
-        "--backup-location",
-        metavar="PATH",
-        required=False,
-        help="the path to the backup directory",
-    )
-    parser.add_argument(
-        "--garmin-username",
-        metavar="USERNAME",
-        required=False,
-        help="the garmin username for upload",
-    )
-    parser.add_argument(
-        "--garmin-password",
-        metavar="PASSWORD",
-        required=False,
-        help="the garmin password for upload",
-    )
-    parser.add_argument(
-        "--loglevel",
-        default="DEBUG",
-        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
-        help="Set the logging level",
-    )
-    return vars(parser.parse_args())
+    ensure_packages()
+    session = GarminSession(args)
+    try:
+        session.connect()
+        uploaded = upload_fit_bytes(cleaned or b"", name, session)
+    finally:
+        session.close()
+    if not uploaded:
+        sys.exit(1)
 
 
 def main() -> None:
@@ -576,17 +1017,68 @@ def main() -> None:
     # setup logging
     logger = setup_logging(level=numeric_level)
     logger.info("Starting MyWhoosh2Garmin...")
-    msg = f"FIT file location: < {args['fit_file_location']} >."
-    logger.info(msg)
+    if not args["serve"] and (args["fit_file_location"] or args["source"]):
+        msg = f"FIT file location: < {args['fit_file_location'] or args['source']} >."
+        logger.info(msg)
+
+    profiler = None
+    if args["cprofile"]:
+        import cProfile  # noqa: PLC0415
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if not args["profile_startup"]:
+            run(args)
+            return
+        msg = f"Startup until main() took {(time.perf_counter() - STARTUP_TIME) * 1000:.1f} ms."
+        logger.info(msg)
+        with ImportProfiler() as import_profiler:
+            try:
+                run(args)
+            finally:
+                for line in import_profiler.report():
+                    logger.info(line)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args["cprofile"])
+            msg = f"cProfile statistics written to < {args['cprofile']} >."
+            logger.info(msg)
+        log_metrics(args)
 
-    # ensure packages
-    ensure_packages()
 
-    authenticate_to_garmin(args)
-    new_file_path = cleanup_and_save_fit_file(Path(args["fit_file_location"]), Path(args["backup_location"]))
-    upload_fit_file_to_garmin(new_file_path)
-    if new_file_path:
-        upload_fit_file_to_garmin(new_file_path)
+def log_metrics(args: dict) -> None:
+    """Log the timing summary of the run and append it to the metrics file.
+
+    Args:
+        args (dict): command line arguments
+
+    Returns:
+        None
+
+    """
+    if args["source"] is not None:
+        mode = "stream"
+    elif args["index"]:
+        mode = "index"
+    elif args["serve"]:
+        mode = "serve"
+    elif args["watch"]:
+        mode = "watch"
+    else:
+        mode = "batch" if args["all"] or args["since"] else "single"
+    report = metrics.write(args["metrics_file"], mode=mode, streaming=args["streaming"])
+    stages = ", ".join(
+        f"{name} {span['seconds']:.3f}s"
+        for name, span in sorted(report["spans"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+    )
+    msg = f"Run took {report['wall_time']:.3f}s ({report['cpu_time']:.3f}s CPU): {stages or 'nothing to do'}."
+    logger.info(msg)
+    counters = ", ".join(f"{name} {value}" for name, value in report["counters"].items())
+    if counters:
+        msg = f"Counters: {counters}."
+        logger.info(msg)
 
 
 if __name__ == "__main__":
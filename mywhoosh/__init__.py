@@ -0,0 +1 @@
+"""Library code of myWhoosh2Garmin: FIT cleanup, backups, the upload outbox and the ingest server."""
@@ -0,0 +1,477 @@
+"""Cleanup of FIT files into the backup directory, and archiving of backups."""
+
+from __future__ import annotations
+
+import functools
+import gzip
+import hashlib
+import itertools
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from importlib.util import find_spec
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from tzlocal import get_localzone
+
+from mywhoosh.fit_files import get_most_recent_fit_file
+from mywhoosh.fit_profile import DEFAULT_TRANSFORM_PROFILE, FitTransformProfile
+from mywhoosh.fit_reader import checked_fit_data
+from mywhoosh.fit_rewriter import cleanup_fit_file
+from mywhoosh.run_metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from mywhoosh.upload_outbox import FitFileLedger
+
+logger = logging.getLogger(__name__)
+
+# cleaned files are stored once per content in BACKUP_OBJECTS_DIR and hardlinked into the backup directory
+BACKUP_OBJECTS_DIR = ".objects"
+BACKUP_ARCHIVE_DIR = "archive"
+BACKUP_ARCHIVE_FORMATS = {"gzip": ".gz", "zstd": ".zst"}
+BACKUP_ARCHIVE_WORKERS = 2
+BACKUP_ZSTD_LEVEL = 10
+
+
+def generate_new_filename(fit_file: Path) -> str:
+    """Generates a new filename with a timestamp."""
+    timestamp = datetime.now(tz=get_localzone()).strftime("%Y-%m-%d_%H%M%S")
+    return f"{fit_file.stem}_{timestamp}.fit"
+
+
+def _link_backup(tmp_path: Path, new_file_path: Path) -> Path:
+    """Give a completely written temporary file the backup path, or its first free numbered variant.
+
+    An existing backup is never replaced: backups of different rides that get
+    the same timestamped name, e.g. from several athletes or processes in the
+    same second, are stored as ``<name>_2.fit``, ``<name>_3.fit``, ...
+    The name is claimed with a hardlink, which fails if it exists; on
+    filesystems without hardlinks it is reserved with ``O_EXCL`` and the file
+    is renamed over the reservation.
+
+    Args:
+        tmp_path (Path): The temporary file, in the same directory as ``new_file_path``.
+        new_file_path (Path): The preferred path of the backup.
+
+    Returns:
+        Path: The path the backup was stored at.
+
+    """
+    for number in itertools.count(1):
+        candidate = new_file_path if number == 1 else new_file_path.with_stem(f"{new_file_path.stem}_{number}")
+        try:
+            os.link(tmp_path, candidate)
+        except FileExistsError:
+            continue
+        except OSError:
+            try:
+                os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            tmp_path.replace(candidate)
+            return candidate
+        tmp_path.unlink()
+        return candidate
+    raise AssertionError  # pragma: no cover
+
+
+def store_backup(tmp_path: Path, new_file_path: Path) -> Path:
+    """Move a completely written temporary file to its backup path, deduplicated by content.
+
+    The content is kept once under its SHA-256 in the ``.objects`` directory
+    of the backup location and every backup with the same content is a
+    hardlink to it; ``prune_backup_objects`` removes contents whose backups
+    are all gone. The backup path either does not exist or holds the
+    complete file, and an existing backup is never overwritten: if the name
+    is taken, a numbered variant of it is used. On filesystems without
+    hardlinks the file is simply renamed into place.
+
+    Args:
+        tmp_path (Path): The temporary file, in the same directory as ``new_file_path``.
+        new_file_path (Path): The preferred path of the backup.
+
+    Returns:
+        Path: The path the backup was stored at.
+
+    """
+    with tmp_path.open("r+b") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+        os.fsync(f.fileno())
+    objects = new_file_path.parent / BACKUP_OBJECTS_DIR
+    object_path = objects / f"{digest}.fit"
+    try:
+        objects.mkdir(exist_ok=True)
+        os.link(tmp_path, object_path)
+    except FileExistsError:
+        # link next to the temporary file and swap it in, so that the content is
+        # kept even if the object was pruned in the meantime
+        linked_path = tmp_path.with_suffix(".link")
+        linked_path.unlink(missing_ok=True)
+        try:
+            os.link(object_path, linked_path)
+        except FileNotFoundError:
+            msg = f"The earlier backup with the content of < {new_file_path.name} > was just pruned."
+            logger.debug(msg)
+        else:
+            linked_path.replace(tmp_path)
+            msg = f"< {new_file_path.name} > has the same content as an earlier backup, storing it as a hardlink."
+            logger.debug(msg)
+    except OSError as e:
+        msg = f"Cannot deduplicate backups in < {new_file_path.parent} >: {e}."
+        logger.debug(msg)
+    return _link_backup(tmp_path, new_file_path)
+
+
+def prune_backup_objects(backup_location: Path) -> int:
+    """Remove the stored contents that no backup links to any more.
+
+    Deleting or rotating backups leaves their content in ``.objects`` with a
+    single link, its own; removing it frees the space of the deleted backups.
+
+    Args:
+        backup_location (Path): The backup directory.
+
+    Returns:
+        int: The number of removed contents.
+
+    """
+    removed = 0
+    try:
+        entries = list(os.scandir(backup_location / BACKUP_OBJECTS_DIR))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.name.endswith(".fit") and entry.stat(follow_symlinks=False).st_nlink == 1:
+                Path(entry.path).unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            msg = f"Cannot prune < {entry.name} > from < {backup_location} >: {e}."
+            logger.debug(msg)
+    if removed:
+        msg = f"Pruned the content of {removed} deleted backups from < {backup_location} >."
+        logger.debug(msg)
+    return removed
+
+
+def save_backup(
+    fit_file_path: Path,
+    new_file_path: Path,
+    *,
+    streaming: bool = True,
+    repair: bool = False,
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+) -> Path:
+    """Verify a FIT file, clean it up into a temporary file and store it as a backup.
+
+    Args:
+        fit_file_path (Path): The path to the input FIT file.
+        new_file_path (Path): The preferred path of the backup.
+        streaming (bool): Use the single-pass streaming rewriter.
+        repair (bool): Repair a truncated or damaged input instead of rejecting it.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        Path: The path the backup was stored at, see ``store_backup``.
+
+    Raises:
+        ValueError: If the input is damaged and cannot or may not be repaired.
+
+    """
+    tmp_path = new_file_path.with_name(f".{new_file_path.name}.{os.getpid()}.tmp")
+    repaired_path = tmp_path.with_suffix(".repaired")
+    try:
+        repaired = checked_fit_data(fit_file_path, repair=repair)
+        if repaired is not None:
+            repaired_path.write_bytes(repaired)
+            fit_file_path = repaired_path
+        cleanup_fit_file(fit_file_path, tmp_path, streaming=streaming, profile=profile)
+        with metrics.span("store"):
+            return store_backup(tmp_path, new_file_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+        repaired_path.unlink(missing_ok=True)
+
+
+def archive_backup(backup_path: Path, compression: str) -> Path:
+    """Write a compressed copy of a backup to the ``archive`` directory next to it.
+
+    Args:
+        backup_path (Path): The backup to archive.
+        compression (str): "gzip" or "zstd".
+
+    Returns:
+        Path: The path of the compressed copy.
+
+    """
+    archive_dir = backup_path.parent / BACKUP_ARCHIVE_DIR
+    archive_dir.mkdir(exist_ok=True)
+    archive_path = archive_dir / f"{backup_path.name}{BACKUP_ARCHIVE_FORMATS[compression]}"
+    tmp_path = archive_dir / f".{archive_path.name}.tmp"
+    try:
+        with backup_path.open("rb") as src, tmp_path.open("wb") as dst:
+            if compression == "zstd":
+                import zstandard  # noqa: PLC0415
+
+                zstandard.ZstdCompressor(level=BACKUP_ZSTD_LEVEL).copy_stream(src, dst)
+            else:
+                with gzip.GzipFile(filename=backup_path.name, mode="wb", fileobj=dst) as gz:
+                    shutil.copyfileobj(src, gz)
+        tmp_path.replace(archive_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return archive_path
+
+
+class BackupArchiver:
+    """Writes compressed copies of new backups on background threads.
+
+    FIT files compress to a fraction of their size, so the archive stays small
+    even when the backup directory is pruned; compression runs off the main
+    thread (zlib and zstd release the GIL) and never delays the upload.
+    """
+
+    def __init__(self, compression: str, workers: int = BACKUP_ARCHIVE_WORKERS) -> None:
+        """Start the archive thread pool, falling back to gzip if zstandard is not installed."""
+        if compression == "zstd" and find_spec("zstandard") is None:
+            logger.warning("Package < zstandard > is not installed, archiving with gzip instead.")
+            compression = "gzip"
+        self.compression = compression
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="archive")
+
+    def submit(self, backup_path: Path) -> None:
+        """Queue a backup for archiving."""
+        future = self._executor.submit(archive_backup, backup_path, self.compression)
+        future.add_done_callback(functools.partial(self._archived, backup_path))
+
+    @staticmethod
+    def _archived(backup_path: Path, future: Future) -> None:
+        """Log the outcome of an archive job."""
+        error = future.exception()
+        if error is not None:
+            msg = f"Failed to archive < {backup_path.name} >: {error}."
+            logger.error(msg)
+            return
+        msg = f"Archived < {backup_path.name} > as < {future.result().name} >."
+        logger.debug(msg)
+
+    def close(self) -> None:
+        """Wait for the queued archive jobs and stop the threads."""
+        self._executor.shutdown(wait=True)
+
+
+def cleanup_and_save_fit_file(
+    fitfile_location: Path,
+    backup_location: Path,
+    *,
+    streaming: bool = True,
+    repair: bool = False,
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+    ledger: FitFileLedger | None = None,
+    archiver: BackupArchiver | None = None,
+) -> Path:
+    """Clean up the most recent .fit file in a directory and save it with a timestamped filename.
+
+    Args:
+        fitfile_location (Path): The directory containing the .fit files.
+        backup_location (Path): The directory for backup of .fit files.
+        streaming (bool): Use the single-pass streaming rewriter (default) instead of
+            decoding the whole file with fit_tool.
+        repair (bool): Repair a truncated or damaged file instead of skipping it.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+        ledger (FitFileLedger | None): If given, files that were already cleaned up
+            are not processed again and new results are recorded.
+        archiver (BackupArchiver | None): If given, a compressed copy of the new file is archived.
+
+    Returns:
+        Path: The path to the newly saved and cleaned .fit file,
+        or an empty Path if no .fit file is found or if the path is invalid.
+
+    """
+    fit_file = fitfile_location
+    if fitfile_location.is_dir():
+        msg = f"Checking for .fit files in directory: < {fitfile_location} >."
+        logger.debug(msg)
+        fit_file = get_most_recent_fit_file(fitfile_location)
+
+    if not fit_file:
+        logger.info("No .fit files found.")
+        return Path()
+
+    msg = f"Found the most recent .fit file: < {fit_file.name} >."
+    logger.debug(msg)
+    if ledger is not None:
+        entry = ledger.lookup(fit_file)
+        if entry is not None and entry.output_path and entry.output_path.exists():
+            msg = f"< {fit_file.name} > was already cleaned up as < {entry.output_path.name} >."
+            logger.info(msg)
+            return entry.output_path
+    new_filename = generate_new_filename(fit_file)
+
+    if not backup_location.exists():
+        msg = f"The backup directory < {backup_location} > does not exist. Did you delete it?"
+        logger.exception(msg)
+        return Path()
+
+    new_file_path = backup_location / new_filename
+    msg = f"Cleaning up {new_file_path}."
+    logger.info(msg)
+
+    try:
+        new_file_path = save_backup(fit_file, new_file_path, streaming=streaming, repair=repair, profile=profile)
+    except Exception as e:
+        msg = f"Failed to process < {fit_file.name} >: {e}."
+        logger.exception(msg)
+        return Path()
+    msg = f"Successfully cleaned < {fit_file.name} > and saved it as < {new_file_path.name} >."
+    logger.info(msg)
+    prune_backup_objects(backup_location)
+    if ledger is not None:
+        ledger.record_processed(fit_file, new_file_path)
+    if archiver is not None:
+        archiver.submit(new_file_path)
+    return new_file_path
+
+
+def timed_cleanup_fit_file(
+    fit_file_path: Path,
+    new_file_path: Path,
+    *,
+    streaming: bool = True,
+    repair: bool = False,
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+) -> tuple[Path, float, int, dict]:
+    """Clean up a FIT file and measure how long it took.
+
+    This is the unit of work of the batch mode; it is a module level function
+    so it can be sent to the worker processes, which also write the backups.
+
+    Args:
+        fit_file_path (Path): The path to the input FIT file.
+        new_file_path (Path): The preferred path to save the processed FIT file.
+        streaming (bool): Use the single-pass streaming rewriter.
+        repair (bool): Repair a truncated or damaged input instead of rejecting it.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        tuple: The path the backup was stored at, the elapsed wall time in seconds,
+            the size of the input file in bytes and the metrics snapshot of the cleanup.
+
+    """
+    metrics.reset()
+    start = time.perf_counter()
+    new_file_path = save_backup(fit_file_path, new_file_path, streaming=streaming, repair=repair, profile=profile)
+    return new_file_path, time.perf_counter() - start, fit_file_path.stat().st_size, metrics.snapshot()
+
+
+def cleanup_and_save_fit_files(
+    fit_files: Sequence[Path],
+    backup_location: Path,
+    *,
+    streaming: bool = True,
+    repair: bool = False,
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+    max_workers: int | None = None,
+    ledger: FitFileLedger | None = None,
+    archiver: BackupArchiver | None = None,
+) -> list[Path]:
+    """Clean up many .fit files in parallel and save them with timestamped filenames.
+
+    The files are distributed over a process pool sized to the number of cores,
+    and the throughput is logged per file and for the whole batch.
+
+    Args:
+        fit_files (Sequence[Path]): The .fit files to clean up.
+        backup_location (Path): The directory for backup of .fit files.
+        streaming (bool): Use the single-pass streaming rewriter.
+        repair (bool): Repair truncated or damaged files instead of skipping them.
+        profile (FitTransformProfile): What to change in the files, defaults to the built-in cleanup.
+        max_workers (int | None): The number of worker processes, defaults to the number of cores.
+        ledger (FitFileLedger | None): If given, files that were already cleaned up
+            are not processed again and new results are recorded.
+        archiver (BackupArchiver | None): If given, compressed copies of the new files are archived.
+
+    Returns:
+        list[Path]: The paths of the successfully cleaned files, in the order of ``fit_files``.
+
+    """
+    if not fit_files:
+        logger.info("No .fit files found.")
+        return []
+    if not backup_location.exists():
+        msg = f"The backup directory < {backup_location} > does not exist. Did you delete it?"
+        logger.error(msg)
+        return []
+
+    done: dict[Path, Path] = {}
+    if ledger is not None:
+        for fit_file in fit_files:
+            entry = ledger.lookup(fit_file)
+            if entry is not None and entry.output_path and entry.output_path.exists():
+                done[fit_file] = entry.output_path
+        if done:
+            msg = f"Skipping {len(done)} .fit files that were already cleaned up."
+            logger.info(msg)
+
+    jobs = {
+        fit_file: backup_location / generate_new_filename(fit_file) for fit_file in fit_files if fit_file not in done
+    }
+    if not jobs:
+        return [done[fit_file] for fit_file in fit_files]
+    workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    msg = f"Cleaning up {len(jobs)} .fit files with {workers} worker processes."
+    logger.info(msg)
+
+    cleaned: dict[Path, Path] = {}
+    total_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                timed_cleanup_fit_file,
+                fit_file,
+                new_file_path,
+                streaming=streaming,
+                repair=repair,
+                profile=profile,
+            ): fit_file
+            for fit_file, new_file_path in jobs.items()
+        }
+        for future in as_completed(futures):
+            fit_file = futures[future]
+            try:
+                new_file_path, elapsed, size, snapshot = future.result()
+            except Exception as e:
+                msg = f"Failed to process < {fit_file.name} >: {e}."
+                logger.exception(msg)
+                continue
+            cleaned[fit_file] = new_file_path
+            total_bytes += size
+            metrics.merge(snapshot)
+            if ledger is not None:
+                ledger.record_processed(fit_file, new_file_path)
+            if archiver is not None:
+                archiver.submit(new_file_path)
+            msg = (
+                f"Cleaned < {fit_file.name} > as < {new_file_path.name} > "
+                f"in {elapsed:.3f}s ({size / max(elapsed, 1e-9) / 1e6:.2f} MB/s)."
+            )
+            logger.info(msg)
+    elapsed = time.perf_counter() - start
+    msg = (
+        f"Cleaned {len(cleaned)} of {len(jobs)} .fit files in {elapsed:.3f}s "
+        f"({len(cleaned) / max(elapsed, 1e-9):.2f} files/s, {total_bytes / max(elapsed, 1e-9) / 1e6:.2f} MB/s)."
+    )
+    logger.info(msg)
+    if cleaned:
+        prune_backup_objects(backup_location)
+    done.update(cleaned)
+    return [done[fit_file] for fit_file in fit_files if fit_file in done]
@@ -0,0 +1,160 @@
+"""Discovery of the MyWhoosh FIT files and their index."""
+
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from mywhoosh.run_metrics import metrics
+
+if TYPE_CHECKING:
+    from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# kept next to myWhoosh2Garmin.py, like its other state files
+FIT_INDEX_FILE_PATH = Path(__file__).resolve().parent.parent / "fit_file_index.json"
+# directories modified this recently are rescanned, their mtime may not have ticked yet
+FIT_INDEX_RACY_INTERVAL = 2.0
+
+
+def fit_file_version(fit_file: Path | str) -> tuple[int, ...]:
+    """Return the MyWhoosh version encoded in a .fit file name, e.g. (3, 8, 5) for MyNewActivity-3.8.5.fit."""
+    stem = fit_file.stem if isinstance(fit_file, Path) else fit_file.removesuffix(".fit")
+    return tuple(map(int, re.findall(r"(\d+)", stem.split("-")[-1])))
+
+
+class FitFileIndex:
+    """Persistent index of the .fit files in the MyWhoosh data directories.
+
+    For every directory the index keeps the parsed version and modification
+    time of each .fit file together with the directory's own modification
+    time. As long as the directory was not modified, no file is created,
+    removed or renamed in it, so the index is used without listing the
+    directory; otherwise only new file names are parsed. A file overwritten
+    in place does not change the directory, so the modification time of
+    every file is still taken from the file itself. The resolved MyWhoosh
+    data directory is cached as well.
+    """
+
+    def __init__(self, index_file: Path = FIT_INDEX_FILE_PATH) -> None:
+        """Load the index, starting empty if it is missing or unreadable."""
+        self.index_file = index_file
+        try:
+            with index_file.open("r") as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+        self._index.setdefault("directories", {})
+        self._changed = False
+
+    @property
+    def data_dir(self) -> Path | None:
+        """The cached MyWhoosh data directory."""
+        data_dir = self._index.get("data_dir")
+        return Path(data_dir) if data_dir else None
+
+    @data_dir.setter
+    def data_dir(self, data_dir: Path) -> None:
+        self._index["data_dir"] = str(data_dir)
+        self._changed = True
+
+    def files(self, directory: Path) -> dict[str, tuple[tuple[int, ...], int]]:
+        """Return the version and modification time of every .fit file in a directory by name."""
+        key = str(directory.resolve())
+        mtime_ns = directory.stat().st_mtime_ns
+        entry = self._index["directories"].get(key)
+        if entry is not None and entry["mtime_ns"] == mtime_ns:
+            try:
+                files = {
+                    name: (tuple(version), (directory / name).stat().st_mtime_ns)
+                    for name, (version, _) in entry["files"].items()
+                }
+            except FileNotFoundError:
+                pass
+            else:
+                if any(files[name][1] != mtime for name, (_, mtime) in entry["files"].items()):
+                    entry["files"] = files
+                    self._changed = True
+                return files
+
+        known = entry["files"] if entry is not None else {}
+        files = {}
+        with os.scandir(directory) as entries:
+            for dir_entry in entries:
+                if dir_entry.name.endswith(".fit") and dir_entry.is_file():
+                    version = known[dir_entry.name][0] if dir_entry.name in known else fit_file_version(dir_entry.name)
+                    files[dir_entry.name] = (tuple(version), dir_entry.stat().st_mtime_ns)
+        # a file created within the same mtime tick would go unnoticed, so recently
+        # modified directories are not trusted and listed again next time
+        racy = time.time_ns() - mtime_ns < FIT_INDEX_RACY_INTERVAL * 1e9
+        self._index["directories"][key] = {"mtime_ns": 0 if racy else mtime_ns, "files": files}
+        self._changed = True
+        return files
+
+    def most_recent(self, directory: Path) -> Path:
+        """Return the .fit file with the highest version in a directory, the newest one on a tie."""
+        files = self.files(directory)
+        if not files:
+            return Path()
+        return directory / max(files, key=files.__getitem__)
+
+    def save(self) -> None:
+        """Write the index back to disk if it changed."""
+        if not self._changed:
+            return
+        try:
+            with self.index_file.open("w") as f:
+                json.dump(self._index, f)
+        except OSError as e:
+            msg = f"Could not save the FIT file index: {e}"
+            logger.warning(msg)
+        self._changed = False
+
+
+@functools.cache
+def fit_file_index() -> FitFileIndex:
+    """Return the FIT file index, loading it on first use."""
+    return FitFileIndex()
+
+
+def get_fit_files(fitfile_location: Path, since: datetime | None = None) -> list:
+    """Returns a list of all .fit files based in the fitfile location.
+
+    Args:
+        fitfile_location (Path): location with .fit files to be processed
+        since (datetime | None): only return files modified at or after this time
+
+    Returns:
+        list: list of all .fit files based in the fitfile location
+
+    """
+    with metrics.span("discovery"):
+        fit_files = list(fitfile_location.glob("*.fit"))
+        if since is not None:
+            timestamp = since.timestamp()
+            fit_files = [fit_file for fit_file in fit_files if fit_file.stat().st_mtime >= timestamp]
+    return fit_files
+
+
+def get_most_recent_fit_file(fitfile_location: Path) -> Path:
+    """Returns the most recent .fit file based on versioning in the filename.
+
+    Args:
+        fitfile_location (Path): The directory containing the .fit files.
+
+    Returns:
+        Path: The path to the most recent .fit file
+
+    """
+    with metrics.span("discovery"):
+        index = fit_file_index()
+        fit_file = index.most_recent(fitfile_location)
+        index.save()
+    return fit_file
@@ -0,0 +1,236 @@
+"""Transform profiles: which FIT messages and fields the cleanup drops, sets or recalculates."""
+
+from __future__ import annotations
+
+import functools
+import json
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING
+
+from mywhoosh.fit_protocol import (
+    FIT_BASE_TYPE_UINT16,
+    FIT_FIELD_DEVICE_INFO_MANUFACTURER,
+    FIT_FIELD_DEVICE_INFO_PRODUCT,
+    FIT_FIELD_FILE_ID_MANUFACTURER,
+    FIT_FIELD_FILE_ID_PRODUCT,
+    FIT_FIELD_RECORD_CADENCE,
+    FIT_FIELD_RECORD_DISTANCE,
+    FIT_FIELD_RECORD_ENHANCED_SPEED,
+    FIT_FIELD_RECORD_HEART_RATE,
+    FIT_FIELD_RECORD_POWER,
+    FIT_FIELD_RECORD_SPEED,
+    FIT_FIELD_RECORD_TEMPERATURE,
+    FIT_MAX_RECORD_INTERVAL,
+    FIT_MESG_DEVICE_INFO,
+    FIT_MESG_FILE_ID,
+    FIT_MESG_LAP,
+    FIT_MESG_RECORD,
+    FIT_MESG_SESSION,
+    FIT_SUMMARY_FIELDS,
+    GARMIN_MANUFACTURER_ID,
+    GARMIN_PRODUCT_ID,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+    from pathlib import Path
+
+
+# Fields a transform profile may set are added with this size and base type when a message lacks them.
+FIT_SETTABLE_FIELDS = {
+    (FIT_MESG_FILE_ID, FIT_FIELD_FILE_ID_MANUFACTURER): (2, FIT_BASE_TYPE_UINT16),
+    (FIT_MESG_FILE_ID, FIT_FIELD_FILE_ID_PRODUCT): (2, FIT_BASE_TYPE_UINT16),
+    (FIT_MESG_DEVICE_INFO, FIT_FIELD_DEVICE_INFO_MANUFACTURER): (2, FIT_BASE_TYPE_UINT16),
+    (FIT_MESG_DEVICE_INFO, FIT_FIELD_DEVICE_INFO_PRODUCT): (2, FIT_BASE_TYPE_UINT16),
+}
+# Message and field names accepted by transform profile files, besides plain numbers.
+FIT_MESSAGE_NAMES = {
+    "file_id": FIT_MESG_FILE_ID,
+    "session": FIT_MESG_SESSION,
+    "lap": FIT_MESG_LAP,
+    "record": FIT_MESG_RECORD,
+    "event": 21,
+    "device_info": FIT_MESG_DEVICE_INFO,
+    "activity": 34,
+    "file_creator": 49,
+    "hrv": 78,
+}
+FIT_FIELD_NAMES = {
+    FIT_MESG_FILE_ID: {"manufacturer": FIT_FIELD_FILE_ID_MANUFACTURER, "product": FIT_FIELD_FILE_ID_PRODUCT},
+    FIT_MESG_DEVICE_INFO: {
+        "manufacturer": FIT_FIELD_DEVICE_INFO_MANUFACTURER,
+        "product": FIT_FIELD_DEVICE_INFO_PRODUCT,
+    },
+    FIT_MESG_RECORD: {
+        "heart_rate": FIT_FIELD_RECORD_HEART_RATE,
+        "cadence": FIT_FIELD_RECORD_CADENCE,
+        "distance": FIT_FIELD_RECORD_DISTANCE,
+        "speed": FIT_FIELD_RECORD_SPEED,
+        "power": FIT_FIELD_RECORD_POWER,
+        "temperature": FIT_FIELD_RECORD_TEMPERATURE,
+        "enhanced_speed": FIT_FIELD_RECORD_ENHANCED_SPEED,
+    },
+}
+
+
+@dataclass(frozen=True)
+class FitMessageTransform:
+    """The operations a transform profile applies to the messages of one global message number."""
+
+    drop: frozenset[int] = frozenset()
+    ensure: tuple[tuple[int, int, int], ...] = ()
+    set_values: tuple[tuple[int, int], ...] = ()
+    summary: Mapping[str, tuple[int, int, int]] | None = None
+    records: bool = False
+    remove: bool = False
+    record_interval: int = 0
+    smart_recording: bool = False
+
+
+@dataclass(frozen=True)
+class FitTransformProfile:
+    """Declarative description of what the cleanup changes in a FIT file.
+
+    The default profile removes the temperature from record messages, fills in
+    missing lap and session averages from the records and sets the file id to
+    a Garmin device. The profile is compiled once into ``table``, a dispatch
+    table keyed by global message number; messages without an entry are
+    copied unchanged. Record messages can be downsampled, either to one every
+    ``record_interval`` seconds or by ``smart_recording``; lap and session
+    summaries are still computed from every record.
+    """
+
+    drop_fields: Mapping[int, frozenset[int]] = field(
+        default_factory=lambda: {FIT_MESG_RECORD: frozenset({FIT_FIELD_RECORD_TEMPERATURE})}
+    )
+    drop_messages: frozenset[int] = frozenset()
+    set_fields: Mapping[int, Mapping[int, int]] = field(
+        default_factory=lambda: {
+            FIT_MESG_FILE_ID: {
+                FIT_FIELD_FILE_ID_MANUFACTURER: GARMIN_MANUFACTURER_ID,
+                FIT_FIELD_FILE_ID_PRODUCT: GARMIN_PRODUCT_ID,
+            }
+        }
+    )
+    fill_summaries: bool = True
+    record_interval: int = 0
+    smart_recording: bool = False
+
+    @property
+    def downsampling(self) -> bool:
+        """Whether record messages are downsampled."""
+        return self.smart_recording or self.record_interval > 1
+
+    def downsampled(self, downsample: str | int | None) -> FitTransformProfile:
+        """Return the profile with records downsampled by ``"smart"`` recording or to one every N seconds.
+
+        Raises:
+            ValueError: If ``downsample`` is neither "smart" nor a number of seconds
+                from 1 to ``FIT_MAX_RECORD_INTERVAL``; longer gaps would count as pauses.
+
+        """
+        if downsample is None:
+            return self
+        if downsample == "smart":
+            return replace(self, smart_recording=True, record_interval=0)
+        if not str(downsample).isdigit() or not 1 <= int(downsample) <= FIT_MAX_RECORD_INTERVAL:
+            msg = f"Invalid downsampling '{downsample}', use 'smart' or 1 to {FIT_MAX_RECORD_INTERVAL} seconds."
+            raise ValueError(msg)
+        return replace(self, smart_recording=False, record_interval=int(downsample))
+
+    @functools.cached_property
+    def table(self) -> dict[int, FitMessageTransform]:
+        """The compiled dispatch table: global message number -> transform."""
+        global_ids = {*self.drop_fields, *self.set_fields, *self.drop_messages}
+        if self.fill_summaries:
+            global_ids |= {FIT_MESG_RECORD, *FIT_SUMMARY_FIELDS}
+        if self.downsampling:
+            global_ids.add(FIT_MESG_RECORD)
+        table = {}
+        for global_id in global_ids:
+            if global_id in self.drop_messages:
+                table[global_id] = FitMessageTransform(remove=True)
+                continue
+            drop = frozenset(self.drop_fields.get(global_id, ()))
+            set_values = tuple(self.set_fields.get(global_id, {}).items())
+            summary = FIT_SUMMARY_FIELDS.get(global_id) if self.fill_summaries else None
+            if summary is not None and drop:
+                # a dropped summary field is neither added nor filled in
+                summary = {name: spec for name, spec in summary.items() if spec[0] not in drop}
+            ensure = tuple(
+                (number, *FIT_SETTABLE_FIELDS[global_id, number])
+                for number, _ in set_values
+                if (global_id, number) in FIT_SETTABLE_FIELDS
+            )
+            table[global_id] = FitMessageTransform(
+                drop=drop,
+                ensure=ensure + tuple(summary.values() if summary else ()),
+                set_values=set_values,
+                summary=summary,
+                records=global_id == FIT_MESG_RECORD and (self.fill_summaries or self.downsampling),
+                record_interval=self.record_interval if global_id == FIT_MESG_RECORD and self.downsampling else 0,
+                smart_recording=self.smart_recording and global_id == FIT_MESG_RECORD,
+            )
+        return table
+
+
+DEFAULT_TRANSFORM_PROFILE = FitTransformProfile()
+
+
+def _fit_number(name: str | int, names: Mapping[str, int], kind: str) -> int:
+    """Resolve a message or field name of a transform profile file to its number."""
+    if isinstance(name, int) or name.isdigit():
+        return int(name)
+    if name not in names:
+        msg = f"Unknown FIT {kind} '{name}', use one of {', '.join(names)} or a number."
+        raise ValueError(msg)
+    return names[name]
+
+
+def load_transform_profile(profile_file: Path) -> FitTransformProfile:
+    """Load a transform profile from a JSON file.
+
+    The file may contain ``drop_fields`` (message -> list of fields),
+    ``drop_messages`` (list of messages), ``set_fields`` (message -> field ->
+    value), ``fill_summaries`` (bool) and ``downsample`` ("smart" or seconds).
+    Messages and fields are given by name or number; settings missing from
+    the file keep their default.
+
+    Args:
+        profile_file (Path): The JSON profile file.
+
+    Returns:
+        FitTransformProfile: The profile.
+
+    Raises:
+        ValueError: If the file names an unknown message or field, or an invalid downsampling.
+
+    """
+    with profile_file.open("r") as f:
+        settings = json.load(f)
+    default = DEFAULT_TRANSFORM_PROFILE
+
+    def message(name: str | int) -> int:
+        return _fit_number(name, FIT_MESSAGE_NAMES, "message")
+
+    def field_number(global_id: int, name: str | int) -> int:
+        return _fit_number(name, FIT_FIELD_NAMES.get(global_id, {}), "field")
+
+    drop_fields = default.drop_fields
+    if "drop_fields" in settings:
+        drop_fields = {
+            message(name): frozenset(field_number(message(name), number) for number in numbers)
+            for name, numbers in settings["drop_fields"].items()
+        }
+    set_fields = default.set_fields
+    if "set_fields" in settings:
+        set_fields = {
+            message(name): {field_number(message(name), number): int(value) for number, value in values.items()}
+            for name, values in settings["set_fields"].items()
+        }
+    return FitTransformProfile(
+        drop_fields=drop_fields,
+        drop_messages=frozenset(message(name) for name in settings.get("drop_messages", ())),
+        set_fields=set_fields,
+        fill_summaries=bool(settings.get("fill_summaries", default.fill_summaries)),
+    ).downsampled(settings.get("downsample"))
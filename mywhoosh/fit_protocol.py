@@ -0,0 +1,405 @@
+"""FIT protocol constants, CRC and field helpers shared by the reader and the rewriter."""
+
+from __future__ import annotations
+
+import functools
+import struct
+from array import array
+from importlib.util import find_spec
+from typing import TYPE_CHECKING, Any, BinaryIO
+
+if TYPE_CHECKING:
+    import mmap
+    from collections.abc import Sequence
+    from types import ModuleType
+
+    # bytes-like objects accepted by the in-memory cleanup (collections.abc.Buffer needs Python 3.12)
+    Buffer = bytes | bytearray | memoryview | mmap.mmap
+
+
+# FIT protocol constants used by the streaming rewriter
+FIT_HEADER_SIZE_LEGACY = 12
+FIT_HEADER_SIZE = 14
+FIT_CRC_SIZE = 2
+FIT_SIGNATURE = b".FIT"
+FIT_COMPRESSED_HEADER_MASK = 0x80
+FIT_DEFINITION_MASK = 0x40
+FIT_DEVELOPER_DATA_MASK = 0x20
+FIT_LOCAL_ID_MASK = 0x0F
+FIT_COMPRESSED_LOCAL_ID_MASK = 0x60
+FIT_COMPRESSED_TIME_MASK = 0x1F
+FIT_BASE_TYPE_UINT8 = 0x02
+FIT_BASE_TYPE_UINT16 = 0x84
+FIT_BASE_TYPE_UINT32 = 0x86
+FIT_BASE_TYPE_ENUM = 0x00
+FIT_MESG_FILE_ID = 0
+FIT_MESG_SESSION = 18
+FIT_MESG_LAP = 19
+FIT_MESG_RECORD = 20
+FIT_MESG_DEVICE_INFO = 23
+FIT_FIELD_TIMESTAMP = 253
+FIT_FIELD_FILE_ID_MANUFACTURER = 1
+FIT_FIELD_FILE_ID_PRODUCT = 2
+FIT_FIELD_DEVICE_INFO_MANUFACTURER = 2
+FIT_FIELD_DEVICE_INFO_PRODUCT = 4
+FIT_FIELD_RECORD_HEART_RATE = 3
+FIT_FIELD_RECORD_CADENCE = 4
+FIT_FIELD_RECORD_DISTANCE = 5
+FIT_FIELD_RECORD_SPEED = 6
+FIT_FIELD_RECORD_POWER = 7
+FIT_FIELD_RECORD_TEMPERATURE = 13
+FIT_FIELD_RECORD_ENHANCED_SPEED = 73
+# lap and session messages share these field numbers
+FIT_FIELD_SUMMARY_START_TIME = 2
+FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME = 8
+FIT_FIELD_SUMMARY_TOTAL_DISTANCE = 9
+# session fields written into a repaired file
+FIT_FIELD_SESSION_SPORT = 5
+FIT_FIELD_SESSION_SUB_SPORT = 6
+FIT_FIELD_SESSION_TOTAL_ELAPSED_TIME = 7
+FIT_SPORT_CYCLING = 2
+FIT_SUB_SPORT_VIRTUAL_ACTIVITY = 58
+# seconds between the Unix epoch and the FIT epoch (1989-12-31 00:00 UTC)
+FIT_EPOCH_OFFSET = 631065600
+# record samples further apart than this (in seconds) are treated as a pause
+FIT_MAX_RECORD_INTERVAL = 10
+# smart recording keeps a record at least this often (in seconds) and whenever power (W), cadence (rpm),
+# heart rate (bpm) or speed (mm/s) moved by the threshold since the last kept record
+SMART_RECORDING_MAX_INTERVAL = 8
+SMART_RECORDING_THRESHOLDS = (15, 5, 3, 500)
+NORMALIZED_POWER_WINDOW = 30
+GARMIN_MANUFACTURER_ID = 1
+GARMIN_PRODUCT_ID = 1836
+
+
+@functools.cache
+def _numpy() -> ModuleType | None:
+    """Import NumPy on first use, or return None if it is not installed."""
+    if find_spec("numpy") is None:
+        return None
+    import numpy as np  # noqa: PLC0415
+
+    return np
+
+
+def calculate_avg(values: Sequence[float | int]) -> float:
+    """Calculate the average of a list of values, returning 0 if the list is empty.
+
+    Args:
+        values (Sequence[float | int]): The list of values to average.
+
+    Returns:
+        float: The average value or 0 if the list is empty.
+
+    """
+    return sum(values) / len(values) if values else 0.0
+
+
+def message_value(message: object, field_name: str, scale: float = 1) -> int:
+    """Return a field of a decoded fit_tool message in FIT units, or 0 if it is missing.
+
+    Args:
+        message (object): The object that holds the field value.
+        field_name (str): The name of the field to retrieve from the message.
+        scale (float): The factor converting the decoded value back to FIT units.
+
+    Returns:
+        int: The scaled value, 0 if the field is missing.
+
+    """
+    value = getattr(message, field_name, None)
+    return round(value * scale) if value else 0
+
+
+def calculate_ride_statistics(
+    timestamps: Sequence[int],
+    power: Sequence[int],
+    cadence: Sequence[int],
+    heart_rate: Sequence[int],
+    speed: Sequence[int],
+) -> dict[str, float]:
+    """Calculate lap or session summary statistics from record channels.
+
+    Averages are weighted by the time each sample represents (capped at
+    ``FIT_MAX_RECORD_INTERVAL`` so pauses do not count), heart rate ignores
+    samples without a reading, and normalized power uses a 30 s rolling
+    average. Values are in FIT units: speed in mm/s, the others as recorded.
+    Without NumPy only plain averages are calculated.
+
+    Args:
+        timestamps (Sequence[int]): The record timestamps in seconds.
+        power (Sequence[int]): The power samples, 0 where missing.
+        cadence (Sequence[int]): The cadence samples, 0 where missing.
+        heart_rate (Sequence[int]): The heart rate samples, 0 where missing.
+        speed (Sequence[int]): The speed samples in mm/s, 0 where missing.
+
+    Returns:
+        dict[str, float]: The statistics by summary field name; statistics that
+        cannot be calculated from the samples are left out.
+
+    """
+    if not timestamps:
+        return {}
+    np = _numpy()
+    if np is None:
+        return {
+            "avg_power": calculate_avg(power),
+            "avg_cadence": calculate_avg(cadence),
+            "avg_heart_rate": calculate_avg(heart_rate),
+        }
+
+    ts = np.asarray(timestamps, dtype=np.int64)
+    channels = {
+        "power": np.asarray(power, dtype=np.float64),
+        "cadence": np.asarray(cadence, dtype=np.float64),
+        "heart_rate": np.asarray(heart_rate, dtype=np.float64),
+        "speed": np.asarray(speed, dtype=np.float64),
+    }
+    weights = np.clip(np.diff(ts, append=ts[-1] + 1), 0, FIT_MAX_RECORD_INTERVAL).astype(np.float64)
+    if not weights.any():
+        weights[:] = 1.0
+
+    statistics: dict[str, float] = {}
+    for name, values in channels.items():
+        if not values.any():
+            continue
+        channel_weights = weights * (values > 0) if name == "heart_rate" else weights
+        total_weight = channel_weights.sum()
+        if total_weight:
+            statistics[f"avg_{name}"] = float(np.dot(values, channel_weights) / total_weight)
+        statistics[f"max_{name}"] = float(values.max())
+
+    # Normalized power: resample to 1 Hz, 30 s rolling average, fourth-power mean.
+    duration = int(ts[-1] - ts[0]) + 1
+    if channels["power"].any() and duration >= NORMALIZED_POWER_WINDOW:
+        indexes = np.searchsorted(ts, ts[0] + np.arange(duration), side="right") - 1
+        cumulative = np.concatenate(([0.0], np.cumsum(channels["power"][indexes])))
+        window = NORMALIZED_POWER_WINDOW
+        rolling = (cumulative[window:] - cumulative[:-window]) / window
+        statistics["normalized_power"] = float(np.mean(rolling**4) ** 0.25)
+    return statistics
+
+
+class RideChannels:
+    """Record channels of a ride, stored in typed arrays.
+
+    Every sample takes a few bytes per channel instead of a boxed int, values
+    are kept in FIT units (speed in mm/s, distance in cm) with 0 for a missing
+    reading, and laps are kept as index ranges into the channels. ``numpy()``
+    exposes the buffers to NumPy without copying them.
+    """
+
+    __slots__ = ("cadence", "distance", "heart_rate", "lap_bounds", "power", "speed", "timestamps")
+
+    def __init__(self) -> None:
+        """Create empty channels."""
+        self.timestamps = array("I")
+        self.power = array("H")
+        self.cadence = array("B")
+        self.heart_rate = array("B")
+        self.speed = array("I")
+        self.distance = array("I")
+        # start and end index of every closed lap, flattened
+        self.lap_bounds = array("I")
+
+    def __len__(self) -> int:
+        """Return the number of samples."""
+        return len(self.timestamps)
+
+    def channels(self) -> dict[str, array]:
+        """Return the channel arrays by name."""
+        return {
+            "timestamps": self.timestamps,
+            "power": self.power,
+            "cadence": self.cadence,
+            "heart_rate": self.heart_rate,
+            "speed": self.speed,
+            "distance": self.distance,
+        }
+
+    def append(self, timestamp: int, power: int, cadence: int, heart_rate: int, speed: int, distance: int = 0) -> None:
+        """Add one record sample; values must fit the FIT field types of the channels."""
+        self.timestamps.append(timestamp)
+        self.power.append(power)
+        self.cadence.append(cadence)
+        self.heart_rate.append(heart_rate)
+        self.speed.append(speed)
+        self.distance.append(distance)
+
+    @property
+    def lap_start(self) -> int:
+        """Return the index of the first sample after the last closed lap."""
+        return self.lap_bounds[-1] if self.lap_bounds else 0
+
+    def close_lap(self, start: int | None = None, end: int | None = None) -> range:
+        """Record a lap, by default from the end of the previous lap to the last sample.
+
+        Args:
+            start (int | None): The index of the first sample of the lap.
+            end (int | None): The index after the last sample of the lap.
+
+        Returns:
+            range: The sample indices of the lap.
+
+        """
+        lap = range(self.lap_start if start is None else start, len(self) if end is None else end)
+        self.lap_bounds.extend((lap.start, lap.stop))
+        return lap
+
+    @property
+    def laps(self) -> list[range]:
+        """Return the sample index ranges of the closed laps."""
+        bounds = self.lap_bounds
+        return [range(bounds[i], bounds[i + 1]) for i in range(0, len(bounds), 2)]
+
+    def statistics(self, samples: range | None = None) -> dict[str, float]:
+        """Calculate the summary statistics of a range of samples, by default of all of them."""
+        start, end = (0, len(self)) if samples is None else (samples.start, samples.stop)
+        return calculate_ride_statistics(
+            memoryview(self.timestamps)[start:end],
+            memoryview(self.power)[start:end],
+            memoryview(self.cadence)[start:end],
+            memoryview(self.heart_rate)[start:end],
+            memoryview(self.speed)[start:end],
+        )
+
+    def numpy(self, *names: str) -> dict[str, Any]:
+        """Return NumPy arrays sharing memory with the given channels, by default all of them.
+
+        The channels cannot grow while the arrays are alive, so drop them
+        before appending more samples.
+
+        Raises:
+            ModuleNotFoundError: If NumPy is not installed.
+
+        """
+        np = _numpy()
+        if np is None:
+            msg = "NumPy is required to expose the ride channels as arrays."
+            raise ModuleNotFoundError(msg)
+        channels = self.channels()
+        return {name: np.frombuffer(channels[name], dtype=channels[name].typecode) for name in names or channels}
+
+    def reset(self) -> None:
+        """Drop all samples and laps, e.g. after a session message has been written."""
+        for channel in (*self.channels().values(), self.lap_bounds):
+            del channel[:]
+
+    @property
+    def nbytes(self) -> int:
+        """Return the memory used by the sample buffers."""
+        return sum(channel.itemsize * len(channel) for channel in self.channels().values())
+
+
+def _build_crc16_table() -> tuple[int, ...]:
+    """Build the byte-wise lookup table for the FIT CRC-16 (polynomial 0xA001, reflected)."""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+FIT_CRC16_TABLE = _build_crc16_table()
+
+
+def fit_crc16(data: bytes | bytearray | memoryview, crc: int = 0) -> int:
+    """Calculate the FIT CRC-16 of a buffer, optionally continuing from a previous CRC.
+
+    Args:
+        data (bytes | bytearray | memoryview): The bytes to checksum.
+        crc (int): The CRC of the preceding bytes, 0 to start a new checksum.
+
+    Returns:
+        int: The updated CRC-16 value.
+
+    """
+    table = FIT_CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+# Summary fields filled in when missing: statistic name -> (field number, size, base type).
+FIT_SUMMARY_FIELDS = {
+    FIT_MESG_LAP: {
+        "avg_speed": (13, 2, FIT_BASE_TYPE_UINT16),
+        "max_speed": (14, 2, FIT_BASE_TYPE_UINT16),
+        "avg_heart_rate": (15, 1, FIT_BASE_TYPE_UINT8),
+        "max_heart_rate": (16, 1, FIT_BASE_TYPE_UINT8),
+        "avg_cadence": (17, 1, FIT_BASE_TYPE_UINT8),
+        "max_cadence": (18, 1, FIT_BASE_TYPE_UINT8),
+        "avg_power": (19, 2, FIT_BASE_TYPE_UINT16),
+        "max_power": (20, 2, FIT_BASE_TYPE_UINT16),
+        "normalized_power": (33, 2, FIT_BASE_TYPE_UINT16),
+    },
+    FIT_MESG_SESSION: {
+        "avg_speed": (14, 2, FIT_BASE_TYPE_UINT16),
+        "max_speed": (15, 2, FIT_BASE_TYPE_UINT16),
+        "avg_heart_rate": (16, 1, FIT_BASE_TYPE_UINT8),
+        "max_heart_rate": (17, 1, FIT_BASE_TYPE_UINT8),
+        "avg_cadence": (18, 1, FIT_BASE_TYPE_UINT8),
+        "max_cadence": (19, 1, FIT_BASE_TYPE_UINT8),
+        "avg_power": (20, 2, FIT_BASE_TYPE_UINT16),
+        "max_power": (21, 2, FIT_BASE_TYPE_UINT16),
+        "normalized_power": (34, 2, FIT_BASE_TYPE_UINT16),
+    },
+}
+FIT_FIELD_FORMATS = {1: "B", 2: "H", 4: "I"}
+# Struct format and invalid value of the integer base types, decoded by FitReader.
+FIT_BASE_TYPE_FORMATS = {
+    0x00: ("B", 0xFF),
+    0x01: ("b", 0x7F),
+    0x02: ("B", 0xFF),
+    0x83: ("h", 0x7FFF),
+    0x84: ("H", 0xFFFF),
+    0x85: ("i", 0x7FFFFFFF),
+    0x86: ("I", 0xFFFFFFFF),
+    0x0A: ("B", 0),
+    0x8B: ("H", 0),
+    0x8C: ("I", 0),
+    0x8E: ("q", 0x7FFFFFFFFFFFFFFF),
+    0x8F: ("Q", 0xFFFFFFFFFFFFFFFF),
+    0x90: ("Q", 0),
+}
+
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    """Read exactly ``size`` bytes from a stream or raise ``ValueError`` if it is truncated."""
+    data = stream.read(size)
+    if len(data) != size:
+        msg = f"Unexpected end of FIT data: wanted {size} bytes, got {len(data)}."
+        raise ValueError(msg)
+    return data
+
+
+def _read_fit_field(
+    data: bytes | bytearray | memoryview, offsets: dict[int, tuple[int, int]], field_id: int, endian: str
+) -> int:
+    """Return the value of a numeric field, or 0 if it is missing or holds the FIT invalid value."""
+    if field_id not in offsets:
+        return 0
+    offset, size = offsets[field_id]
+    fmt = FIT_FIELD_FORMATS.get(size)
+    if fmt is None:
+        return 0
+    value = struct.unpack_from(endian + fmt, data, offset)[0]
+    return 0 if value == (1 << (8 * size)) - 1 else value
+
+
+def _write_fit_field(
+    data: bytearray, offsets: dict[int, tuple[int, int]], field_id: int, endian: str, value: float
+) -> None:
+    """Store a numeric field value, clamped to the largest valid value of its size."""
+    offset, size = offsets[field_id]
+    value = max(0, min(int(value), (1 << (8 * size)) - 2))
+    struct.pack_into(endian + FIT_FIELD_FORMATS[size], data, offset, value)
+
+
+def _expand_compressed_timestamp(header_byte: int, last_timestamp: int) -> int:
+    """Return the timestamp of a compressed-header message from its 5-bit time offset."""
+    time_offset = header_byte & FIT_COMPRESSED_TIME_MASK
+    rollover = FIT_COMPRESSED_TIME_MASK + 1 if time_offset < last_timestamp & FIT_COMPRESSED_TIME_MASK else 0
+    return (last_timestamp & ~FIT_COMPRESSED_TIME_MASK) + time_offset + rollover
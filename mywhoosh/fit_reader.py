@@ -0,0 +1,461 @@
+"""Indexed reading, verification and repair of FIT files."""
+
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import struct
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Self
+
+from mywhoosh.fit_protocol import (
+    FIT_BASE_TYPE_ENUM,
+    FIT_BASE_TYPE_FORMATS,
+    FIT_BASE_TYPE_UINT32,
+    FIT_COMPRESSED_HEADER_MASK,
+    FIT_COMPRESSED_LOCAL_ID_MASK,
+    FIT_CRC_SIZE,
+    FIT_DEFINITION_MASK,
+    FIT_DEVELOPER_DATA_MASK,
+    FIT_FIELD_RECORD_DISTANCE,
+    FIT_FIELD_SESSION_SPORT,
+    FIT_FIELD_SESSION_SUB_SPORT,
+    FIT_FIELD_SESSION_TOTAL_ELAPSED_TIME,
+    FIT_FIELD_SUMMARY_START_TIME,
+    FIT_FIELD_SUMMARY_TOTAL_DISTANCE,
+    FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME,
+    FIT_FIELD_TIMESTAMP,
+    FIT_HEADER_SIZE,
+    FIT_HEADER_SIZE_LEGACY,
+    FIT_LOCAL_ID_MASK,
+    FIT_MESG_RECORD,
+    FIT_MESG_SESSION,
+    FIT_SIGNATURE,
+    FIT_SPORT_CYCLING,
+    FIT_SUB_SPORT_VIRTUAL_ACTIVITY,
+    fit_crc16,
+)
+from mywhoosh.run_metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from mywhoosh.fit_protocol import Buffer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FitMessage:
+    """A data message decoded by ``FitReader``.
+
+    Integer fields hold their value, or None for the FIT invalid value; strings,
+    floats, arrays and byte fields hold their raw bytes.
+    """
+
+    global_id: int
+    index: int
+    fields: dict[int, int | bytes | None]
+
+
+@dataclass
+class _FitLayout:
+    """Field layout of a definition message, used to decode the data messages of its local type."""
+
+    global_id: int
+    endian: str
+    size: int
+    fields: tuple[tuple[int, int, int, int], ...]
+
+
+class FitReader:
+    """Lazy reader of FIT data backed by an offset index.
+
+    One pass over the record headers stores the offset, size and global message
+    number of every message in typed arrays; no message is decoded on the way.
+    Data messages are only turned into ``FitMessage`` objects when their global
+    message number is asked for, and any message can be copied as a raw slice
+    of the input. Paths are mmap'd, so the file is never read into memory.
+    """
+
+    def __init__(self, source: Path | Buffer, name: str | None = None, *, partial: bool = False) -> None:
+        """Map or wrap the FIT data and build its message index.
+
+        Args:
+            source (Path | Buffer): The path of a FIT file, or its content as a bytes-like object.
+            name (str | None): The name of the input used in error messages.
+            partial (bool): Index truncated data up to its last complete message
+                instead of raising; ``truncated`` tells whether anything was cut off.
+
+        Raises:
+            ValueError: If the input is not valid FIT data or is truncated.
+
+        """
+        self.name = name or (source.name if isinstance(source, Path) else "FIT data")
+        self.partial = partial
+        self.truncated = False
+        self._mmap: mmap.mmap | None = None
+        if isinstance(source, Path):
+            with source.open("rb") as fp:
+                # mmap refuses empty files, which clean up to an empty file anyway
+                if os.fstat(fp.fileno()).st_size:
+                    self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            source = self._mmap if self._mmap is not None else b""
+        self._view = memoryview(source).cast("B")
+        self._offsets = array("Q")
+        self._sizes = array("I")
+        self._global_ids = array("H")
+        self._layout_ids = array("I")
+        self._definitions = bytearray()
+        self._layouts: list[_FitLayout] = []
+        self.segments: list[tuple[bytes, int, int]] = []
+        try:
+            self._scan()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self) -> Self:
+        """Return the reader itself."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Release the buffer and unmap the file."""
+        self.close()
+
+    def close(self) -> None:
+        """Release the buffer and unmap the file; raw slices must not be used afterwards."""
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __len__(self) -> int:
+        """Return the number of indexed messages, definitions included."""
+        return len(self._offsets)
+
+    def _scan(self) -> None:
+        """Index the messages of every chained FIT segment."""
+        view = self._view
+        position = 0
+        while position < len(view):
+            header_size = view[position]
+            header = view[position : position + header_size].tobytes()
+            if header_size < FIT_HEADER_SIZE_LEGACY or header[8:12] != FIT_SIGNATURE:
+                if self.partial and self.segments and len(header) < header_size:
+                    self.truncated = True
+                    return
+                msg = f"< {self.name} > is not a valid FIT file."
+                raise ValueError(msg)
+            data_start = position + header_size
+            data_end = data_start + struct.unpack_from("<I", header, 4)[0]
+            if data_end + FIT_CRC_SIZE > len(view) or (self.partial and data_end == data_start):
+                if not self.partial:
+                    wanted, available = data_end + FIT_CRC_SIZE - position, len(view) - position
+                    msg = f"Unexpected end of FIT data: wanted {wanted} bytes, got {available}."
+                    raise ValueError(msg)
+                # a crashed writer leaves the data size short, stale or 0: take whatever records are there
+                self.truncated = True
+                data_end = len(view)
+            first = len(self._offsets)
+            self._scan_records(data_start, data_end)
+            self.segments.append((header, first, len(self._offsets)))
+            position = data_end + FIT_CRC_SIZE
+
+    def _scan_records(self, position: int, end: int) -> None:
+        """Index the records between ``position`` and ``end`` without decoding them."""
+        layouts: dict[int, int] = {}
+        # the slice is released on the way out, so an error leaves no export that keeps the file mapped
+        with self._view[:end] as view:
+            self._scan_layouts(view, position, end, layouts)
+
+    def _scan_layouts(self, view: memoryview, position: int, end: int, layouts: dict[int, int]) -> None:
+        """Index the records of ``view`` from ``position``, tracking the local message types in ``layouts``."""
+        try:
+            while position < end:
+                header_byte = view[position]
+                if header_byte & FIT_COMPRESSED_HEADER_MASK:
+                    local_id = (header_byte & FIT_COMPRESSED_LOCAL_ID_MASK) >> 5
+                elif header_byte & FIT_DEFINITION_MASK:
+                    size = self._read_layout(view, position, header_byte)
+                    layouts[header_byte & FIT_LOCAL_ID_MASK] = len(self._layouts) - 1
+                    self._append(position, size, len(self._layouts) - 1, definition=True)
+                    position += size
+                    continue
+                else:
+                    local_id = header_byte & FIT_LOCAL_ID_MASK
+                layout_id = layouts.get(local_id)
+                if layout_id is None:
+                    msg = f"Data message for undefined local message type {local_id}."
+                    raise ValueError(msg)
+                size = 1 + self._layouts[layout_id].size
+                if position + size > end:
+                    raise IndexError(position + size)
+                self._append(position, size, layout_id, definition=False)
+                position += size
+        except (IndexError, struct.error) as error:
+            if self.partial:
+                self.truncated = True
+                return
+            msg = "FIT record overruns the data size declared in the file header."
+            raise ValueError(msg) from error
+        if position > end:
+            msg = "FIT record overruns the data size declared in the file header."
+            raise ValueError(msg)
+
+    def _read_layout(self, view: memoryview, position: int, header_byte: int) -> int:
+        """Store the layout of the definition message at ``position`` and return its size."""
+        endian = ">" if view[position + 2] else "<"
+        global_id = struct.unpack_from(endian + "H", view, position + 3)[0]
+        fields = []
+        offset = 0
+        end = position + 6 + view[position + 5] * 3
+        if end > len(view):
+            raise IndexError(end)
+        for number, size, base_type in struct.iter_unpack("BBB", view[position + 6 : end]):
+            fields.append((number, offset, size, base_type))
+            offset += size
+        if header_byte & FIT_DEVELOPER_DATA_MASK:
+            developer_end = end + 1 + view[end] * 3
+            if developer_end > len(view):
+                raise IndexError(developer_end)
+            offset += sum(view[i + 1] for i in range(end + 1, developer_end, 3))
+            end = developer_end
+        self._layouts.append(_FitLayout(global_id, endian, offset, tuple(fields)))
+        return end - position
+
+    def _append(self, offset: int, size: int, layout_id: int, *, definition: bool) -> None:
+        """Add one message to the index."""
+        self._offsets.append(offset)
+        self._sizes.append(size)
+        self._global_ids.append(self._layouts[layout_id].global_id)
+        self._layout_ids.append(layout_id)
+        self._definitions.append(definition)
+
+    def global_id(self, index: int) -> int:
+        """Return the global message number of a message, or of the messages a definition describes."""
+        return self._global_ids[index]
+
+    def is_definition(self, index: int) -> bool:
+        """Return whether the message at ``index`` is a definition message."""
+        return bool(self._definitions[index])
+
+    def raw(self, index: int) -> memoryview:
+        """Return the bytes of a message, record header included, as a slice of the input."""
+        offset = self._offsets[index]
+        return self._view[offset : offset + self._sizes[index]]
+
+    def decode(self, index: int) -> FitMessage:
+        """Decode the fields of the data message at ``index``.
+
+        Args:
+            index (int): The position of the message in the index.
+
+        Returns:
+            FitMessage: The decoded message.
+
+        Raises:
+            ValueError: If the message is a definition message.
+
+        """
+        if self._definitions[index]:
+            msg = f"Message {index} of < {self.name} > is a definition message."
+            raise ValueError(msg)
+        layout = self._layouts[self._layout_ids[index]]
+        data = self.raw(index)[1:]
+        fields: dict[int, int | bytes | None] = {}
+        for number, offset, size, base_type in layout.fields:
+            fmt, invalid = FIT_BASE_TYPE_FORMATS.get(base_type, ("", None))
+            if not fmt or struct.calcsize(fmt) != size:
+                fields[number] = data[offset : offset + size].tobytes()
+                continue
+            value = struct.unpack_from(layout.endian + fmt, data, offset)[0]
+            fields[number] = None if value == invalid else value
+        return FitMessage(layout.global_id, index, fields)
+
+    def messages(self, *global_ids: int) -> Iterator[FitMessage]:
+        """Decode the data messages with the given global message numbers, in file order.
+
+        Args:
+            *global_ids (int): The global message numbers to decode, e.g. ``FIT_MESG_SESSION``.
+
+        Yields:
+            FitMessage: The decoded messages; all other messages are skipped without decoding.
+
+        """
+        wanted = set(global_ids)
+        definitions = self._definitions
+        for index, global_id in enumerate(self._global_ids):
+            if global_id in wanted and not definitions[index]:
+                yield self.decode(index)
+
+
+def verify_fit_data(data: Buffer) -> list[str]:
+    """Check the headers, data sizes and CRCs of FIT data without decoding any message.
+
+    Args:
+        data (Buffer): The content of a FIT file.
+
+    Returns:
+        list[str]: The problems found, empty if the data is intact.
+
+    """
+    problems = []
+    with memoryview(data) as base, base.cast("B") as view:
+        if not len(view):
+            return ["the file is empty"]
+        position = 0
+        while position < len(view):
+            header_size = view[position]
+            if (
+                header_size < FIT_HEADER_SIZE_LEGACY
+                or position + header_size > len(view)
+                or view[position + 8 : position + 12] != FIT_SIGNATURE
+            ):
+                problems.append(f"no FIT header at byte {position}")
+                break
+            if header_size >= FIT_HEADER_SIZE:
+                header_crc = struct.unpack_from("<H", view, position + 12)[0]
+                if header_crc and header_crc != fit_crc16(view[position : position + FIT_HEADER_SIZE_LEGACY]):
+                    problems.append(f"header CRC mismatch at byte {position}")
+            data_end = position + header_size + struct.unpack_from("<I", view, position + 4)[0]
+            if data_end + FIT_CRC_SIZE > len(view):
+                problems.append(
+                    f"truncated: the header at byte {position} declares {data_end + FIT_CRC_SIZE - position} bytes, "
+                    f"only {len(view) - position} are present"
+                )
+                break
+            if fit_crc16(view[position:data_end]) != struct.unpack_from("<H", view, data_end)[0]:
+                problems.append(f"file CRC mismatch at byte {data_end}")
+            position = data_end + FIT_CRC_SIZE
+    return problems
+
+
+def verify_fit_file(fit_file: Path) -> list[str]:
+    """Check the headers, data sizes and CRCs of a FIT file, see ``verify_fit_data``.
+
+    Args:
+        fit_file (Path): The FIT file to check.
+
+    Returns:
+        list[str]: The problems found, empty if the file is intact.
+
+    """
+    with metrics.span("verify"), fit_file.open("rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return ["the file is empty"]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return verify_fit_data(data)
+
+
+def _synthesize_session(reader: FitReader, first: int, end: int) -> bytes:
+    """Build a definition and a session message covering the record messages of a segment."""
+    records = [index for index in range(first, end) if reader.global_id(index) == FIT_MESG_RECORD]
+    records = [index for index in records if not reader.is_definition(index)]
+    if not records:
+        msg = f"< {reader.name} > has no complete record message to build a session from."
+        raise ValueError(msg)
+    first_record, last_record = reader.decode(records[0]).fields, reader.decode(records[-1]).fields
+    timestamps = [
+        value
+        for value in (first_record.get(FIT_FIELD_TIMESTAMP), last_record.get(FIT_FIELD_TIMESTAMP))
+        if isinstance(value, int)
+    ]
+    if len(timestamps) != 2:
+        msg = f"< {reader.name} > has no record timestamps to build a session from."
+        raise ValueError(msg)
+    start_time, timestamp = timestamps
+    distance = last_record.get(FIT_FIELD_RECORD_DISTANCE)
+    elapsed = (timestamp - start_time) * 1000
+    fields = (
+        (FIT_FIELD_TIMESTAMP, 4, FIT_BASE_TYPE_UINT32, timestamp),
+        (FIT_FIELD_SUMMARY_START_TIME, 4, FIT_BASE_TYPE_UINT32, start_time),
+        (FIT_FIELD_SESSION_TOTAL_ELAPSED_TIME, 4, FIT_BASE_TYPE_UINT32, elapsed),
+        (FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME, 4, FIT_BASE_TYPE_UINT32, elapsed),
+        (
+            FIT_FIELD_SUMMARY_TOTAL_DISTANCE,
+            4,
+            FIT_BASE_TYPE_UINT32,
+            distance if isinstance(distance, int) else 0xFFFFFFFF,
+        ),
+        (FIT_FIELD_SESSION_SPORT, 1, FIT_BASE_TYPE_ENUM, FIT_SPORT_CYCLING),
+        (FIT_FIELD_SESSION_SUB_SPORT, 1, FIT_BASE_TYPE_ENUM, FIT_SUB_SPORT_VIRTUAL_ACTIVITY),
+    )
+    local_id = FIT_LOCAL_ID_MASK
+    message = bytearray([FIT_DEFINITION_MASK | local_id, 0, 0])
+    message += struct.pack("<HB", FIT_MESG_SESSION, len(fields))
+    for number, size, base_type, _ in fields:
+        message += bytes((number, size, base_type))
+    message.append(local_id)
+    for _, size, _, value in fields:
+        message += value.to_bytes(size, "little")
+    return bytes(message)
+
+
+def repair_fit_data(data: Buffer, name: str = "FIT data") -> bytes:
+    """Cut truncated FIT data at its last complete message and close it properly.
+
+    Every segment is kept up to its last complete message; a segment without a
+    session message, like a ride whose recording was killed, gets one built
+    from its first and last record. The headers and CRCs are recomputed.
+
+    Args:
+        data (Buffer): The content of a damaged FIT file.
+        name (str): The name of the input used in error messages.
+
+    Returns:
+        bytes: The repaired FIT data.
+
+    Raises:
+        ValueError: If the data holds no FIT header or no records to build a session from.
+
+    """
+    with metrics.span("repair"), FitReader(data, name, partial=True) as reader:
+        if not reader.segments:
+            msg = f"< {name} > holds no FIT data to repair."
+            raise ValueError(msg)
+        out = bytearray()
+        for header, first, end in reader.segments:
+            segment = bytearray(header)
+            for index in range(first, end):
+                segment += reader.raw(index)
+            if not any(
+                reader.global_id(index) == FIT_MESG_SESSION and not reader.is_definition(index)
+                for index in range(first, end)
+            ):
+                segment += _synthesize_session(reader, first, end)
+            struct.pack_into("<I", segment, 4, len(segment) - len(header))
+            if len(header) >= FIT_HEADER_SIZE:
+                struct.pack_into("<H", segment, 12, fit_crc16(segment[:FIT_HEADER_SIZE_LEGACY]))
+            out += segment
+            out += struct.pack("<H", fit_crc16(segment))
+    msg = f"Repaired < {name} >: kept {len(reader)} complete messages, {len(out)} bytes."
+    logger.info(msg)
+    return bytes(out)
+
+
+def checked_fit_data(fit_file: Path, *, repair: bool = False) -> bytes | None:
+    """Verify a source FIT file before it is cleaned up, repairing it if asked to.
+
+    Args:
+        fit_file (Path): The FIT file to check.
+        repair (bool): Repair a damaged file instead of rejecting it.
+
+    Returns:
+        bytes | None: The repaired content, or None if the file is intact.
+
+    Raises:
+        ValueError: If the file is damaged and ``repair`` is False, or cannot be repaired.
+
+    """
+    problems = verify_fit_file(fit_file)
+    if not problems:
+        return None
+    msg = f"< {fit_file.name} > is damaged: {'; '.join(problems)}."
+    if not repair:
+        raise ValueError(msg + " Use --repair to cut it at the last complete message.")
+    logger.warning(msg)
+    return repair_fit_data(fit_file.read_bytes(), fit_file.name)
@@ -0,0 +1,771 @@
+"""Rewriting of MyWhoosh FIT files into cleaned-up FIT files."""
+
+from __future__ import annotations
+
+import functools
+import logging
+import struct
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import TYPE_CHECKING, BinaryIO
+
+from mywhoosh.fit_profile import DEFAULT_TRANSFORM_PROFILE, FitMessageTransform, FitTransformProfile
+from mywhoosh.fit_protocol import (
+    FIT_COMPRESSED_HEADER_MASK,
+    FIT_COMPRESSED_LOCAL_ID_MASK,
+    FIT_CRC_SIZE,
+    FIT_DEFINITION_MASK,
+    FIT_DEVELOPER_DATA_MASK,
+    FIT_EPOCH_OFFSET,
+    FIT_FIELD_FORMATS,
+    FIT_FIELD_RECORD_CADENCE,
+    FIT_FIELD_RECORD_DISTANCE,
+    FIT_FIELD_RECORD_ENHANCED_SPEED,
+    FIT_FIELD_RECORD_HEART_RATE,
+    FIT_FIELD_RECORD_POWER,
+    FIT_FIELD_RECORD_SPEED,
+    FIT_FIELD_SUMMARY_START_TIME,
+    FIT_FIELD_SUMMARY_TOTAL_DISTANCE,
+    FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME,
+    FIT_FIELD_TIMESTAMP,
+    FIT_HEADER_SIZE,
+    FIT_HEADER_SIZE_LEGACY,
+    FIT_LOCAL_ID_MASK,
+    FIT_MESG_LAP,
+    FIT_MESG_RECORD,
+    FIT_MESG_SESSION,
+    FIT_SIGNATURE,
+    SMART_RECORDING_MAX_INTERVAL,
+    SMART_RECORDING_THRESHOLDS,
+    RideChannels,
+    _expand_compressed_timestamp,
+    _numpy,
+    _read_exact,
+    _read_fit_field,
+    _write_fit_field,
+    calculate_avg,
+    fit_crc16,
+    message_value,
+)
+from mywhoosh.fit_reader import FitReader
+from mywhoosh.run_metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+    from pathlib import Path
+
+    from mywhoosh.fit_protocol import Buffer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FitRewritePlan:
+    """Pre-computed rewrite instructions for one local message type of a FIT file.
+
+    The plan is compiled once per definition message, so every data message of
+    that local type is handled with slicing and ``struct`` calls only.
+    """
+
+    global_id: int
+    endian: str
+    size: int
+    definition: bytes
+    keep: list[tuple[int, int]] | None = None
+    insert: bytes = b""
+    developer_size: int = 0
+    input_offsets: dict[int, tuple[int, int]] = field(default_factory=dict)
+    output_offsets: dict[int, tuple[int, int]] = field(default_factory=dict)
+    transform: FitMessageTransform | None = None
+
+
+@dataclass
+class FitRewriteStats:
+    """State of the rewriter within one segment.
+
+    The record channels of the current session are used to fill in missing lap
+    and session summaries; the last timestamp resolves compressed timestamps.
+    When records are downsampled, the last skipped record is held back and
+    written before the next message that is not a record, so every lap and
+    the session still end on their last sample.
+    """
+
+    channels: RideChannels = field(default_factory=RideChannels)
+    last_timestamp: int = 0
+    kept_record: tuple[int, ...] | None = None
+    pending: bytes | None = None
+    records_kept: int = 0
+    records_dropped: int = 0
+
+
+def _compile_rewrite_plan(
+    header_byte: int,
+    content: bytes,
+    developer_content: bytes,
+    table: Mapping[int, FitMessageTransform] = DEFAULT_TRANSFORM_PROFILE.table,
+) -> FitRewritePlan:
+    """Compile a definition message into a rewrite plan and the definition bytes to write.
+
+    Args:
+        header_byte (int): The record header byte of the definition message.
+        content (bytes): The fixed part and field definitions of the definition message.
+        developer_content (bytes): The developer field definitions including their count byte, or empty.
+        table (Mapping[int, FitMessageTransform]): The compiled transform profile.
+
+    Returns:
+        FitRewritePlan: The plan for the data messages using this definition.
+
+    """
+    endian = ">" if content[1] else "<"
+    global_id = struct.unpack_from(endian + "H", content, 2)[0]
+    fields = [tuple(content[i : i + 3]) for i in range(5, len(content), 3)]
+    developer_size = sum(developer_content[i + 1] for i in range(1, len(developer_content), 3))
+
+    transform = table.get(global_id)
+    if transform is not None and transform.remove:
+        # the definition and all data messages of a removed message type are left out
+        return FitRewritePlan(
+            global_id, endian, sum(size for _, size, _ in fields) + developer_size, b"", transform=transform
+        )
+    drop = transform.drop if transform else frozenset()
+    ensure = [f for f in transform.ensure if f[0] not in {n for n, _, _ in fields}] if transform else []
+
+    input_offsets: dict[int, tuple[int, int]] = {}
+    output_offsets: dict[int, tuple[int, int]] = {}
+    keep: list[tuple[int, int]] = []
+    new_fields = []
+    offset = out_offset = 0
+    for number, size, base_type in fields:
+        input_offsets[number] = (offset, size)
+        if number in drop:
+            offset += size
+            continue
+        if keep and keep[-1][1] == offset:
+            keep[-1] = (keep[-1][0], offset + size)
+        else:
+            keep.append((offset, offset + size))
+        output_offsets[number] = (out_offset, size)
+        new_fields.append((number, size, base_type))
+        offset += size
+        out_offset += size
+
+    insert = bytearray()
+    for number, size, base_type in ensure:
+        output_offsets[number] = (out_offset + len(insert), size)
+        new_fields.append((number, size, base_type))
+        insert += b"\xff" * size
+
+    definition = bytearray([header_byte, 0, content[1]])
+    definition += struct.pack(endian + "H", global_id)
+    definition.append(len(new_fields))
+    for number, size, base_type in new_fields:
+        definition += bytes((number, size, base_type))
+    definition += developer_content
+
+    unchanged = not insert and len(new_fields) == len(fields)
+    return FitRewritePlan(
+        global_id=global_id,
+        endian=endian,
+        size=offset + developer_size,
+        definition=bytes(definition),
+        keep=None if unchanged else keep,
+        insert=bytes(insert),
+        developer_size=developer_size,
+        input_offsets=input_offsets,
+        output_offsets=output_offsets,
+        transform=transform,
+    )
+
+
+def _summary_window(plan: FitRewritePlan, data: bytes | memoryview, stats: FitRewriteStats) -> tuple[int, int]:
+    """Return the index range of the record samples summarised by a lap or session message."""
+    channels = stats.channels
+    if plan.global_id == FIT_MESG_SESSION:
+        return 0, len(channels)
+    start, end = channels.lap_start, len(channels)
+    np = _numpy()
+    if np is not None and end > start:
+        timestamps = channels.numpy("timestamps")["timestamps"]
+        start_time = _read_fit_field(data, plan.input_offsets, FIT_FIELD_SUMMARY_START_TIME, plan.endian)
+        if start_time:
+            start = int(np.searchsorted(timestamps, start_time, side="left"))
+        if FIT_FIELD_TIMESTAMP in plan.input_offsets:
+            end = int(np.searchsorted(timestamps, stats.last_timestamp, side="right"))
+        del timestamps
+    return start, end
+
+
+def _keep_record(transform: FitMessageTransform, stats: FitRewriteStats) -> bool:
+    """Decide whether the record just added to the channels is kept by the downsampling."""
+    channels = stats.channels
+    timestamp = channels.timestamps[-1]
+    values = (channels.power[-1], channels.cadence[-1], channels.heart_rate[-1], channels.speed[-1])
+    kept = stats.kept_record
+    if kept is not None and timestamp >= kept[0]:
+        elapsed = timestamp - kept[0]
+        if transform.record_interval:
+            keep = elapsed >= transform.record_interval
+        else:
+            keep = elapsed >= SMART_RECORDING_MAX_INTERVAL or any(
+                abs(value - kept_value) >= threshold
+                for value, kept_value, threshold in zip(values, kept[1:], SMART_RECORDING_THRESHOLDS, strict=True)
+            )
+        if not keep:
+            return False
+    stats.kept_record = (timestamp, *values)
+    return True
+
+
+def _flush_pending_record(dst: BinaryIO, stats: FitRewriteStats) -> int:
+    """Write the record held back by the downsampling, if any, and return the bytes written."""
+    if stats.pending is None:
+        return 0
+    pending, stats.pending = stats.pending, None
+    dst.write(pending)
+    stats.records_kept += 1
+    stats.records_dropped -= 1
+    return len(pending)
+
+
+def _rewrite_data_message(
+    plan: FitRewritePlan, data: bytes | memoryview, stats: FitRewriteStats, header_byte: int = 0
+) -> bytes | memoryview | None:
+    """Apply a rewrite plan to the content of one data message.
+
+    Args:
+        plan (FitRewritePlan): The compiled plan of the message's local type.
+        data (bytes | memoryview): The raw content of the data message, without its header byte.
+        stats (FitRewriteStats): The record channels, extended by record messages
+            and summarised into lap and session messages.
+        header_byte (int): The record header byte, kept with a record held back by the downsampling.
+
+    Returns:
+        bytes | memoryview | None: The content to write in place of ``data``,
+            or None if the message is removed or skipped by the downsampling.
+
+    """
+    endian = plan.endian
+    offsets = plan.input_offsets
+    transform = plan.transform
+    if FIT_FIELD_TIMESTAMP in offsets:
+        stats.last_timestamp = _read_fit_field(data, offsets, FIT_FIELD_TIMESTAMP, endian) or stats.last_timestamp
+    if transform is None:
+        return data
+    if transform.remove:
+        return None
+    if transform.records:
+        stats.channels.append(
+            stats.last_timestamp,
+            _read_fit_field(data, offsets, FIT_FIELD_RECORD_POWER, endian),
+            _read_fit_field(data, offsets, FIT_FIELD_RECORD_CADENCE, endian),
+            _read_fit_field(data, offsets, FIT_FIELD_RECORD_HEART_RATE, endian),
+            _read_fit_field(data, offsets, FIT_FIELD_RECORD_ENHANCED_SPEED, endian)
+            or _read_fit_field(data, offsets, FIT_FIELD_RECORD_SPEED, endian),
+            _read_fit_field(data, offsets, FIT_FIELD_RECORD_DISTANCE, endian),
+        )
+    out = _transform_data_message(plan, data, stats)
+    if transform.record_interval or transform.smart_recording:
+        # compressed headers carry a time offset and must not lose their predecessor
+        if header_byte & FIT_COMPRESSED_HEADER_MASK or _keep_record(transform, stats):
+            stats.pending = None
+            stats.records_kept += 1
+        else:
+            stats.pending = bytes((header_byte,)) + bytes(out)
+            stats.records_dropped += 1
+            return None
+    return out
+
+
+def _transform_data_message(
+    plan: FitRewritePlan, data: bytes | memoryview, stats: FitRewriteStats
+) -> bytes | memoryview:
+    """Drop, insert, summarise and set the fields of one data message as its transform says."""
+    transform = plan.transform
+    if transform is None or (plan.keep is None and not transform.set_values and transform.summary is None):
+        return data
+    endian = plan.endian
+
+    if plan.keep is None:
+        out = bytearray(data)
+    else:
+        out = bytearray()
+        for start, end in plan.keep:
+            out += data[start:end]
+        out += plan.insert
+        out += data[plan.size - plan.developer_size :]
+
+    offsets = plan.output_offsets
+    if transform.summary is not None:
+        samples = range(*_summary_window(plan, data, stats))
+        statistics = stats.channels.statistics(samples)
+        timer_time = _read_fit_field(out, offsets, FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME, endian)
+        if timer_time:
+            # total_distance is stored in cm, total_timer_time in ms and avg_speed in mm/s
+            distance = _read_fit_field(out, offsets, FIT_FIELD_SUMMARY_TOTAL_DISTANCE, endian)
+            statistics["avg_speed"] = distance * 10_000 / timer_time
+        for name, (number, _, _) in transform.summary.items():
+            if name in statistics and not _read_fit_field(out, offsets, number, endian):
+                _write_fit_field(out, offsets, number, endian, statistics[name])
+        if plan.global_id == FIT_MESG_SESSION:
+            stats.channels.reset()
+        else:
+            stats.channels.close_lap(samples.start, samples.stop)
+    for number, value in transform.set_values:
+        if offsets.get(number, (0, 0))[1] in FIT_FIELD_FORMATS:
+            _write_fit_field(out, offsets, number, endian, value)
+    return bytes(out)
+
+
+def _rewrite_fit_segment(
+    src: BinaryIO,
+    dst: BinaryIO,
+    header: bytes,
+    table: Mapping[int, FitMessageTransform] = DEFAULT_TRANSFORM_PROFILE.table,
+) -> None:
+    """Stream the records of one FIT segment from ``src`` to ``dst``, patching them on the fly.
+
+    The segment header is written with a placeholder data size first and fixed
+    up once all records are written; the trailing CRC is then calculated by
+    re-reading the written segment in chunks, so memory use stays constant.
+
+    Args:
+        src (BinaryIO): The input stream, positioned right after the segment header.
+        dst (BinaryIO): The seekable, readable output stream.
+        header (bytes): The header of the input segment.
+        table (Mapping[int, FitMessageTransform]): The compiled transform profile.
+
+    Returns:
+        None
+
+    """
+    header_size = header[0]
+    data_size = struct.unpack_from("<I", header, 4)[0]
+    segment_start = dst.tell()
+    dst.write(header)
+
+    plans: dict[int, FitRewritePlan] = {}
+    stats = FitRewriteStats()
+    remaining = data_size
+    written = 0
+    messages = 0
+    # per-stage time is summed locally and reported once per segment
+    clock = time.perf_counter
+    decode_time = transform_time = write_time = 0.0
+    while remaining > 0:
+        start = clock()
+        header_byte = _read_exact(src, 1)[0]
+        remaining -= 1
+        if header_byte & FIT_COMPRESSED_HEADER_MASK:
+            local_id = (header_byte & FIT_COMPRESSED_LOCAL_ID_MASK) >> 5
+            stats.last_timestamp = _expand_compressed_timestamp(header_byte, stats.last_timestamp)
+        elif header_byte & FIT_DEFINITION_MASK:
+            content = _read_exact(src, 5)
+            content += _read_exact(src, content[4] * 3)
+            developer_content = b""
+            if header_byte & FIT_DEVELOPER_DATA_MASK:
+                developer_content = _read_exact(src, 1)
+                developer_content += _read_exact(src, developer_content[0] * 3)
+            remaining -= len(content) + len(developer_content)
+            plan = _compile_rewrite_plan(header_byte, content, developer_content, table)
+            plans[header_byte & FIT_LOCAL_ID_MASK] = plan
+            decoded = clock()
+            written += _flush_pending_record(dst, stats)
+            dst.write(plan.definition)
+            written += len(plan.definition)
+            decode_time += decoded - start
+            write_time += clock() - decoded
+            continue
+        else:
+            local_id = header_byte & FIT_LOCAL_ID_MASK
+
+        data_plan = plans.get(local_id)
+        if data_plan is None:
+            msg = f"Data message for undefined local message type {local_id}."
+            raise ValueError(msg)
+        content = _read_exact(src, data_plan.size)
+        remaining -= data_plan.size
+        decoded = clock()
+        data = _rewrite_data_message(data_plan, content, stats, header_byte)
+        transformed = clock()
+        if data is not None:
+            if data_plan.global_id != FIT_MESG_RECORD:
+                written += _flush_pending_record(dst, stats)
+            dst.write(bytes((header_byte,)))
+            dst.write(data)
+            written += 1 + len(data)
+        messages += 1
+        decode_time += decoded - start
+        transform_time += transformed - decoded
+        write_time += clock() - transformed
+
+    if remaining < 0:
+        msg = "FIT record overruns the data size declared in the file header."
+        raise ValueError(msg)
+    _read_exact(src, FIT_CRC_SIZE)
+
+    written += _flush_pending_record(dst, stats)
+    segment_size = _finish_fit_segment(dst, header, segment_start, written)
+    metrics.add_time("decode", decode_time)
+    metrics.add_time("transform", transform_time, messages)
+    metrics.add_time("write", write_time)
+    metrics.count("messages", messages)
+    metrics.count("bytes_read", header_size + data_size + FIT_CRC_SIZE)
+    metrics.count("bytes_written", segment_size)
+    _report_downsampling(stats, header_size + data_size + FIT_CRC_SIZE, segment_size)
+
+
+def _report_downsampling(stats: FitRewriteStats, size_before: int, size_after: int) -> None:
+    """Count and log the records kept and dropped by the downsampling of a segment."""
+    records = stats.records_kept + stats.records_dropped
+    if not records:
+        return
+    metrics.count("records_kept", stats.records_kept)
+    metrics.count("records_dropped", stats.records_dropped)
+    msg = (
+        f"Downsampled {records} records to {stats.records_kept}, "
+        f"{size_before} -> {size_after} bytes ({1 - size_after / size_before:.0%} smaller)."
+    )
+    logger.info(msg)
+
+
+def _finish_fit_segment(dst: BinaryIO, header: bytes, segment_start: int, written: int) -> int:
+    """Patch the data size and header CRC of a rewritten segment and append its file CRC.
+
+    Args:
+        dst (BinaryIO): The seekable, readable output stream, positioned after the last record.
+        header (bytes): The header of the input segment.
+        segment_start (int): The position of the segment header in ``dst``.
+        written (int): The number of record bytes written after the header.
+
+    Returns:
+        int: The size of the rewritten segment including its header and CRC.
+
+    """
+    with metrics.span("encode"):
+        new_header = bytearray(header)
+        struct.pack_into("<I", new_header, 4, written)
+        if header[0] >= FIT_HEADER_SIZE:
+            struct.pack_into("<H", new_header, 12, fit_crc16(new_header[:FIT_HEADER_SIZE_LEGACY]))
+        segment_end = dst.tell()
+        dst.seek(segment_start)
+        dst.write(new_header)
+
+        dst.seek(segment_start)
+        crc = 0
+        left = segment_end - segment_start
+        while left > 0:
+            chunk = dst.read(min(left, 1 << 16))
+            crc = fit_crc16(chunk, crc)
+            left -= len(chunk)
+        dst.seek(segment_end)
+        dst.write(struct.pack("<H", crc))
+    return segment_end - segment_start + FIT_CRC_SIZE
+
+
+def _rewrite_indexed_segment(
+    reader: FitReader,
+    segment: tuple[bytes, int, int],
+    dst: BinaryIO,
+    table: Mapping[int, FitMessageTransform] = DEFAULT_TRANSFORM_PROFILE.table,
+) -> None:
+    """Rewrite one segment of an indexed FIT file, copying untouched messages as raw slices.
+
+    Only messages that are transformed or summarised are handed to
+    ``_rewrite_data_message``; everything else is written straight from the
+    reader's buffer, reading at most its timestamp.
+
+    Args:
+        reader (FitReader): The indexed input.
+        segment (tuple[bytes, int, int]): The segment header and its range of message indices.
+        dst (BinaryIO): The seekable, readable output stream.
+        table (Mapping[int, FitMessageTransform]): The compiled transform profile.
+
+    Returns:
+        None
+
+    """
+    header, first, end = segment
+    segment_start = dst.tell()
+    dst.write(header)
+
+    plans: dict[int, FitRewritePlan] = {}
+    stats = FitRewriteStats()
+    written = 0
+    messages = 0
+    clock = time.perf_counter
+    decode_time = transform_time = write_time = 0.0
+    for index in range(first, end):
+        start = clock()
+        record = reader.raw(index)
+        header_byte = record[0]
+        if header_byte & FIT_COMPRESSED_HEADER_MASK:
+            local_id = (header_byte & FIT_COMPRESSED_LOCAL_ID_MASK) >> 5
+            stats.last_timestamp = _expand_compressed_timestamp(header_byte, stats.last_timestamp)
+        elif header_byte & FIT_DEFINITION_MASK:
+            content_end = 6 + record[5] * 3
+            plan = _compile_rewrite_plan(
+                header_byte, record[1:content_end].tobytes(), record[content_end:].tobytes(), table
+            )
+            plans[header_byte & FIT_LOCAL_ID_MASK] = plan
+            decoded = clock()
+            written += _flush_pending_record(dst, stats)
+            dst.write(plan.definition)
+            written += len(plan.definition)
+            decode_time += decoded - start
+            write_time += clock() - decoded
+            continue
+        else:
+            local_id = header_byte & FIT_LOCAL_ID_MASK
+
+        data_plan = plans[local_id]
+        decoded = clock()
+        if data_plan.transform is None:
+            if FIT_FIELD_TIMESTAMP in data_plan.input_offsets:
+                timestamp = _read_fit_field(record[1:], data_plan.input_offsets, FIT_FIELD_TIMESTAMP, data_plan.endian)
+                stats.last_timestamp = timestamp or stats.last_timestamp
+            transformed = clock()
+            written += _flush_pending_record(dst, stats)
+            dst.write(record)
+            written += len(record)
+        else:
+            data = _rewrite_data_message(data_plan, record[1:], stats, header_byte)
+            transformed = clock()
+            if data is not None:
+                if data_plan.global_id != FIT_MESG_RECORD:
+                    written += _flush_pending_record(dst, stats)
+                dst.write(bytes((header_byte,)))
+                dst.write(data)
+                written += 1 + len(data)
+        messages += 1
+        decode_time += decoded - start
+        transform_time += transformed - decoded
+        write_time += clock() - transformed
+
+    written += _flush_pending_record(dst, stats)
+    segment_size = _finish_fit_segment(dst, header, segment_start, written)
+    segment_read = header[0] + struct.unpack_from("<I", header, 4)[0] + FIT_CRC_SIZE
+    metrics.add_time("decode", decode_time)
+    metrics.add_time("transform", transform_time, messages)
+    metrics.add_time("write", write_time)
+    metrics.count("messages", messages)
+    metrics.count("bytes_read", segment_read)
+    metrics.count("bytes_written", segment_size)
+    _report_downsampling(stats, segment_read, segment_size)
+
+
+def cleanup_fit_reader(
+    reader: FitReader, dst: BinaryIO, *, profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE
+) -> None:
+    """Clean up every segment of an indexed FIT file and write the result to ``dst``.
+
+    Args:
+        reader (FitReader): The indexed input.
+        dst (BinaryIO): The seekable, readable output stream.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        None
+
+    """
+    for segment in reader.segments:
+        _rewrite_indexed_segment(reader, segment, dst, profile.table)
+
+
+def stream_cleanup_fit_file(
+    fit_file_path: Path, new_file_path: Path, *, profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE
+) -> None:
+    """Clean up a FIT file in a single pass without decoding it into objects.
+
+    The file is mmap'd and indexed by ``FitReader``; the messages named by the
+    transform profile are rewritten (by default record messages lose their
+    temperature field, lap and session messages get missing averages filled in
+    and the file id is overridden to a Garmin device). All other messages are
+    copied as raw slices of the mapping and the CRCs are recomputed, so memory
+    use does not grow with the length of the ride.
+
+    Args:
+        fit_file_path (Path): The path to the input FIT file.
+        new_file_path (Path): The path to save the processed FIT file.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the input is not a valid FIT file or is truncated.
+
+    """
+    with metrics.span("decode"):
+        reader = FitReader(fit_file_path)
+    with reader, new_file_path.open("w+b") as dst:
+        cleanup_fit_reader(reader, dst, profile=profile)
+    msg = f"Cleaned-up file saved as < {new_file_path} >."
+    logger.info(msg)
+
+
+def cleanup_fit_stream(
+    src: BinaryIO, dst: BinaryIO, name: str = "FIT data", *, profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE
+) -> None:
+    """Clean up FIT data read from ``src`` and write the result to ``dst``.
+
+    This is the sequential counterpart of ``cleanup_fit_reader`` for inputs
+    that cannot be indexed up front, like pipes; every chained FIT segment of
+    the input is rewritten.
+
+    Args:
+        src (BinaryIO): The input stream, positioned at the start of the FIT data.
+        dst (BinaryIO): The seekable, readable output stream.
+        name (str): The name of the input used in error messages.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the input is not valid FIT data or is truncated.
+
+    """
+    while header_start := src.read(1):
+        if header_start[0] < FIT_HEADER_SIZE_LEGACY:
+            msg = f"< {name} > is not a valid FIT file."
+            raise ValueError(msg)
+        header = header_start + _read_exact(src, header_start[0] - 1)
+        if header[8:12] != FIT_SIGNATURE:
+            msg = f"< {name} > is not a valid FIT file."
+            raise ValueError(msg)
+        _rewrite_fit_segment(src, dst, header, profile.table)
+
+
+def cleanup_fit_bytes(
+    data: Buffer | BinaryIO,
+    output: BinaryIO | None = None,
+    *,
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+) -> bytes | None:
+    """Clean up FIT data in memory, without touching the disk.
+
+    The input can be any bytes-like object, including a memoryview of an
+    mmap'd file, or a readable binary stream such as ``sys.stdin.buffer``.
+    The result is returned as bytes, or written to ``output``; outputs that
+    cannot seek back to patch the header and CRC, like pipes, are written
+    in one go from an in-memory buffer.
+
+    Args:
+        data (Buffer | BinaryIO): The content of a FIT file, or a stream to read it from.
+        output (BinaryIO | None): The binary stream to write the cleaned-up file to.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        bytes | None: The cleaned-up FIT file, or None if it was written to ``output``.
+
+    Raises:
+        ValueError: If the input is not valid FIT data or is truncated.
+
+    """
+    with ExitStack() as stack:
+        if hasattr(data, "read"):
+            rewrite = functools.partial(cleanup_fit_stream, data, profile=profile)  # type: ignore[arg-type]
+        else:
+            with metrics.span("decode"):
+                reader = stack.enter_context(FitReader(data))  # type: ignore[arg-type]
+            rewrite = functools.partial(cleanup_fit_reader, reader, profile=profile)
+        if output is not None and output.seekable() and output.readable():
+            rewrite(output)
+            return None
+        with BytesIO() as dst:
+            rewrite(dst)
+            if output is None:
+                return dst.getvalue()
+            output.write(dst.getbuffer())
+            output.flush()
+    return None
+
+
+def cleanup_fit_file(
+    fit_file_path: Path,
+    new_file_path: Path,
+    *,
+    streaming: bool = True,
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+) -> None:
+    """Clean up the FIT file by processing and removing unnecessary fields.
+
+    Clean up the FIT file by processing and removing unnecessary fields.
+    Also, calculate average values for cadence, power, and heart rate.
+
+    Args:
+        fit_file_path (Path): The path to the input FIT file.
+        new_file_path (Path): The path to save the processed FIT file.
+        streaming (bool): Use the single-pass streaming rewriter instead of
+            decoding the whole file with fit_tool.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        None
+
+    """
+    if streaming:
+        stream_cleanup_fit_file(fit_file_path, new_file_path, profile=profile)
+        return
+    if profile.downsampling:
+        logger.warning("Downsampling needs the streaming rewriter, the records are kept at full rate.")
+    from fit_tool.data_message import DataMessage  # noqa: PLC0415
+    from fit_tool.fit_file import FitFile  # noqa: PLC0415
+    from fit_tool.fit_file_builder import FitFileBuilder  # noqa: PLC0415
+
+    builder = FitFileBuilder()
+    with metrics.span("decode"):
+        fit_file = FitFile.from_file(str(fit_file_path))
+    metrics.count("bytes_read", fit_file_path.stat().st_size)
+    with metrics.span("transform"):
+        channels = RideChannels()
+        table = profile.table
+
+        for record in fit_file.records:
+            message = record.message
+            transform = table.get(message.global_id) if isinstance(message, DataMessage) else None
+            if transform is None:
+                builder.add(message)
+                continue
+            if transform.remove:
+                continue
+            for number in transform.drop:
+                message.remove_field(number)
+            if transform.records:
+                timestamp = message_value(message, "timestamp", 0.001)
+                channels.append(
+                    max(0, timestamp - FIT_EPOCH_OFFSET) if timestamp else 0,
+                    message_value(message, "power"),
+                    message_value(message, "cadence"),
+                    message_value(message, "heart_rate"),
+                    message_value(message, "speed", 1000),
+                    message_value(message, "distance", 100),
+                )
+            if transform.summary is not None and message.global_id == FIT_MESG_LAP:
+                channels.close_lap()
+            if transform.summary is not None and message.global_id == FIT_MESG_SESSION:
+                if not message.avg_cadence:
+                    message.avg_cadence = int(calculate_avg(channels.cadence))
+                if not message.avg_power:
+                    message.avg_power = int(calculate_avg(channels.power))
+                if not message.avg_heart_rate:
+                    message.avg_heart_rate = int(calculate_avg(channels.heart_rate))
+                if not message.avg_speed or message.avg_speed == 0:
+                    message.avg_speed = message.total_distance / message.total_timer_time
+                channels.reset()
+            for number, value in transform.set_values:
+                # Override e.g. manufacturer/product but keep other fields
+                fit_field = message.get_field(number)
+                if fit_field is not None:
+                    fit_field.set_value(0, value, fit_field.get_valid_sub_field(message.fields))
+            builder.add(message)
+    metrics.count("messages", len(fit_file.records))
+    with metrics.span("encode"):
+        new_fit_file = builder.build()
+    with metrics.span("write"):
+        new_fit_file.to_file(str(new_file_path))
+    metrics.count("bytes_written", new_file_path.stat().st_size)
+    msg = f"Cleaned-up file saved as < {new_file_path} >."
+    logger.info(msg)
@@ -0,0 +1,422 @@
+"""Garmin Connect accounts, authentication and uploads."""
+
+from __future__ import annotations
+
+import fnmatch
+import glob
+import json
+import logging
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from getpass import getpass
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO
+
+from tzlocal import get_localzone
+
+from mywhoosh.fit_reader import verify_fit_data
+from mywhoosh.run_metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    from garth.http import Client
+
+logger = logging.getLogger(__name__)
+
+# kept next to myWhoosh2Garmin.py, like its other state files
+TOKENS_PATH = Path(__file__).resolve().parent.parent / ".garth"
+# accounts without a "tokens" entry in the accounts file keep their tokens in ".garth-<name>"
+ACCOUNT_TOKENS_PREFIX = ".garth-"
+# refresh the Garmin OAuth2 token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
+UPLOAD_POOL_SIZE = 4
+# the upload outbox retries rate-limited and failed uploads with exponential backoff
+UPLOAD_WORKERS = UPLOAD_POOL_SIZE
+UPLOAD_MAX_ATTEMPTS = 6
+UPLOAD_BACKOFF_BASE = 2.0
+UPLOAD_BACKOFF_MAX = 300.0
+HTTP_CONFLICT = 409
+HTTP_TOO_MANY_REQUESTS = 429
+HTTP_SERVER_ERROR = 500
+
+
+def get_credentials_for_garmin(args: dict, client: Client | None = None, tokens_path: Path = TOKENS_PATH) -> None:
+    """Take command line arguments or prompt the user for Garmin credentials and authenticate using Garth.
+
+    Args:
+        args (dict): command line arguments, optionally containing username and password
+        client (Client | None): The garth client to log in, defaults to the global ``garth.client``.
+        tokens_path (Path): The directory to save the OAuth tokens to.
+
+    Returns:
+        None
+
+    Exits:
+        Exits with status 1 if authentication fails.
+
+    """
+    import garth  # noqa: PLC0415
+    from garth.exc import GarthHTTPError  # noqa: PLC0415
+
+    client = client or garth.client
+    if "garmin_username" in args and args["garmin_username"] and "garmin_password" in args and args["garmin_password"]:
+        username = args["garmin_username"]
+        password = args["garmin_password"]
+    else:
+        username = args.get("garmin_username") or input("Username: ")
+        password = getpass(f"Password for {username}: ")
+    logger.info("Authenticating...")
+    try:
+        client.login(username, password)
+        client.dump(str(tokens_path))
+        logger.info("")
+        logger.info("Successfully authenticated!")
+    except GarthHTTPError:
+        logger.info("Wrong credentials. Please check username and password.")
+        sys.exit(1)
+
+
+def authenticate_to_garmin(args: dict, client: Client | None = None, tokens_path: Path = TOKENS_PATH) -> None:
+    """Authenticate the user to Garmin
+
+    Authenticate the user to Garmin by checking for existing tokens and resuming the session
+     or prompting for credentials if no session exists or the session is expired.
+
+    Args:
+        args (dict): command line arguments, optionally containing username and password
+        client (Client | None): The garth client to authenticate, defaults to the global ``garth.client``.
+        tokens_path (Path): The directory the OAuth tokens are stored in.
+
+    Returns:
+        None
+
+    Exits:
+        Exits with status 1 if authentication fails.
+
+    """
+    import garth  # noqa: PLC0415
+    from garth.exc import GarthException  # noqa: PLC0415
+
+    client = client or garth.client
+    try:
+        if tokens_path.exists():
+            try:
+                client.load(str(tokens_path))
+                msg = f"Authenticated as: {client.username}"
+                logger.info(msg)
+            except GarthException:
+                logger.info("Session expired. Re-authenticating...")
+                get_credentials_for_garmin(args, client, tokens_path)
+        else:
+            logger.info("No existing session. Please log in.")
+            get_credentials_for_garmin(args, client, tokens_path)
+    except GarthException as e:
+        msg = f"Authentication error: {e}"
+        logger.info(msg)
+        sys.exit(1)
+
+
+@dataclass
+class GarminAccount:
+    """A Garmin Connect identity from the accounts file and the .fit files that belong to it.
+
+    A source is either a directory, which matches every .fit file below it,
+    or a file name pattern like ``*_alice_*.fit``, which is matched against
+    the name and the full path of the file.
+    """
+
+    name: str
+    username: str | None
+    tokens_path: Path
+    sources: list[str] = field(default_factory=list)
+
+    @property
+    def directories(self) -> list[Path]:
+        """Return the sources that are directories rather than patterns."""
+        return [Path(source) for source in self.sources if not glob.has_magic(source)]
+
+    def matches(self, fit_file: Path) -> bool:
+        """Return whether a .fit file belongs to this account."""
+        fit_file = fit_file.resolve()
+        for source in self.sources:
+            if glob.has_magic(source):
+                if fnmatch.fnmatch(fit_file.name, source) or fnmatch.fnmatch(str(fit_file), source):
+                    return True
+            elif fit_file.is_relative_to(Path(source).resolve()):
+                return True
+        return False
+
+
+def load_accounts(accounts_file: Path) -> list[GarminAccount]:
+    """Load the Garmin accounts from a JSON accounts file.
+
+    The file holds a list of accounts, each with a unique ``name``, the
+    Garmin ``username``, the ``sources`` that select its .fit files and an
+    optional ``tokens`` directory; relative paths are relative to the file.
+
+    Args:
+        accounts_file (Path): The JSON accounts file.
+
+    Returns:
+        list[GarminAccount]: The accounts in the order of the file.
+
+    Raises:
+        ValueError: If the accounts file is not a list of accounts with unique names and sources.
+
+    """
+    with accounts_file.open("r") as f:
+        entries = json.load(f)
+    base = accounts_file.resolve().parent
+    if not isinstance(entries, list):
+        msg = f"The accounts file < {accounts_file} > must contain a list of accounts."
+        raise ValueError(msg)  # noqa: TRY004
+    accounts: list[GarminAccount] = []
+    for entry in entries:
+        name = entry.get("name") if isinstance(entry, dict) else None
+        if not name or not entry.get("sources"):
+            msg = f"Every account in < {accounts_file} > needs a name and sources: {entry!r}"
+            raise ValueError(msg)
+        if any(account.name == name for account in accounts):
+            msg = f"The account name '{name}' is used twice in < {accounts_file} >."
+            raise ValueError(msg)
+        sources = [source if glob.has_magic(source) else str(base / source) for source in entry["sources"]]
+        accounts.append(
+            GarminAccount(
+                name=name,
+                username=entry.get("username"),
+                tokens_path=base / entry.get("tokens", f"{ACCOUNT_TOKENS_PREFIX}{name}"),
+                sources=sources,
+            )
+        )
+    return accounts
+
+
+def account_for(fit_file: Path, accounts: Sequence[GarminAccount]) -> GarminAccount | None:
+    """Return the first account a .fit file belongs to, None for the default account."""
+    return next((account for account in accounts if account.matches(fit_file)), None)
+
+
+class GarminSession:
+    """Authenticated Garmin Connect session shared by all uploads of a run.
+
+    The session wraps a garth client, keeps its OAuth2 token fresh with a
+    background thread that refreshes it shortly before it expires, and mounts
+    a keep-alive connection pool, so uploads neither pay for a new TLS
+    handshake nor for an OAuth2 exchange; the pool keeps garth's retry
+    policy. The session of an account from the
+    accounts file has a client and token store of its own, so sessions of
+    different athletes can upload at the same time.
+    """
+
+    def __init__(
+        self, args: dict, refresh_margin: float = TOKEN_REFRESH_MARGIN, account: GarminAccount | None = None
+    ) -> None:
+        """Prepare the session; call ``connect`` to authenticate."""
+        self.args = args if account is None else {**args, "garmin_username": account.username, "garmin_password": None}
+        self.refresh_margin = refresh_margin
+        self.account = account
+        self.tokens_path = TOKENS_PATH if account is None else account.tokens_path
+        self.lock = threading.RLock()
+        self._client: Client | None = None
+        self._stop = threading.Event()
+        self._refresher: threading.Thread | None = None
+
+    @property
+    def client(self) -> Client:
+        """The garth client used for all requests: the global one, or the account's own."""
+        if self.account is None:
+            import garth  # noqa: PLC0415
+
+            return garth.client
+        with self.lock:
+            if self._client is None:
+                from garth.http import Client  # noqa: PLC0415
+
+                self._client = Client()
+            return self._client
+
+    def connect(self) -> None:
+        """Authenticate, set up the connection pool and start the background token refresh."""
+        with self.lock, metrics.span("auth"):
+            hooks = self.client.sess.hooks["response"]
+            if self._count_response not in hooks:
+                hooks.append(self._count_response)
+            authenticate_to_garmin(self.args, self.client, self.tokens_path)
+            # configure mounts the pool with garth's retries instead of a bare adapter
+            self.client.configure(pool_connections=1, pool_maxsize=UPLOAD_POOL_SIZE)
+            self.refresh_if_needed()
+        if self._refresher is None:
+            name = "garmin-token-refresh" if self.account is None else f"garmin-token-refresh-{self.account.name}"
+            self._refresher = threading.Thread(target=self._refresh_loop, name=name, daemon=True)
+            self._refresher.start()
+
+    @staticmethod
+    def _count_response(response: object, *_args: object, **_kwargs: object) -> object:
+        """Count every HTTP round-trip to Garmin Connect."""
+        metrics.count("http_requests")
+        return response
+
+    def seconds_until_refresh(self) -> float:
+        """Return the seconds until the OAuth2 token should be refreshed, 0 if it is due."""
+        token = self.client.oauth2_token
+        expires_at = getattr(token, "expires_at", None)
+        if not expires_at:
+            return 0.0
+        return max(0.0, expires_at - self.refresh_margin - time.time())
+
+    def refresh_if_needed(self) -> None:
+        """Refresh the OAuth2 token if it expires within the refresh margin."""
+        with self.lock:
+            if self.seconds_until_refresh() > 0:
+                return
+            logger.info("Refreshing Garmin OAuth2 token...")
+            with metrics.span("auth"):
+                self.client.refresh_oauth2()
+                self.client.dump(str(self.tokens_path))
+            expires_at = getattr(self.client.oauth2_token, "expires_at", 0)
+            expires = datetime.fromtimestamp(expires_at, tz=get_localzone())
+            msg = f"Garmin OAuth2 token valid until {expires:%Y-%m-%d %H:%M:%S}."
+            logger.info(msg)
+
+    def _refresh_loop(self) -> None:
+        """Refresh the token in the background until the session is closed."""
+        from garth.exc import GarthException  # noqa: PLC0415
+        from requests import RequestException  # noqa: PLC0415
+
+        while not self._stop.wait(self.seconds_until_refresh()):
+            try:
+                self.refresh_if_needed()
+            except (GarthException, RequestException) as e:
+                msg = f"Background token refresh failed, retrying at the next upload: {e}"
+                logger.warning(msg)
+                self._stop.wait(self.refresh_margin / 2)
+
+    def upload(self, fp: BinaryIO) -> dict:
+        """Upload an open .fit file over the pooled connection with a fresh token."""
+        self.refresh_if_needed()
+        with metrics.span("upload"):
+            return self.client.upload(fp)
+
+    def close(self) -> None:
+        """Stop the background token refresh."""
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+
+def http_status(error: Exception) -> int | None:
+    """Return the HTTP status code of a failed garth request, None if there was no response.
+
+    Args:
+        error (Exception): The exception raised by garth, usually a GarthHTTPError.
+
+    Returns:
+        int | None: The status code of the response.
+
+    """
+    response = getattr(getattr(error, "error", None), "response", None)
+    return getattr(response, "status_code", None)
+
+
+def retry_after(error: Exception) -> float:
+    """Return the delay in seconds requested by the Retry-After header of a failed request.
+
+    Args:
+        error (Exception): The exception raised by garth, usually a GarthHTTPError.
+
+    Returns:
+        float: The requested delay, 0 if there is none or it is not given in seconds.
+
+    """
+    response = getattr(getattr(error, "error", None), "response", None)
+    value = getattr(response, "headers", {}).get("Retry-After", "")
+    return float(value) if value.isdigit() else 0.0
+
+
+def upload_with_outcome(session: GarminSession, fp: BinaryIO) -> tuple[str, str, float]:
+    """Upload an open .fit file and classify the outcome instead of raising.
+
+    Args:
+        session (GarminSession): The session to upload with.
+        fp (BinaryIO): The .fit file; its ``name`` is sent as the file name.
+
+    Returns:
+        tuple: The outcome ("uploaded", "duplicate", "retry" or "failed"), the error
+            message and the delay in seconds the server asked for before a retry.
+
+    """
+    import requests  # noqa: PLC0415
+    from garth.exc import GarthException, GarthHTTPError  # noqa: PLC0415
+
+    # a damaged file would only be rejected after the whole upload
+    with metrics.span("verify"):
+        problems = verify_fit_data(fp.read())
+    fp.seek(0)
+    if problems:
+        return "failed", f"Not a valid FIT file: {'; '.join(problems)}.", 0.0
+    try:
+        logger.debug(session.upload(fp))
+    except GarthHTTPError as e:
+        status = http_status(e)
+        if status == HTTP_CONFLICT:
+            return "duplicate", "", 0.0
+        if status is None or status == HTTP_TOO_MANY_REQUESTS or status >= HTTP_SERVER_ERROR:
+            return "retry", str(e), retry_after(e)
+        return "failed", str(e), 0.0
+    except (requests.RequestException, GarthException) as e:
+        return "retry", str(e), 0.0
+    return "uploaded", "", 0.0
+
+
+def upload_backoff(attempts: int, requested: float = 0.0) -> float:
+    """Return the delay before retrying an upload that failed ``attempts`` times.
+
+    Args:
+        attempts (int): The number of failed attempts so far.
+        requested (float): The delay the server asked for, if any.
+
+    Returns:
+        float: The delay in seconds.
+
+    """
+    return max(requested, min(UPLOAD_BACKOFF_MAX, UPLOAD_BACKOFF_BASE * 2 ** (attempts - 1)))
+
+
+def upload_fit_bytes(data: bytes, name: str, session: GarminSession) -> bool:
+    """Upload a cleaned-up .fit file straight from memory, retrying with backoff.
+
+    Args:
+        data (bytes): The cleaned-up FIT file.
+        name (str): The file name reported to Garmin Connect.
+        session (GarminSession): The session to upload with.
+
+    Returns:
+        bool: True if Garmin Connect has the activity now, False if the upload failed.
+
+    """
+    for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+        fp = BytesIO(data)
+        fp.name = name
+        outcome, error, delay = upload_with_outcome(session, fp)
+        if outcome == "uploaded":
+            msg = f"Uploaded < {name} > to Garmin Connect."
+            logger.info(msg)
+            return True
+        if outcome == "duplicate":
+            logger.info("Duplicate activity found on Garmin Connect.")
+            return True
+        if outcome == "failed" or attempt == UPLOAD_MAX_ATTEMPTS:
+            msg = f"Giving up uploading < {name} > after {attempt} attempt(s): {error}"
+            logger.error(msg)
+            return False
+        delay = upload_backoff(attempt, delay)
+        msg = f"Upload of < {name} > failed ({error}), retrying in {delay:.1f}s."
+        logger.warning(msg)
+        time.sleep(delay)
+    return False
@@ -0,0 +1,406 @@
+"""HTTP service that converts and uploads posted FIT files."""
+
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from mywhoosh.backups import BackupArchiver, generate_new_filename, prune_backup_objects, store_backup
+from mywhoosh.fit_profile import DEFAULT_TRANSFORM_PROFILE, FitTransformProfile
+from mywhoosh.fit_reader import repair_fit_data, verify_fit_data
+from mywhoosh.fit_rewriter import cleanup_fit_bytes
+from mywhoosh.garmin import GarminAccount, account_for
+from mywhoosh.run_metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping, Sequence
+
+    from mywhoosh.upload_outbox import UploadOutbox
+
+logger = logging.getLogger(__name__)
+
+# at most this many files wait for a worker, larger uploads are rejected,
+# and the latency metrics cover the most recent files
+SERVER_MAX_QUEUE = 64
+SERVER_MAX_UPLOAD_SIZE = 64 * 1024 * 1024
+SERVER_LATENCY_SAMPLES = 1000
+SERVER_MAX_JOBS = 1000
+
+
+def _ingest_fit_data(
+    data: bytes,
+    name: str,
+    repair: bool,  # noqa: FBT001
+    profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+) -> tuple[bytes, float, dict]:
+    """Verify and clean up a FIT file received by the server, in a worker process.
+
+    Args:
+        data (bytes): The received FIT file.
+        name (str): The name of the file, for messages.
+        repair (bool): Repair a damaged file instead of rejecting it.
+        profile (FitTransformProfile): What to change in the file, defaults to the built-in cleanup.
+
+    Returns:
+        tuple[bytes, float, dict]: The cleaned-up file, the seconds it took
+            and the metrics snapshot of the cleanup.
+
+    Raises:
+        ValueError: If the file is damaged and cannot or may not be repaired.
+
+    """
+    metrics.reset()
+    start = time.perf_counter()
+    with metrics.span("verify"):
+        problems = verify_fit_data(data)
+    if problems:
+        msg = f"< {name} > is damaged: {'; '.join(problems)}."
+        if not repair:
+            raise ValueError(msg + " Send it again with ?repair=1 to cut it at the last complete message.")
+        logger.warning(msg)
+        data = repair_fit_data(data, name)
+    cleaned = cleanup_fit_bytes(data, profile=profile) or b""
+    return cleaned, time.perf_counter() - start, metrics.snapshot()
+
+
+def _percentile(values: Sequence[float], percent: float) -> float | None:
+    """Return the nearest-rank percentile of some values, None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+@dataclass
+class IngestJob:
+    """A FIT file received by the server to be cleaned up, backed up and uploaded."""
+
+    id: str
+    name: str
+    status: str = "cleaning"
+    output_path: Path | None = None
+    error: str | None = None
+
+
+class IngestService:
+    """Clean up FIT files received over HTTP with a pool of warm worker processes.
+
+    A file is either cleaned up while the client waits for the result, or
+    accepted as a job: it is cleaned up in the background, stored in the
+    backup location and queued in the upload outbox of its account. At most
+    ``max_queue`` files wait for a worker, further files are refused with
+    ``queue.Full``. The workers are spawned rather than forked, as the
+    server already runs the outbox, token refresh and request threads when
+    they start, and jobs are stored on a thread of their own, so that
+    storing one never holds up the results of the others. The service keeps
+    the time files waited for a worker and the time the cleanup took for
+    the most recent files, and the status of the most recent ``max_jobs``
+    jobs.
+    """
+
+    def __init__(
+        self,
+        backup_location: Path | None = None,
+        outboxes: Mapping[str, UploadOutbox] | None = None,
+        accounts: Sequence[GarminAccount] = (),
+        *,
+        max_workers: int | None = None,
+        max_queue: int = SERVER_MAX_QUEUE,
+        max_jobs: int = SERVER_MAX_JOBS,
+        archiver: BackupArchiver | None = None,
+        profile: FitTransformProfile = DEFAULT_TRANSFORM_PROFILE,
+    ) -> None:
+        """Start the worker processes."""
+        self.backup_location = backup_location
+        self.profile = profile
+        self.outboxes = outboxes or {}
+        self.accounts = accounts
+        self.max_queue = max_queue
+        self.max_jobs = max_jobs
+        self.archiver = archiver
+        self.workers = max_workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self.store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-store")
+        self.jobs: OrderedDict[str, IngestJob] = OrderedDict()
+        self.queued = 0
+        self.processed = 0
+        self.failed = 0
+        self.latencies: deque[tuple[float, float]] = deque(maxlen=SERVER_LATENCY_SAMPLES)
+        self.lock = threading.Lock()
+
+    def submit(self, data: bytes, name: str, *, repair: bool = False) -> Future:
+        """Queue a FIT file for a worker and return the future of ``_ingest_fit_data``.
+
+        Raises:
+            queue.Full: If ``max_queue`` files are already waiting.
+
+        """
+        with self.lock:
+            if self.queued >= self.max_queue:
+                msg = f"{self.queued} files are already waiting for a worker."
+                raise queue.Full(msg)
+            self.queued += 1
+        submitted = time.perf_counter()
+        future = self.executor.submit(_ingest_fit_data, data, name, repair, self.profile)
+        future.add_done_callback(functools.partial(self._finished, submitted))
+        return future
+
+    def _finished(self, submitted: float, future: Future) -> None:
+        """Update the queue depth and latencies once a worker is done with a file."""
+        elapsed = time.perf_counter() - submitted
+        error = future.exception()
+        with self.lock:
+            self.queued -= 1
+            if error is not None:
+                self.failed += 1
+                return
+            self.processed += 1
+            _, seconds, snapshot = future.result()
+            self.latencies.append((elapsed - seconds, seconds))
+        metrics.merge(snapshot)
+
+    def clean(self, data: bytes, name: str, *, repair: bool = False) -> bytes:
+        """Clean up a FIT file and wait for the result.
+
+        Raises:
+            queue.Full: If ``max_queue`` files are already waiting.
+            ValueError: If the file is damaged and cannot or may not be repaired.
+
+        """
+        cleaned, _, _ = self.submit(data, name, repair=repair).result()
+        return cleaned
+
+    def enqueue(self, data: bytes, name: str, *, repair: bool = False) -> IngestJob:
+        """Accept a FIT file for cleanup, backup and upload in the background and return its job.
+
+        Raises:
+            queue.Full: If ``max_queue`` files are already waiting.
+            ValueError: If the server has no backup location to store files for upload.
+
+        """
+        if self.backup_location is None:
+            msg = "Uploads need a server started with --backup-location."
+            raise ValueError(msg)
+        job = IngestJob(uuid.uuid4().hex, name)
+        future = self.submit(data, name, repair=repair)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        future.add_done_callback(functools.partial(self._store_later, job))
+        return job
+
+    def _store_later(self, job: IngestJob, future: Future) -> None:
+        """Hand a cleaned-up job to the store thread, keeping the executor's result handling free."""
+        self.store_executor.submit(self._store, job, future)
+
+    def _store(self, job: IngestJob, future: Future) -> None:
+        """Store the cleaned-up file of a job as a backup and queue it for upload."""
+        if self.backup_location is None:
+            return
+        new_file_path = self.backup_location / generate_new_filename(Path(job.name))
+        tmp_path = new_file_path.with_name(f".{new_file_path.name}.{job.id}.tmp")
+        try:
+            cleaned, _, _ = future.result()
+            tmp_path.write_bytes(cleaned)
+            with metrics.span("store"):
+                job.output_path = store_backup(tmp_path, new_file_path)
+        except (OSError, ValueError) as e:
+            job.status, job.error = "failed", str(e)
+            msg = f"Failed to process < {job.name} >: {e}."
+            logger.error(msg)  # noqa: TRY400
+            return
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        prune_backup_objects(self.backup_location)
+        if self.archiver is not None:
+            self.archiver.submit(job.output_path)
+        account = account_for(Path(job.name), self.accounts)
+        outbox = self.outboxes.get(account.name if account else "")
+        if outbox is None:
+            job.status = "stored"
+            return
+        try:
+            outbox.enqueue(job.output_path)
+        except sqlite3.Error as e:
+            job.status, job.error = "failed", f"Failed to queue the upload: {e}."
+            msg = f"Failed to queue < {job.output_path.name} > for upload: {e}."
+            logger.error(msg)  # noqa: TRY400
+            return
+        job.status = "queued"
+        msg = f"Queued < {job.output_path.name} > for upload."
+        logger.info(msg)
+
+    def job_status(self, job_id: str) -> dict | None:
+        """Return the status of a job, None if there is no such job."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        status = job.status
+        if status == "queued" and job.output_path is not None:
+            account = account_for(Path(job.name), self.accounts)
+            outbox = self.outboxes[account.name if account else ""]
+            status = outbox.status(job.output_path) or "uploaded"
+        return {
+            "id": job.id,
+            "name": job.name,
+            "status": status,
+            "output": job.output_path.name if job.output_path else None,
+            "error": job.error,
+        }
+
+    def stats(self) -> dict:
+        """Return the queue depth, latencies and pipeline metrics as a JSON-serialisable dict."""
+        with self.lock:
+            waits = [wait_time for wait_time, _ in self.latencies]
+            services = [seconds for _, seconds in self.latencies]
+            totals = [wait_time + seconds for wait_time, seconds in self.latencies]
+            stats: dict[str, Any] = {
+                "workers": self.workers,
+                "queue_depth": self.queued,
+                "max_queue": self.max_queue,
+                "processed": self.processed,
+                "failed": self.failed,
+                "jobs": len(self.jobs),
+            }
+        stats["upload_pending"] = sum(outbox.pending() for outbox in self.outboxes.values())
+        stats["latency"] = {
+            f"{name}_p{percent}": _percentile(values, percent)
+            for name, values in (("wait", waits), ("cleanup", services), ("total", totals))
+            for percent in (50, 95)
+        }
+        return {**stats, **metrics.snapshot()}
+
+    def close(self) -> None:
+        """Stop the worker processes and the store thread once the queued files are done."""
+        self.executor.shutdown()
+        self.store_executor.shutdown()
+
+
+def _received_fit_file(content_type: str, body: bytes, name: str) -> tuple[bytes, str]:
+    """Return the FIT file and its name from a raw or ``multipart/form-data`` request body.
+
+    Raises:
+        ValueError: If a multipart body contains no file.
+
+    """
+    if content_type.startswith("multipart/form-data"):
+        from email import policy  # noqa: PLC0415
+        from email.parser import BytesParser  # noqa: PLC0415
+
+        header = f"Content-Type: {content_type}\r\n\r\n".encode()
+        message = BytesParser(policy=policy.HTTP).parsebytes(header + body)
+        for part in message.walk():
+            filename = part.get_filename()
+            if filename or part.get_param("name", header="content-disposition") == "file":
+                payload = part.get_payload(decode=True)
+                if isinstance(payload, bytes):
+                    return payload, filename or name
+        msg = "The multipart body contains no file."
+        raise ValueError(msg)
+    return body, name
+
+
+def ingest_handler(service: IngestService) -> type:
+    """Return the HTTP request handler class of the server, importing ``http.server`` only in server mode."""
+    from http.server import BaseHTTPRequestHandler  # noqa: PLC0415
+    from urllib.parse import parse_qs, urlsplit  # noqa: PLC0415
+
+    class IngestRequestHandler(BaseHTTPRequestHandler):
+        """Handle ``POST /fit``, ``GET /jobs/<id>`` and ``GET /metrics``.
+
+        ``POST /fit`` takes the FIT file as raw body or ``multipart/form-data``
+        and answers with the cleaned-up file, or with ``?upload=1`` with a
+        job that backs the file up and uploads it to Garmin Connect.
+        """
+
+        server_version = "MyWhoosh2Garmin"
+
+        def do_POST(self) -> None:
+            """Clean up a received FIT file, or accept it as upload job."""
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            if url.path != "/fit":
+                self._send_json(404, {"error": f"Unknown path {url.path}."})
+                return
+            if "Content-Length" not in self.headers:
+                self._send_json(411, {"error": "A Content-Length is required."})
+                return
+            content_length = self.headers["Content-Length"].strip()
+            if not content_length.isdigit():
+                self._send_json(400, {"error": f"Invalid Content-Length {content_length!r}."})
+                return
+            length = int(content_length)
+            if length > SERVER_MAX_UPLOAD_SIZE:
+                self._send_json(413, {"error": f"Files are limited to {SERVER_MAX_UPLOAD_SIZE} bytes."})
+                return
+            body = self.rfile.read(length)
+            requested_name = query.get("name", [self.headers.get("X-Filename", "upload.fit")])[0]
+            repair = query.get("repair", ["0"])[0] not in {"0", "false", ""}
+            upload = query.get("upload", ["0"])[0] not in {"0", "false", ""}
+            try:
+                data, name = _received_fit_file(self.headers.get("Content-Type", ""), body, requested_name)
+                # never let a client pick a path outside the backup location
+                name = Path(name.replace("\\", "/")).name or "upload.fit"
+                if upload:
+                    job = service.enqueue(data, name, repair=repair)
+                    self._send_json(202, {"id": job.id, "status": job.status, "url": f"/jobs/{job.id}"})
+                    return
+                cleaned = service.clean(data, name, repair=repair)
+            except queue.Full as e:
+                self._send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+                return
+            except ValueError as e:
+                self._send_json(422, {"error": str(e)})
+                return
+            self._send(
+                200, cleaned, "application/octet-stream", {"Content-Disposition": f'attachment; filename="{name}"'}
+            )
+
+        def do_GET(self) -> None:
+            """Report the status of a job or the server metrics."""
+            path = urlsplit(self.path).path
+            if path == "/metrics":
+                self._send_json(200, service.stats())
+                return
+            job_id = path.removeprefix("/jobs/")
+            status = service.job_status(job_id) if job_id != path else None
+            if status is None:
+                self._send_json(404, {"error": f"Unknown path {path}."})
+                return
+            self._send_json(200, status)
+
+        def _send_json(self, status: int, content: dict, headers: dict[str, str] | None = None) -> None:
+            """Send a JSON response."""
+            self._send(status, json.dumps(content).encode(), "application/json", headers)
+
+        def _send(self, status: int, body: bytes, content_type: str, headers: dict[str, str] | None = None) -> None:
+            """Send a response with a body."""
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+            """Log requests through the module logger instead of stderr."""
+            msg = f"{self.address_string()} {format % args}"
+            logger.debug(msg)
+
+    return IngestRequestHandler
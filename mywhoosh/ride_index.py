@@ -0,0 +1,303 @@
+"""Index of the lap and session summaries of the backed-up rides."""
+
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import astuple, dataclass, fields
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from tzlocal import get_localzone
+
+from mywhoosh.fit_protocol import (
+    FIT_EPOCH_OFFSET,
+    FIT_FIELD_SUMMARY_START_TIME,
+    FIT_FIELD_SUMMARY_TOTAL_DISTANCE,
+    FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME,
+    FIT_FIELD_TIMESTAMP,
+    FIT_MESG_SESSION,
+    FIT_SUMMARY_FIELDS,
+)
+from mywhoosh.fit_reader import FitReader
+from mywhoosh.run_metrics import metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping, Sequence
+
+logger = logging.getLogger(__name__)
+
+# more new files than this are read into the ride index by a process pool
+RIDE_INDEX_PARALLEL_THRESHOLD = 8
+
+
+@dataclass
+class RideSummary:
+    """Session-level summary of a ride in the backup directory, in SI units (s, m, m/s, W, bpm, rpm)."""
+
+    path: str
+    session: int
+    start_time: int
+    duration: float | None = None
+    distance: float | None = None
+    avg_speed: float | None = None
+    avg_power: float | None = None
+    max_power: float | None = None
+    normalized_power: float | None = None
+    avg_heart_rate: float | None = None
+    max_heart_rate: float | None = None
+    avg_cadence: float | None = None
+
+    @property
+    def started(self) -> datetime:
+        """Return the start time in the local time zone."""
+        return datetime.fromtimestamp(self.start_time, tz=get_localzone())
+
+
+def _scaled(value: int | bytes | None, scale: float = 1) -> float | None:
+    """Return a decoded numeric field divided by its FIT scale, or None if it is missing."""
+    return value / scale if isinstance(value, int) else None
+
+
+def read_ride_summaries(fit_file: Path) -> list[RideSummary]:
+    """Read the session summaries of a FIT file, decoding only its session messages.
+
+    This is a module level function so it can be sent to worker processes.
+
+    Args:
+        fit_file (Path): The FIT file to read.
+
+    Returns:
+        list[RideSummary]: One summary per session message.
+
+    Raises:
+        ValueError: If the file is not a valid FIT file or is truncated.
+
+    """
+    numbers = {name: number for name, (number, _, _) in FIT_SUMMARY_FIELDS[FIT_MESG_SESSION].items()}
+    summaries = []
+    with FitReader(fit_file) as reader:
+        for session, message in enumerate(reader.messages(FIT_MESG_SESSION)):
+            values = message.fields
+            start_time = values.get(FIT_FIELD_SUMMARY_START_TIME) or values.get(FIT_FIELD_TIMESTAMP)
+            summaries.append(
+                RideSummary(
+                    path=str(fit_file),
+                    session=session,
+                    start_time=start_time + FIT_EPOCH_OFFSET if isinstance(start_time, int) else 0,
+                    duration=_scaled(values.get(FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME), 1000),
+                    distance=_scaled(values.get(FIT_FIELD_SUMMARY_TOTAL_DISTANCE), 100),
+                    avg_speed=_scaled(values.get(numbers["avg_speed"]), 1000),
+                    avg_power=_scaled(values.get(numbers["avg_power"])),
+                    max_power=_scaled(values.get(numbers["max_power"])),
+                    normalized_power=_scaled(values.get(numbers["normalized_power"])),
+                    avg_heart_rate=_scaled(values.get(numbers["avg_heart_rate"])),
+                    max_heart_rate=_scaled(values.get(numbers["max_heart_rate"])),
+                    avg_cadence=_scaled(values.get(numbers["avg_cadence"])),
+                )
+            )
+    return summaries
+
+
+class RideIndex:
+    """SQLite index of the session summaries of the rides in a backup directory.
+
+    Every file is read once; later updates only stat the directory and read
+    files that are new or changed, and drop rides whose file was removed.
+    Queries run on indexed columns, so they never touch the FIT files.
+    """
+
+    COLUMNS = tuple(f.name for f in fields(RideSummary))
+
+    def __init__(self, db_file: Path) -> None:
+        """Open the index database, creating its tables if needed."""
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS indexed_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ride_summaries (
+                path TEXT NOT NULL,
+                session INTEGER NOT NULL,
+                start_time INTEGER NOT NULL,
+                duration REAL,
+                distance REAL,
+                avg_speed REAL,
+                avg_power REAL,
+                max_power REAL,
+                normalized_power REAL,
+                avg_heart_rate REAL,
+                max_heart_rate REAL,
+                avg_cadence REAL,
+                PRIMARY KEY (path, session)
+            );
+            CREATE INDEX IF NOT EXISTS ride_summaries_start_time ON ride_summaries (start_time);
+            CREATE INDEX IF NOT EXISTS ride_summaries_avg_power ON ride_summaries (avg_power);
+            """
+        )
+        self.conn.commit()
+
+    def update(self, backup_location: Path, max_workers: int | None = None) -> tuple[int, int]:
+        """Bring the index up to date with the .fit files in a backup directory.
+
+        Args:
+            backup_location (Path): The directory for backup of .fit files.
+            max_workers (int | None): The number of worker processes used to read
+                new files, defaults to the number of cores.
+
+        Returns:
+            tuple[int, int]: The number of files read and the number of files dropped.
+
+        """
+        root = backup_location.resolve()
+        with metrics.span("discovery"):
+            current = {}
+            for entry in os.scandir(root):
+                if entry.name.endswith(".fit") and not entry.name.startswith(".") and entry.is_file():
+                    stat = entry.stat()
+                    current[str(root / entry.name)] = (stat.st_size, stat.st_mtime_ns)
+        indexed = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self.conn.execute("SELECT path, size, mtime_ns FROM indexed_files")
+            if os.path.dirname(path) == str(root)  # noqa: PTH120
+        }
+        removed = [(path,) for path in indexed if path not in current]
+        with self.conn:
+            self.conn.executemany("DELETE FROM indexed_files WHERE path = ?", removed)
+            self.conn.executemany("DELETE FROM ride_summaries WHERE path = ?", removed)
+        read = self.add(self._changed(current, indexed), max_workers=max_workers)
+        msg = f"Indexed {read} new or changed .fit files, dropped {len(removed)} removed ones."
+        logger.info(msg)
+        return read, len(removed)
+
+    def refresh(self, fit_files: Sequence[Path], max_workers: int | None = None) -> int:
+        """Read the session summaries of those .fit files that are new or changed since they were indexed.
+
+        Args:
+            fit_files (Sequence[Path]): The files to index.
+            max_workers (int | None): The number of worker processes used for more
+                than a few files, defaults to the number of cores.
+
+        Returns:
+            int: The number of files read.
+
+        """
+        current = {}
+        for fit_file in fit_files:
+            stat = fit_file.stat()
+            current[str(fit_file.resolve())] = (stat.st_size, stat.st_mtime_ns)
+        indexed = {}
+        for path in current:
+            row = self.conn.execute("SELECT size, mtime_ns FROM indexed_files WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                indexed[path] = tuple(row)
+        return self.add(self._changed(current, indexed), max_workers=max_workers)
+
+    @staticmethod
+    def _changed(current: Mapping[str, tuple[int, int]], indexed: Mapping[str, tuple[int, int]]) -> list[Path]:
+        """Return the files whose size and mtime differ from the indexed ones, or that are not indexed."""
+        return sorted(Path(path) for path, stat in current.items() if indexed.get(path) != stat)
+
+    def add(self, fit_files: Sequence[Path], max_workers: int | None = None) -> int:
+        """Read the session summaries of .fit files into the index, replacing earlier entries.
+
+        Args:
+            fit_files (Sequence[Path]): The files to index.
+            max_workers (int | None): The number of worker processes used for more
+                than a few files, defaults to the number of cores.
+
+        Returns:
+            int: The number of files read.
+
+        """
+        paths = [str(fit_file.resolve()) for fit_file in fit_files]
+        with metrics.span("decode"):
+            if len(paths) > RIDE_INDEX_PARALLEL_THRESHOLD:
+                workers = min(max_workers or os.cpu_count() or 1, len(paths))
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(_try_read_ride_summaries, paths, chunksize=8))
+            else:
+                results = [_try_read_ride_summaries(path) for path in paths]
+
+        summaries: list[RideSummary] = []
+        files = []
+        for path, result in zip(paths, results, strict=True):
+            if isinstance(result, str):
+                msg = f"Cannot index < {Path(path).name} >: {result}"
+                logger.warning(msg)
+            else:
+                summaries.extend(result)
+            stat = Path(path).stat()
+            files.append((path, stat.st_size, stat.st_mtime_ns))
+        placeholders = ", ".join("?" * len(self.COLUMNS))
+        with self.conn:
+            self.conn.executemany("DELETE FROM ride_summaries WHERE path = ?", [(path,) for path in paths])
+            self.conn.executemany(
+                f"INSERT INTO ride_summaries ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",  # noqa: S608
+                [astuple(summary) for summary in summaries],
+            )
+            self.conn.executemany(
+                "INSERT INTO indexed_files (path, size, mtime_ns) VALUES (?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns",
+                files,
+            )
+        return len(files)
+
+    def query(
+        self,
+        root: Path | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        min_avg_power: float | None = None,
+    ) -> list[RideSummary]:
+        """Return the indexed rides matching all given conditions, oldest first.
+
+        Args:
+            root (Path | None): Only rides in this backup directory, as indexed by ``update``.
+            since (datetime | None): Only rides that started at or after this time.
+            until (datetime | None): Only rides that started before this time.
+            min_avg_power (float | None): Only rides with at least this average power in W.
+
+        Returns:
+            list[RideSummary]: The matching rides.
+
+        """
+        conditions = []
+        parameters: list[float | str] = []
+        if root is not None:
+            prefix = os.path.join(root.resolve(), "")  # noqa: PTH118
+            conditions.append("substr(path, 1, length(?)) = ?")
+            parameters.extend((prefix, prefix))
+        if since is not None:
+            conditions.append("start_time >= ?")
+            parameters.append(since.timestamp())
+        if until is not None:
+            conditions.append("start_time < ?")
+            parameters.append(until.timestamp())
+        if min_avg_power is not None:
+            conditions.append("avg_power >= ?")
+            parameters.append(min_avg_power)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        rows = self.conn.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM ride_summaries {where}ORDER BY start_time",  # noqa: S608
+            parameters,
+        )
+        return [RideSummary(*row) for row in rows]
+
+    def close(self) -> None:
+        """Close database connection."""
+        self.conn.close()
+
+
+def _try_read_ride_summaries(path: str) -> list[RideSummary] | str:
+    """Read the session summaries of a file, returning the error message if it cannot be read."""
+    try:
+        return read_ride_summaries(Path(path))
+    except (OSError, ValueError) as e:
+        return str(e)
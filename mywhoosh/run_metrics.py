@@ -0,0 +1,111 @@
+"""Timings and counters of the pipeline stages of a run."""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from tzlocal import get_localzone
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class RunMetrics:
+    """Timings and counters of the pipeline stages of one run.
+
+    Spans accumulate the wall time and number of calls per stage (discovery,
+    decode, transform, encode, write, auth, upload); counters track messages,
+    bytes and HTTP round-trips. All methods are thread-safe, and worker
+    processes send a ``snapshot`` back to be merged into the parent's metrics.
+    """
+
+    def __init__(self) -> None:
+        """Start with empty spans and counters."""
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget all spans and counters and restart the run clocks."""
+        with self._lock:
+            self.spans: dict[str, list[float]] = {}
+            self.counters: dict[str, int] = {}
+            self.started = datetime.now(tz=get_localzone())
+            self._wall_start = time.perf_counter()
+            self._cpu_start = self._cpu_time()
+
+    @staticmethod
+    def _cpu_time() -> float:
+        """Return the CPU time used by this process and its finished worker processes."""
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def add_time(self, name: str, seconds: float, calls: int = 1) -> None:
+        """Add time spent in a stage."""
+        with self._lock:
+            span = self.spans.setdefault(name, [0.0, 0])
+            span[0] += seconds
+            span[1] += calls
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as one call of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Increase a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        """Return the spans and counters as a JSON-serialisable dict."""
+        with self._lock:
+            return {
+                "spans": {
+                    name: {"seconds": seconds, "calls": int(calls)} for name, (seconds, calls) in self.spans.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def merge(self, snapshot: dict) -> None:
+        """Add the spans and counters of a snapshot, e.g. from a worker process."""
+        for name, span in snapshot["spans"].items():
+            self.add_time(name, span["seconds"], span["calls"])
+        for name, value in snapshot["counters"].items():
+            self.count(name, value)
+
+    def report(self) -> dict:
+        """Return the summary of the run: wall and CPU time plus all spans and counters."""
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_time": time.perf_counter() - self._wall_start,
+            "cpu_time": self._cpu_time() - self._cpu_start,
+            **self.snapshot(),
+        }
+
+    def write(self, metrics_file: Path, **context: object) -> dict:
+        """Append the summary of the run as one JSON line to ``metrics_file`` and return it."""
+        report = {**context, **self.report()}
+        try:
+            with metrics_file.open("a") as f:
+                f.write(json.dumps(report) + "\n")
+        except OSError as e:
+            msg = f"Could not write metrics to < {metrics_file} >: {e}"
+            logger.warning(msg)
+        return report
+
+
+metrics = RunMetrics()
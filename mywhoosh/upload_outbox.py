@@ -0,0 +1,405 @@
+"""Ledger of converted files and the outbox that uploads them to Garmin Connect."""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+
+from mywhoosh.garmin import (
+    HTTP_CONFLICT,
+    UPLOAD_MAX_ATTEMPTS,
+    UPLOAD_WORKERS,
+    GarminSession,
+    http_status,
+    upload_backoff,
+    upload_with_outcome,
+)
+from mywhoosh.run_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# the dispatcher checks for new entries this often, and for due retries at least every idle interval
+OUTBOX_POLL_INTERVAL = 1.0
+OUTBOX_IDLE_INTERVAL = 60.0
+
+
+@dataclass
+class LedgerEntry:
+    """A source .fit file known to the ledger."""
+
+    content_hash: str
+    output_path: Path | None
+    uploaded: bool
+
+
+class FitFileLedger:
+    """SQLite ledger of converted and uploaded .fit files.
+
+    Source files are identified by their content hash. A second index on
+    path, size and modification time lets unchanged files be recognised
+    without reading them at all.
+    """
+
+    def __init__(self, db_file: Path) -> None:
+        """Open the ledger database, creating it if needed."""
+        self.conn = sqlite3.connect(db_file)
+        self._hashes: dict[tuple[str, int, int], str] = {}
+        self._create_table()
+
+    def _create_table(self) -> None:
+        """Create database table and indexes if they don't exist."""
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS processed_files (
+                content_hash TEXT PRIMARY KEY,
+                source_path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                output_path TEXT,
+                uploaded INTEGER NOT NULL DEFAULT 0,
+                processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                uploaded_at TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS processed_files_stat
+                ON processed_files (source_path, size, mtime_ns);
+            CREATE INDEX IF NOT EXISTS processed_files_output
+                ON processed_files (output_path);
+            """
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _stat_key(fit_file: Path) -> tuple[str, int, int]:
+        """Return the (path, size, mtime) key of a source file."""
+        stat = fit_file.stat()
+        return str(fit_file.resolve()), stat.st_size, stat.st_mtime_ns
+
+    def content_hash(self, fit_file: Path) -> str:
+        """Return the SHA-256 of a source file, hashing it at most once per run."""
+        key = self._stat_key(fit_file)
+        if key not in self._hashes:
+            with fit_file.open("rb") as f:
+                self._hashes[key] = hashlib.file_digest(f, "sha256").hexdigest()
+        return self._hashes[key]
+
+    def lookup(self, fit_file: Path) -> LedgerEntry | None:
+        """Return the ledger entry of a source file, or None if it was never processed.
+
+        Unchanged files are found by path, size and mtime; only when that misses
+        is the file hashed, so copied or touched files are still recognised.
+        """
+        key = self._stat_key(fit_file)
+        row = self.conn.execute(
+            "SELECT content_hash, output_path, uploaded FROM processed_files "
+            "WHERE source_path = ? AND size = ? AND mtime_ns = ?",
+            key,
+        ).fetchone()
+        if row is None:
+            content_hash = self.content_hash(fit_file)
+            row = self.conn.execute(
+                "SELECT content_hash, output_path, uploaded FROM processed_files WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE processed_files SET source_path = ?, size = ?, mtime_ns = ? WHERE content_hash = ?",
+                (*key, content_hash),
+            )
+            self.conn.commit()
+        return LedgerEntry(row[0], Path(row[1]) if row[1] else None, bool(row[2]))
+
+    def record_processed(self, fit_file: Path, output_path: Path) -> None:
+        """Record that a source file was cleaned up into ``output_path``.
+
+        A source that is cleaned up again, e.g. after its backup was deleted,
+        keeps its upload state: the ride has the same content, so it must not
+        be uploaded a second time. A changed source has a new content hash and
+        starts out as not uploaded.
+        """
+        key = self._stat_key(fit_file)
+        self.conn.execute(
+            "INSERT INTO processed_files (content_hash, source_path, size, mtime_ns, output_path) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (content_hash) DO UPDATE SET source_path = excluded.source_path, "
+            "size = excluded.size, mtime_ns = excluded.mtime_ns, output_path = excluded.output_path, "
+            "processed_at = CURRENT_TIMESTAMP",
+            (self.content_hash(fit_file), *key, str(output_path)),
+        )
+        self.conn.commit()
+
+    def is_uploaded(self, output_path: Path) -> bool:
+        """Check if a cleaned file has already been uploaded."""
+        cursor = self.conn.execute(
+            "SELECT 1 FROM processed_files WHERE output_path = ? AND uploaded = 1",
+            (str(output_path),),
+        )
+        return bool(cursor.fetchone())
+
+    def mark_uploaded(self, output_path: Path) -> None:
+        """Mark a cleaned file as uploaded."""
+        self.conn.execute(
+            "UPDATE processed_files SET uploaded = 1, uploaded_at = CURRENT_TIMESTAMP WHERE output_path = ?",
+            (str(output_path),),
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        """Close database connection."""
+        self.conn.close()
+
+
+def upload_fit_file_to_garmin(
+    new_file_path: Path,
+    ledger: FitFileLedger | None = None,
+    session: GarminSession | None = None,
+) -> None:
+    """Upload a .fit file to Garmin using the Garth client.
+
+    Args:
+        new_file_path (Path): The path to the .fit file to upload.
+        ledger (FitFileLedger | None): If given, the upload is recorded in it.
+        session (GarminSession | None): The session to upload with, the global garth client otherwise.
+
+    Returns:
+        None
+
+    """
+    import garth  # noqa: PLC0415
+    from garth.exc import GarthHTTPError  # noqa: PLC0415
+
+    try:
+        if new_file_path and new_file_path.exists():
+            with new_file_path.open("rb") as f:
+                if session is not None:
+                    uploaded = session.upload(f)
+                else:
+                    with metrics.span("upload"):
+                        uploaded = garth.client.upload(f)
+                logger.debug(uploaded)
+        else:
+            msg = f"Invalid file path: {new_file_path}."
+            logger.info(msg)
+            return
+    except GarthHTTPError as e:
+        if http_status(e) != HTTP_CONFLICT:
+            msg = f"Failed to upload < {new_file_path.name} >."
+            logger.exception(msg)
+            return
+        logger.info("Duplicate activity found on Garmin Connect.")
+    if ledger is not None:
+        ledger.mark_uploaded(new_file_path)
+
+
+class UploadOutbox:
+    """Durable queue of cleaned .fit files waiting to be uploaded to Garmin Connect.
+
+    Queued files are stored in the ``upload_outbox`` table of the ledger
+    database, so uploads interrupted by a crash, a network outage or rate
+    limiting are resumed on the next run. A dispatcher thread drains the
+    queue with a bounded pool of upload workers: rate-limited (429) and
+    server-side (5xx) failures are retried with exponential backoff, a 409
+    means Garmin already has the activity, and a file leaves the outbox in
+    the same transaction in which the ledger marks it uploaded. Every
+    account from the accounts file drains its own share of the queue with its
+    own session; the default account is the empty string.
+    """
+
+    def __init__(self, db_file: Path, session: GarminSession, workers: int = UPLOAD_WORKERS) -> None:
+        """Open the outbox and requeue uploads that were in flight when the last run stopped."""
+        self.db_file = db_file
+        self.session = session
+        self.account = "" if session.account is None else session.account.name
+        self.workers = workers
+        self._wake_up = threading.Event()
+        self._drained = threading.Event()
+        # enqueue() and the dispatcher's drained check must not interleave
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._dispatcher: threading.Thread | None = None
+        FitFileLedger(db_file).close()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS upload_outbox (
+                    output_path TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    account TEXT NOT NULL DEFAULT ''
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(upload_outbox)")}
+            if "account" not in columns:
+                conn.execute("ALTER TABLE upload_outbox ADD COLUMN account TEXT NOT NULL DEFAULT ''")
+            conn.execute(
+                "UPDATE upload_outbox SET status = 'pending' WHERE status = 'uploading' AND account = ?",
+                (self.account,),
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection to the outbox database for the calling thread."""
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def enqueue(self, output_path: Path) -> None:
+        """Queue a cleaned .fit file for upload and wake up the dispatcher."""
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO upload_outbox (output_path, account) VALUES (?, ?) "
+                "ON CONFLICT (output_path) DO UPDATE SET status = 'pending', attempts = 0, next_attempt_at = 0, "
+                "account = excluded.account WHERE status = 'failed'",
+                (str(output_path), self.account),
+            )
+            self._drained.clear()
+        self._wake_up.set()
+
+    def pending(self) -> int:
+        """Return the number of files waiting to be uploaded."""
+        with closing(self._connect()) as conn, conn:
+            (count,) = conn.execute(
+                "SELECT COUNT(*) FROM upload_outbox WHERE status IN ('pending', 'uploading') AND account = ?",
+                (self.account,),
+            ).fetchone()
+        return count
+
+    def start(self) -> None:
+        """Start draining the outbox in a background thread."""
+        if self._dispatcher is None:
+            self._stop.clear()
+            name = f"garmin-upload-outbox-{self.account}" if self.account else "garmin-upload-outbox"
+            self._dispatcher = threading.Thread(target=self._dispatch, name=name, daemon=True)
+            self._dispatcher.start()
+
+    def join(self) -> None:
+        """Wait until every queued file was uploaded or gave up retrying."""
+        while self._dispatcher is not None and self._dispatcher.is_alive():
+            if self._drained.wait(OUTBOX_POLL_INTERVAL):
+                return
+
+    def close(self) -> None:
+        """Stop the dispatcher; uploads still in flight are finished, queued ones stay queued."""
+        self._stop.set()
+        self._wake_up.set()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+            self._dispatcher = None
+
+    def status(self, output_path: Path) -> str | None:
+        """Return the outbox status of a file, None once it has left the outbox."""
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT status FROM upload_outbox WHERE output_path = ?", (str(output_path),)).fetchone()
+        return None if row is None else row[0]
+
+    def _upload(self, output_path: Path) -> tuple[str, str, float]:
+        """Upload one file and classify the outcome as uploaded, duplicate, retry or failed.
+
+        Unexpected errors are retried like transient ones instead of escaping
+        to the dispatcher, which would stop and leave the file 'uploading'.
+        """
+        try:
+            with output_path.open("rb") as f:
+                return upload_with_outcome(self.session, f)
+        except OSError as e:
+            return "failed", str(e), 0.0
+        except Exception as e:
+            msg = f"Unexpected error uploading < {output_path.name} >: {e!r}."
+            logger.exception(msg)
+            return "retry", str(e), 0.0
+
+    def _claim(self, conn: sqlite3.Connection, limit: int) -> list[Path]:
+        """Mark up to ``limit`` due files as uploading and return them."""
+        rows = conn.execute(
+            "SELECT output_path FROM upload_outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+            "AND account = ? ORDER BY enqueued_at LIMIT ?",
+            (time.time(), self.account, limit),
+        ).fetchall()
+        claimed = []
+        with conn:
+            for (output_path,) in rows:
+                cursor = conn.execute(
+                    "UPDATE upload_outbox SET status = 'uploading' WHERE output_path = ? AND status = 'pending'",
+                    (output_path,),
+                )
+                if cursor.rowcount == 1:
+                    claimed.append(Path(output_path))
+        return claimed
+
+    def _complete(self, conn: sqlite3.Connection, output_path: Path, outcome: tuple[str, str, float]) -> None:
+        """Record the outcome of an upload attempt."""
+        status, error, delay = outcome
+        with conn:
+            if status in {"uploaded", "duplicate"}:
+                conn.execute("DELETE FROM upload_outbox WHERE output_path = ?", (str(output_path),))
+                conn.execute(
+                    "UPDATE processed_files SET uploaded = 1, uploaded_at = CURRENT_TIMESTAMP WHERE output_path = ?",
+                    (str(output_path),),
+                )
+                msg = (
+                    f"Duplicate activity < {output_path.name} > found on Garmin Connect."
+                    if status == "duplicate"
+                    else f"Uploaded < {output_path.name} > to Garmin Connect."
+                )
+                logger.info(msg)
+                return
+            (attempts,) = conn.execute(
+                "UPDATE upload_outbox SET attempts = attempts + 1, last_error = ? WHERE output_path = ? "
+                "RETURNING attempts",
+                (error, str(output_path)),
+            ).fetchone()
+            if status == "failed" or attempts >= UPLOAD_MAX_ATTEMPTS:
+                conn.execute("UPDATE upload_outbox SET status = 'failed' WHERE output_path = ?", (str(output_path),))
+                msg = f"Giving up uploading < {output_path.name} > after {attempts} attempt(s): {error}"
+                logger.error(msg)
+                return
+            delay = upload_backoff(attempts, delay)
+            conn.execute(
+                "UPDATE upload_outbox SET status = 'pending', next_attempt_at = ? WHERE output_path = ?",
+                (time.time() + delay, str(output_path)),
+            )
+            msg = f"Upload of < {output_path.name} > failed ({error}), retrying in {delay:.1f}s."
+            logger.warning(msg)
+
+    def _next_due(self, conn: sqlite3.Connection) -> float | None:
+        """Return the seconds until the next queued file is due, None if nothing is queued."""
+        (next_attempt_at,) = conn.execute(
+            "SELECT MIN(next_attempt_at) FROM upload_outbox WHERE status = 'pending' AND account = ?",
+            (self.account,),
+        ).fetchone()
+        return None if next_attempt_at is None else max(0.0, next_attempt_at - time.time())
+
+    def _dispatch(self) -> None:
+        """Keep the upload workers busy until the outbox is closed."""
+        conn = self._connect()
+        in_flight: dict[Future, Path] = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="garmin-upload") as executor:
+                while not self._stop.is_set() or in_flight:
+                    if not self._stop.is_set():
+                        for output_path in self._claim(conn, self.workers - len(in_flight)):
+                            in_flight[executor.submit(self._upload, output_path)] = output_path
+                    with self._lock:
+                        next_due = self._next_due(conn)
+                        if not in_flight and next_due is None:
+                            self._drained.set()
+                    timeout = OUTBOX_IDLE_INTERVAL if next_due is None else next_due
+                    if in_flight:
+                        done, _ = wait(
+                            in_flight, timeout=min(timeout, OUTBOX_POLL_INTERVAL), return_when=FIRST_COMPLETED
+                        )
+                        for future in done:
+                            self._complete(conn, in_flight.pop(future), future.result())
+                    else:
+                        self._wake_up.wait(timeout)
+                        self._wake_up.clear()
+        finally:
+            conn.close()
@@ -2,20 +2,32 @@
 Strava API client for downloading virtual ride activities with 'MyWhoosh' in name.
 
 Handles authentication, session management, and tracks downloaded activities in SQLite.
+Activities are listed page by page and their exports are downloaded concurrently
+by an asyncio based sync engine that respects Strava's rate limits.
 """
 
+import argparse
+import asyncio
+import itertools
 import json
 import os
+import queue
 import sqlite3
+import sys
+import threading
+import time
 import requests
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
 from pathlib import Path
-from typing import List, Optional
+from typing import AsyncIterator, BinaryIO, Callable, List, Optional, Tuple
 from urllib.parse import parse_qs, urlparse
 
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from requests import Session
+from requests.adapters import HTTPAdapter
 
 
 class StravaSettings(BaseSettings):
@@ -28,7 +40,13 @@ class StravaSettings(BaseSettings):
     token_file: str = "strava_tokens.json"
     cookie_file: str = "cookie.json"
     activities_url: str = "https://www.strava.com/api/v3/athlete/activities"
+    export_url: str = "https://www.strava.com/activities/{activity_id}/export_original"
     database_file: str = "strava.db"
+    download_dir: str = "."
+    page_size: int = 200
+    max_concurrency: int = 4
+    max_retries: int = 3
+    request_timeout: float = 30.0
 
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
@@ -58,42 +76,213 @@ class ActivityDetails(BaseModel):
 
 
 class ActivityDatabase:
-    """Database handler for tracking downloaded activities."""
+    """Database handler for tracking downloaded activities.
+
+    Besides the downloaded activities it stores the activities uploaded to
+    Garmin Connect (which are never written to disk), the metadata of every
+    listed MyWhoosh activity and the sync cursor, the start time of the newest
+    activity seen, so a sync only has to ask Strava for newer activities.
+
+    The database runs in WAL mode. All writes are queued to a single writer
+    thread that commits them in batches with ``executemany``, so concurrent
+    download workers never wait for an fsync or for each other; reads use a
+    separate connection and see queued writes through ``flush``. A batch is
+    committed at most ``BATCH_DELAY`` seconds after its first write; if it
+    still cannot be committed after ``WRITE_ATTEMPTS`` tries, ``flush`` and
+    ``close`` raise the error instead of losing the writes silently.
+    """
+
+    MARK_DOWNLOADED = "INSERT OR IGNORE INTO downloaded_activities (activity_id) VALUES (?)"
+    MARK_UPLOADED = "INSERT OR IGNORE INTO uploaded_activities (activity_id) VALUES (?)"
+    SAVE_ACTIVITY = "INSERT OR REPLACE INTO activities (activity_id, name, start_date, type) VALUES (?, ?, ?, ?)"
+    SET_SYNC_STATE = "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)"
+    BATCH_SIZE = 500
+    BATCH_DELAY = 0.05
+    WRITE_ATTEMPTS = 3
     
     def __init__(self, db_file: str):
-        self.conn = sqlite3.connect(db_file)
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
         self._create_table()
+        self._queue: queue.Queue = queue.Queue()
+        # ids queued for one of the MARK_* queries, by query
+        self._pending_ids: dict = {self.MARK_DOWNLOADED: set(), self.MARK_UPLOADED: set()}
+        self._pending_lock = threading.Lock()
+        self._write_error: Optional[sqlite3.Error] = None
+        self._writer = threading.Thread(target=self._write_loop, name="activity-db-writer", daemon=True)
+        self._writer.start()
 
     def _create_table(self):
-        """Create database table if it doesn't exist."""
+        """Create database tables if they don't exist."""
         query = """
         CREATE TABLE IF NOT EXISTS downloaded_activities (
             activity_id INTEGER PRIMARY KEY,
             downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS uploaded_activities (
+            activity_id INTEGER PRIMARY KEY,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS activities (
+            activity_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            start_date TIMESTAMP NOT NULL,
+            type TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
         )
         """
-        self.conn.execute(query)
+        self.conn.executescript(query)
         self.conn.commit()
 
-    def is_downloaded(self, activity_id: int) -> bool:
-        """Check if activity is already downloaded."""
+    def _write_loop(self):
+        """Commit queued writes in batches until the database is closed."""
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.BATCH_DELAY
+            while len(batch) < self.BATCH_SIZE and batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stop = None in batch
+            writes = [item for item in batch if item is not None]
+            try:
+                self._commit(conn, writes)
+            except sqlite3.Error as e:
+                print(f"❌ Database write failed: {e}")
+                self._write_error = e
+            finally:
+                with self._pending_lock:
+                    for query, rows in writes:
+                        if query in self._pending_ids:
+                            self._pending_ids[query].difference_update(row[0] for row in rows)
+                for _ in batch:
+                    self._queue.task_done()
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, writes: List[tuple]):
+        """Commit a batch of writes in one transaction, retrying a few times if that fails."""
+        for attempt in range(1, self.WRITE_ATTEMPTS + 1):
+            try:
+                with conn:
+                    for query, group in itertools.groupby(writes, key=lambda item: item[0]):
+                        conn.executemany(query, [row for _, rows in group for row in rows])
+                return
+            except sqlite3.Error:
+                if attempt == self.WRITE_ATTEMPTS:
+                    raise
+                time.sleep(self.BATCH_DELAY * 2 ** attempt)
+
+    def _raise_write_error(self):
+        """Raise the error of a batch that could not be committed, once."""
+        error, self._write_error = self._write_error, None
+        if error is not None:
+            raise error
+
+    def _write(self, query: str, rows: List[tuple]):
+        """Queue rows to be written by the writer thread."""
+        if rows:
+            self._queue.put((query, rows))
+
+    def flush(self):
+        """Wait until all queued writes are committed.
+
+        Raises the ``sqlite3.Error`` of a batch that could not be committed.
+        """
+        self._queue.join()
+        self._raise_write_error()
+
+    def _filter_not_done(self, activity_ids: List[int], mark_query: str, table: str) -> List[int]:
+        """Return the given activities that are not in ``table`` yet, in one query."""
+        # queued ids are taken first: they only leave the set once they are committed
+        with self._pending_lock:
+            done = set(self._pending_ids[mark_query])
         cursor = self.conn.execute(
-            "SELECT 1 FROM downloaded_activities WHERE activity_id = ?",
-            (activity_id,)
+            f"SELECT activity_id FROM {table} WHERE activity_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(activity_ids),)
         )
-        return bool(cursor.fetchone())
+        done.update(row[0] for row in cursor)
+        return [activity_id for activity_id in activity_ids if activity_id not in done]
+
+    def _mark(self, mark_query: str, activity_ids: List[int]):
+        """Queue activities for one of the MARK_* queries."""
+        with self._pending_lock:
+            self._pending_ids[mark_query].update(activity_ids)
+        self._write(mark_query, [(activity_id,) for activity_id in activity_ids])
+
+    def filter_not_downloaded(self, activity_ids: List[int]) -> List[int]:
+        """Return the given activities that are not downloaded yet, in one query."""
+        return self._filter_not_done(activity_ids, self.MARK_DOWNLOADED, "downloaded_activities")
+
+    def filter_not_uploaded(self, activity_ids: List[int]) -> List[int]:
+        """Return the given activities that are not uploaded to Garmin Connect yet, in one query."""
+        return self._filter_not_done(activity_ids, self.MARK_UPLOADED, "uploaded_activities")
 
     def mark_downloaded(self, activity_id: int):
         """Mark an activity as downloaded."""
-        self.conn.execute(
-            "INSERT OR IGNORE INTO downloaded_activities (activity_id) VALUES (?)",
-            (activity_id,)
+        self.mark_many_downloaded([activity_id])
+
+    def mark_many_downloaded(self, activity_ids: List[int]):
+        """Mark several activities as downloaded in one transaction."""
+        self._mark(self.MARK_DOWNLOADED, activity_ids)
+
+    def mark_uploaded(self, activity_id: int):
+        """Mark an activity as uploaded to Garmin Connect."""
+        self._mark(self.MARK_UPLOADED, [activity_id])
+
+    def save_activities(self, activities: List[ActivityDetails]):
+        """Store the metadata of listed activities."""
+        self._write(
+            self.SAVE_ACTIVITY,
+            [(a.id, a.name, a.start_date.isoformat(), a.type) for a in activities]
         )
-        self.conn.commit()
+
+    def pending_activities(self, uploaded: bool = False) -> List[ActivityDetails]:
+        """Return the stored activities that have not been downloaded (or uploaded) yet."""
+        self.flush()
+        table = "uploaded_activities" if uploaded else "downloaded_activities"
+        cursor = self.conn.execute(
+            "SELECT a.activity_id, a.name, a.start_date, a.type FROM activities a "
+            f"LEFT JOIN {table} d ON d.activity_id = a.activity_id "
+            "WHERE d.activity_id IS NULL ORDER BY a.start_date"
+        )
+        return [
+            ActivityDetails(id=row[0], name=row[1], start_date=row[2], type=row[3])
+            for row in cursor
+        ]
+
+    def get_sync_cursor(self) -> int:
+        """Return the start time (epoch) of the newest activity seen, 0 before the first sync."""
+        self.flush()
+        row = self.conn.execute(
+            "SELECT value FROM sync_state WHERE key = 'activities_after'"
+        ).fetchone()
+        return int(row[0]) if row else 0
+
+    def set_sync_cursor(self, after: int):
+        """Store the start time (epoch) of the newest activity seen."""
+        self._write(self.SET_SYNC_STATE, [("activities_after", str(after))])
 
     def close(self):
-        """Close database connection."""
-        self.conn.close()
+        """Commit queued writes and close the database connections.
+
+        Raises the ``sqlite3.Error`` of a batch that could not be committed.
+        """
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+            self.conn.close()
+            self._raise_write_error()
 
 
 class StravaAuth:
@@ -220,9 +409,65 @@ class CookieManager:
                 self.session.cookies.set(name, value)
 
 
-class ActivityDownloader:
-    """Handles activity file downloads with Chrome-like headers."""
-    
+class RateLimitTracker:
+    """Tracks Strava's 15-minute and daily quotas from the rate limit headers."""
+
+    WINDOW = timedelta(minutes=15)
+
+    def __init__(self):
+        self.limits: Optional[Tuple[int, int]] = None
+        self.usage: Optional[Tuple[int, int]] = None
+
+    @staticmethod
+    def _parse(value: Optional[str]) -> Optional[Tuple[int, int]]:
+        """Parse a "15-minute,daily" header value."""
+        try:
+            short, daily = (int(part) for part in value.split(","))
+        except (AttributeError, ValueError):
+            return None
+        return short, daily
+
+    def update(self, headers) -> None:
+        """Remember the quota reported by a response, preferring the read quota."""
+        for prefix in ("X-ReadRateLimit", "X-RateLimit"):
+            limits = self._parse(headers.get(f"{prefix}-Limit"))
+            usage = self._parse(headers.get(f"{prefix}-Usage"))
+            if limits and usage:
+                self.limits, self.usage = limits, usage
+                return
+
+    def seconds_until_allowed(self, now: Optional[datetime] = None) -> float:
+        """Return how long to wait before the next API request, 0 if it can be sent now."""
+        if not self.limits or not self.usage:
+            return 0.0
+        now = now or datetime.now(timezone.utc)
+        if self.usage[1] >= self.limits[1]:
+            tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            return (tomorrow - now).total_seconds()
+        if self.usage[0] >= self.limits[0]:
+            window_start = now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0)
+            return (window_start + self.WINDOW - now).total_seconds()
+        return 0.0
+
+    async def wait(self) -> None:
+        """Sleep until the quota allows another request."""
+        delay = self.seconds_until_allowed()
+        if delay > 0:
+            print(f"⏳ Strava rate limit reached, waiting {delay / 60:.1f} minutes...")
+            await asyncio.sleep(delay)
+            self.usage = None
+
+
+class StravaSync:
+    """Asynchronous sync engine for MyWhoosh activities.
+
+    Activity pages are listed with the ``after`` cursor while the exports of
+    the activities found so far are already downloading; at most
+    ``max_concurrency`` exports are in flight and each one is streamed to
+    disk. Blocking requests run in worker threads over a shared keep-alive
+    connection pool, while the database is only used from the event loop.
+    """
+
     CHROME_HEADERS = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
                       "AppleWebKit/537.36 (KHTML, like Gecko) "
@@ -239,78 +484,313 @@ class ActivityDownloader:
         "Upgrade-Insecure-Requests": "1"
     }
 
-    def __init__(self, session: Session, database: ActivityDatabase):
-        self.session = session
+    def __init__(self, auth: StravaAuth, database: ActivityDatabase, cookies=None):
+        self.auth = auth
+        self.settings = auth.settings
         self.db = database
+        self.rate_limit = RateLimitTracker()
+        self.download_dir = Path(self.settings.download_dir)
+        adapter = HTTPAdapter(pool_maxsize=self.settings.max_concurrency)
+        self.auth.session.mount("https://", adapter)
+        self.export_session = Session()
+        self.export_session.mount("https://", HTTPAdapter(pool_maxsize=self.settings.max_concurrency))
+        self.export_session.headers.update(self.CHROME_HEADERS)
+        if cookies is not None:
+            self.export_session.cookies.update(cookies)
+        self._refresh_lock = asyncio.Lock()
+
+    async def _refresh_token(self, stale_token: Optional[str]) -> None:
+        """Refresh the access token once, even if several requests failed with 401."""
+        async with self._refresh_lock:
+            if self.auth.token_data and self.auth.token_data.access_token != stale_token:
+                return
+            print("Token expired during sync, refreshing...")
+            await asyncio.to_thread(self.auth.refresh_token)
+
+    async def _get_page(self, after: int, page: int) -> list:
+        """Fetch one page of activities started after the ``after`` epoch timestamp."""
+        for attempt in range(self.settings.max_retries + 1):
+            await self.rate_limit.wait()
+            token = self.auth.token_data.access_token if self.auth.token_data else None
+            try:
+                response = await asyncio.to_thread(
+                    self.auth.session.get,
+                    self.settings.activities_url,
+                    params={"after": after, "page": page, "per_page": self.settings.page_size},
+                    timeout=self.settings.request_timeout,
+                )
+            except requests.RequestException as e:
+                if attempt == self.settings.max_retries:
+                    raise
+                print(f"⚠️ Listing activities failed ({e}), retrying...")
+                await asyncio.sleep(2 ** (attempt + 2))
+                continue
+            self.rate_limit.update(response.headers)
+            if response.status_code == 401 and attempt < self.settings.max_retries:
+                await self._refresh_token(token)
+                continue
+            if response.status_code == 429 and attempt < self.settings.max_retries:
+                if not self.rate_limit.seconds_until_allowed():
+                    await asyncio.sleep(self.rate_limit.WINDOW.total_seconds())
+                continue
+            response.raise_for_status()
+            return response.json()
+        raise RuntimeError("Giving up listing activities after repeated failures")
 
-    def download_activity(self, activity_id: int) -> bool:
-        """Download activity file with retry logic."""
-        try:
-            return self._download_attempt(activity_id)
-        except requests.HTTPError as e:
-            if e.response.status_code == 401:
-                print("Token expired during download, refreshing...")
-                self.session.auth.refresh_token()
-                return self._download_attempt(activity_id)
-            raise
+    async def list_activities(self, after: int = 0) -> AsyncIterator[Tuple[List[ActivityDetails], int]]:
+        """Yield the MyWhoosh virtual rides started after ``after`` page by page, oldest first.
 
-    def _download_attempt(self, activity_id: int) -> bool:
-        """Perform single download attempt for an activity."""
-        if self.db.is_downloaded(activity_id):
-            return False
+        Strava returns activities in ascending order when ``after`` is given, so
+        the start of the last activity of a page is the cursor for the next one.
+        Every page is yielded together with that cursor.
+        """
+        page = 1
+        while True:
+            activities = await self._get_page(after, page)
+            if not activities:
+                return
+            cursor = int(datetime.fromisoformat(activities[-1]["start_date"].replace("Z", "+00:00")).timestamp())
+            yield [
+                ActivityDetails(**activity)
+                for activity in activities
+                if activity.get("type") == "VirtualRide" and "MyWhoosh" in activity.get("name", "")
+            ], max(cursor, after)
+            if len(activities) < self.settings.page_size:
+                return
+            # a page full of activities started in the same second cannot move the cursor
+            if cursor > after:
+                after, page = cursor, 1
+            else:
+                page += 1
 
-        response = self.session.get(
-            f"https://www.strava.com/activities/{activity_id}/export_original",
+    def _stream_export(self, activity_id: int, sink: BinaryIO) -> int:
+        """Stream one export into ``sink``; returns the HTTP status."""
+        with self.export_session.get(
+            self.settings.export_url.format(activity_id=activity_id),
             stream=True,
-            headers=self.CHROME_HEADERS
-        )
-        response.raise_for_status()
-
-        filename = f"activity_{activity_id}_original.fit"
-        with open(filename, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-        self.db.mark_downloaded(activity_id)
-        print(f"✅ Downloaded {filename}")
-        return True
-
-
-class StravaClient:
-    """Main client for interacting with Strava API."""
-    
-    def __init__(self, auth: StravaAuth, downloader: ActivityDownloader):
-        self.auth = auth
-        self.downloader = downloader
-
-    def get_filtered_activities(self) -> List[ActivityDetails]:
-        """Retrieve filtered list of activities."""
-        self.auth.authenticate()
-
+            timeout=self.settings.request_timeout,
+        ) as response:
+            if response.status_code != 200:
+                return response.status_code
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                sink.write(chunk)
+        return 200
+
+    def _export_to_file(self, activity_id: int) -> Tuple[int, Path]:
+        """Stream one export to disk; returns the HTTP status and the file."""
+        filename = self.download_dir / f"activity_{activity_id}_original.fit"
+        partial = filename.with_suffix(".fit.part")
         try:
-            response = self.auth.session.get(
-                self.auth.settings.activities_url,
-                params={"per_page": 100}
-            )
-            response.raise_for_status()
-
-        except requests.HTTPError as e:
-            if e.response.status_code == 401:
-                print("Token expired during request, refreshing...")
-                self.auth.refresh_token()
-                return self.get_filtered_activities()
+            with open(partial, "wb") as f:
+                status = self._stream_export(activity_id, f)
+        except requests.RequestException:
+            partial.unlink(missing_ok=True)
             raise
-
-        return [
-            ActivityDetails(**activity)
-            for activity in response.json()
-            if activity.get("type") == "VirtualRide"
-            and "MyWhoosh" in activity.get("name", "")
+        if status == 200:
+            partial.replace(filename)
+        else:
+            partial.unlink(missing_ok=True)
+        return status, filename
+
+    def _export_to_memory(self, activity_id: int) -> Tuple[int, bytes]:
+        """Download one export into memory; returns the HTTP status and the data."""
+        buffer = BytesIO()
+        status = self._stream_export(activity_id, buffer)
+        return status, buffer.getvalue()
+
+    async def _fetch(self, activity: ActivityDetails, semaphore: asyncio.Semaphore, export: Callable):
+        """Run an export of one activity, retrying when Strava throttles or the connection fails.
+
+        Returns the result of the export, or None if it failed.
+        """
+        for attempt in range(self.settings.max_retries + 1):
+            try:
+                async with semaphore:
+                    status, result = await asyncio.to_thread(export, activity.id)
+            except requests.RequestException as e:
+                status, error = None, str(e)
+            else:
+                error = f"HTTP {status}"
+            if status == 200:
+                return result
+            if status in (None, 429, 500, 502, 503, 504) and attempt < self.settings.max_retries:
+                await asyncio.sleep(2 ** (attempt + 2))
+                continue
+            print(f"❌ Export of activity {activity.id} failed: {error}")
+            return None
+        return None
+
+    async def download(self, activity: ActivityDetails, semaphore: asyncio.Semaphore) -> Optional[Path]:
+        """Download the export of one activity to the download directory."""
+        filename = await self._fetch(activity, semaphore, self._export_to_file)
+        if filename is not None:
+            self.db.mark_downloaded(activity.id)
+            print(f"✅ Downloaded {filename}")
+        return filename
+
+    async def export_bytes(self, activity: ActivityDetails, semaphore: asyncio.Semaphore) -> Optional[bytes]:
+        """Download the export of one activity into memory."""
+        return await self._fetch(activity, semaphore, self._export_to_memory)
+
+    async def new_activities(
+        self, after: Optional[int] = None, uploaded: bool = False
+    ) -> AsyncIterator[ActivityDetails]:
+        """Yield every activity that still has to be downloaded, or uploaded with ``uploaded``.
+
+        Only activities newer than ``after`` are listed, by default newer than
+        the sync cursor stored in the database; listed activities whose
+        download (or upload) failed before are yielded first from the stored
+        metadata. The number of listed activities that were already handled
+        is kept in ``existing``.
+        """
+        if after is None:
+            after = self.db.get_sync_cursor()
+        self.existing = 0
+        started = set()
+        pending = self.db.pending_activities(uploaded)
+        filter_new = self.db.filter_not_uploaded if uploaded else self.db.filter_not_downloaded
+        async for activities, cursor in self._with_pending(pending, after):
+            self.db.save_activities(activities)
+            new_ids = set(filter_new([a.id for a in activities]))
+            self.existing += len(activities) - len(new_ids)
+            for activity in activities:
+                if activity.id not in new_ids or activity.id in started:
+                    continue
+                started.add(activity.id)
+                date_str = activity.start_date.strftime("%Y-%m-%d %H:%M")
+                print(f"📅 {date_str} - {activity.name} (ID: {activity.id})")
+                yield activity
+            if cursor is not None:
+                self.db.set_sync_cursor(cursor)
+
+    async def _with_pending(self, pending: List[ActivityDetails], after: int):
+        """Yield the stored pending activities as a first page, then the listed pages."""
+        if pending:
+            yield pending, None
+        async for activities, cursor in self.list_activities(after):
+            yield activities, cursor
+
+    async def sync(self, after: Optional[int] = None) -> Tuple[int, int, int]:
+        """Download all new activities.
+
+        Returns the number of new downloads, failed downloads and
+        activities that had already been downloaded.
+        """
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        semaphore = asyncio.Semaphore(self.settings.max_concurrency)
+        downloads = [
+            asyncio.create_task(self.download(activity, semaphore))
+            async for activity in self.new_activities(after)
         ]
+        results = await asyncio.gather(*downloads)
+        downloaded = sum(1 for result in results if result is not None)
+        return downloaded, len(results) - downloaded, self.existing
+
+
+def import_mywhoosh():
+    """Import the library of myWhoosh2Garmin (the mywhoosh package) from the parent directory."""
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import mywhoosh.fit_rewriter
+    import mywhoosh.garmin
+
+    return mywhoosh
+
+
+class GarminPipeline:
+    """Streams new Strava exports through the FIT cleanup straight to Garmin Connect.
+
+    Download, cleanup and upload are concurrent stages connected by a
+    bounded queue, so one ride is uploading while the next ones are still
+    downloading or being cleaned up. Exports never touch the disk: they are
+    downloaded into memory, cleaned up by ``cleanup_fit_bytes`` in worker
+    processes and uploaded from memory. An activity is only marked as
+    uploaded (separately from downloaded ones) once Garmin Connect accepted
+    it or already had it, so failed ones are picked up again by the next run.
+    """
+
+    def __init__(self, sync: StravaSync, garmin_session, converter_workers: Optional[int] = None):
+        self.sync = sync
+        self.db = sync.db
+        self.settings = sync.settings
+        self.garmin = garmin_session
+        self.converter_workers = converter_workers
+        self.mywhoosh = import_mywhoosh()
+
+    async def _convert(self, pool, activity: ActivityDetails, data: bytes) -> Optional[bytes]:
+        """Clean up one export in a worker process; returns None if that failed for any reason."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(pool, self.mywhoosh.fit_rewriter.cleanup_fit_bytes, data)
+        except Exception as e:
+            print(f"❌ Could not clean up activity {activity.id}: {e!r}")
+            return None
+
+    async def _upload(self, activity: ActivityDetails, data: bytes) -> bool:
+        """Upload one cleaned export, retrying with backoff when Garmin Connect throttles."""
+        for attempt in range(1, self.mywhoosh.garmin.UPLOAD_MAX_ATTEMPTS + 1):
+            fp = BytesIO(data)
+            fp.name = f"activity_{activity.id}.fit"
+            outcome, error, delay = await asyncio.to_thread(self.mywhoosh.garmin.upload_with_outcome, self.garmin, fp)
+            if outcome in ("uploaded", "duplicate"):
+                self.db.mark_uploaded(activity.id)
+                verb = "Uploaded" if outcome == "uploaded" else "Already on Garmin Connect:"
+                print(f"✅ {verb} {activity.name} (ID: {activity.id})")
+                return True
+            if outcome == "failed" or attempt == self.mywhoosh.garmin.UPLOAD_MAX_ATTEMPTS:
+                print(f"❌ Upload of activity {activity.id} failed: {error}")
+                return False
+            await asyncio.sleep(self.mywhoosh.garmin.upload_backoff(attempt, delay))
+        return False
+
+    async def _upload_worker(self, converted: asyncio.Queue, results: List[bool]):
+        """Upload cleaned exports from the queue until cancelled."""
+        while True:
+            activity, data = await converted.get()
+            try:
+                results.append(await self._upload(activity, data))
+            finally:
+                converted.task_done()
+
+    async def run(self, after: Optional[int] = None) -> Tuple[int, int, int]:
+        """Download, clean up and upload all new activities.
+
+        Returns the number of uploaded activities, failed activities and
+        activities that had already been handled.
+        """
+        semaphore = asyncio.Semaphore(self.settings.max_concurrency)
+        converted: asyncio.Queue = asyncio.Queue(maxsize=self.settings.max_concurrency * 2)
+        results: List[bool] = []
+
+        with ProcessPoolExecutor(max_workers=self.converter_workers) as pool:
+
+            async def process(activity: ActivityDetails):
+                data = await self.sync.export_bytes(activity, semaphore)
+                cleaned = await self._convert(pool, activity, data) if data is not None else None
+                if cleaned is None:
+                    results.append(False)
+                    return
+                await converted.put((activity, cleaned))
+
+            uploaders = [
+                asyncio.create_task(self._upload_worker(converted, results))
+                for _ in range(self.mywhoosh.garmin.UPLOAD_WORKERS)
+            ]
+            stages = [
+                asyncio.create_task(process(activity))
+                async for activity in self.sync.new_activities(after, uploaded=True)
+            ]
+            await asyncio.gather(*stages)
+            await converted.join()
+            for uploader in uploaders:
+                uploader.cancel()
+            await asyncio.gather(*uploaders, return_exceptions=True)
+
+        uploaded = sum(results)
+        return uploaded, len(results) - uploaded, self.sync.existing
 
 
 class StravaClientBuilder:
-    """Builder pattern implementation for StravaClient."""
+    """Sets up the settings, authentication, cookies and database of a sync."""
     
     def __init__(self):
         self.settings = StravaSettings()
@@ -328,52 +808,53 @@ class StravaClientBuilder:
         self.cookie_manager.load_cookies()
         return self
 
-    def build(self) -> StravaClient:
-        """Build configured StravaClient instance."""
-        downloader = ActivityDownloader(
-            self.auth.session,
-            self.database
-        )
-        return StravaClient(self.auth, downloader)
-
     def __del__(self):
         """Cleanup resources on deletion."""
         self.database.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download MyWhoosh rides from Strava.")
+    parser.add_argument(
+        "--garmin",
+        action="store_true",
+        help="clean up the exports in memory and upload them to Garmin Connect instead of saving them",
+    )
+    cli_args = parser.parse_args()
+
     client_builder = None
+    garmin_session = None
     try:
         client_builder = StravaClientBuilder()
-        client = client_builder.with_auth().with_cookies().build()
-
-        all_activities = client.get_filtered_activities()
-        new_activities = [
-            a for a in all_activities
-            if not client.downloader.db.is_downloaded(a.id)
-        ]
-
-        if not new_activities:
-            print("No new activities found")
-            exit()
+        client_builder.with_auth().with_cookies()
+        sync = StravaSync(
+            client_builder.auth,
+            client_builder.database,
+            client_builder.cookie_manager.session.cookies,
+        )
 
         print("\n🏆 New Virtual Rides with 'MyWhoosh' in name:")
-        for activity in new_activities:
-            date_str = activity.start_date.strftime("%Y-%m-%d %H:%M")
-            print(f"📅 {date_str} - {activity.name} (ID: {activity.id})")
-
-        new_downloads = 0
-        for activity in new_activities:
-            if client.downloader.download_activity(activity.id):
-                new_downloads += 1
+        if cli_args.garmin:
+            mywhoosh = import_mywhoosh()
+            garmin_session = mywhoosh.garmin.GarminSession({})
+            garmin_session.connect()
+            new_downloads, failed, existing = asyncio.run(GarminPipeline(sync, garmin_session).run())
+        else:
+            new_downloads, failed, existing = asyncio.run(sync.sync())
+
+        if not new_downloads and not failed:
+            print("No new activities found")
 
         print("\nDownload summary:")
-        print(f"• New activities downloaded: {new_downloads}")
-        print(f"• Already existed: {len(all_activities) - len(new_activities)}")
-        print(f"• Total processed: {len(all_activities)}")
+        print(f"• New activities {'uploaded' if cli_args.garmin else 'downloaded'}: {new_downloads}")
+        print(f"• Failed: {failed}")
+        print(f"• Already existed: {existing}")
+        print(f"• Total processed: {new_downloads + failed + existing}")
 
     except Exception as e:
         print(f"❌ Error: {str(e)}")
     finally:
+        if garmin_session:
+            garmin_session.close()
         if client_builder:
             client_builder.database.close()
@@ -0,0 +1 @@
+"""Tests of myWhoosh2Garmin and the mywhoosh package."""
@@ -0,0 +1,24 @@
+"""Shared fixtures: synthetic MyWhoosh rides as FIT data."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pytest
+
+from tests.fit_data import build_ride
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+
+@pytest.fixture
+def make_ride() -> Callable[..., bytes]:
+    """Return the builder of synthetic rides."""
+    return build_ride
+
+
+@pytest.fixture
+def ride() -> bytes:
+    """Return a two-minute synthetic ride with two laps."""
+    return build_ride()
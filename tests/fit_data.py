@@ -0,0 +1,107 @@
+"""Synthetic MyWhoosh rides as FIT data."""
+
+from __future__ import annotations
+
+import struct
+
+from mywhoosh.fit_protocol import (
+    FIT_DEFINITION_MASK,
+    FIT_HEADER_SIZE,
+    FIT_MESG_FILE_ID,
+    FIT_MESG_LAP,
+    FIT_MESG_RECORD,
+    FIT_MESG_SESSION,
+    FIT_SIGNATURE,
+    fit_crc16,
+)
+
+# 2024-11-21 09:00:00 UTC in seconds since the FIT epoch
+RIDE_START = 1101286800
+RIDE_POWERS = (150, 250)
+RIDE_HEART_RATE = 140
+RIDE_CADENCE = 90
+RIDE_SPEED = 10000
+RIDE_TEMPERATURE = 21
+
+# (field number, size, base type, struct format) per message
+FILE_ID_FIELDS = [(0, 1, 0x00, "B"), (1, 2, 0x84, "H"), (2, 2, 0x84, "H"), (4, 4, 0x86, "I")]
+RECORD_FIELDS = [
+    (253, 4, 0x86, "I"),  # timestamp
+    (5, 4, 0x86, "I"),  # distance, 1/100 m
+    (6, 2, 0x84, "H"),  # speed, 1/1000 m/s
+    (7, 2, 0x84, "H"),  # power
+    (3, 1, 0x02, "B"),  # heart rate
+    (4, 1, 0x02, "B"),  # cadence
+    (13, 1, 0x01, "b"),  # temperature
+]
+# MyWhoosh writes laps and sessions without any averages
+SUMMARY_FIELDS = [
+    (253, 4, 0x86, "I"),  # timestamp
+    (2, 4, 0x86, "I"),  # start time
+    (7, 4, 0x86, "I"),  # total elapsed time, 1/1000 s
+    (8, 4, 0x86, "I"),  # total timer time, 1/1000 s
+    (9, 4, 0x86, "I"),  # total distance, 1/100 m
+]
+
+
+def _definition(local_id: int, global_id: int, fields: list[tuple[int, int, int, str]]) -> tuple[bytes, struct.Struct]:
+    """Return a little-endian definition message and the struct packing its data messages."""
+    content = b"".join(struct.pack("<BBB", number, size, base_type) for number, size, base_type, _ in fields)
+    header = struct.pack("<BBBHB", FIT_DEFINITION_MASK | local_id, 0, 0, global_id, len(fields))
+    return header + content, struct.Struct("<B" + "".join(fmt for *_, fmt in fields))
+
+
+def build_ride(
+    seconds: int = 120, lap_length: int = 60, *, powers: tuple[int, ...] = RIDE_POWERS, session: bool = True
+) -> bytes:
+    """Return a synthetic MyWhoosh ride with one record per second.
+
+    The power cycles through ``powers``, all other channels are constant.
+
+    Args:
+        seconds (int): Duration of the ride.
+        lap_length (int): Duration of a lap in seconds.
+        powers (tuple[int, ...]): The power of consecutive records.
+        session (bool): Whether to close the ride with a session message, like a finished recording.
+
+    Returns:
+        bytes: The FIT file.
+
+    """
+    chunks = []
+    packers = {}
+    for local_id, global_id, fields in [
+        (0, FIT_MESG_FILE_ID, FILE_ID_FIELDS),
+        (1, FIT_MESG_RECORD, RECORD_FIELDS),
+        (2, FIT_MESG_LAP, SUMMARY_FIELDS),
+        (3, FIT_MESG_SESSION, SUMMARY_FIELDS),
+    ]:
+        definition, packers[global_id] = _definition(local_id, global_id, fields)
+        chunks.append(definition)
+        if global_id == FIT_MESG_FILE_ID:
+            chunks.append(packers[global_id].pack(local_id, 4, 255, 0, RIDE_START))
+
+    distance = 0
+    lap_start = 0
+    for second in range(seconds):
+        distance += RIDE_SPEED // 10
+        power = powers[second % len(powers)]
+        chunks.append(
+            packers[FIT_MESG_RECORD].pack(
+                1, RIDE_START + second, distance, RIDE_SPEED, power, RIDE_HEART_RATE, RIDE_CADENCE, RIDE_TEMPERATURE
+            )
+        )
+        if (second + 1) % lap_length == 0 or second == seconds - 1:
+            elapsed = (second + 1 - lap_start) * 1000
+            lap = packers[FIT_MESG_LAP]
+            chunks.append(lap.pack(2, RIDE_START + second, RIDE_START + lap_start, elapsed, elapsed, distance))
+            lap_start = second + 1
+    if session:
+        total = seconds * 1000
+        chunks.append(packers[FIT_MESG_SESSION].pack(3, RIDE_START + seconds, RIDE_START, total, total, distance))
+
+    records = b"".join(chunks)
+    header = struct.pack("<BBHI4s", FIT_HEADER_SIZE, 0x20, 2132, len(records), FIT_SIGNATURE)
+    header += struct.pack("<H", fit_crc16(header))
+    body = header + records
+    return body + struct.pack("<H", fit_crc16(body))
@@ -0,0 +1,27 @@
+"""Tests of the command line arguments."""
+
+from __future__ import annotations
+
+import sys
+
+import pytest
+
+import myWhoosh2Garmin as mw2g  # noqa: N813
+
+
+@pytest.mark.parametrize("option", [["--watch"], ["--all"], ["--since", "2024-11-21"], ["--index"]])
+def test_modes_writing_backups_require_a_backup_location(
+    option: list[str], monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    monkeypatch.setattr(sys, "argv", ["myWhoosh2Garmin.py", *option])
+    with pytest.raises(SystemExit) as exit_info:
+        mw2g.parse_arguments()
+    assert exit_info.value.code == 2
+    assert f"{option[0]} requires --backup-location" in capsys.readouterr().err
+
+
+def test_backup_location_is_passed_on(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(sys, "argv", ["myWhoosh2Garmin.py", "--watch", "--backup-location", "backups"])
+    args = mw2g.parse_arguments()
+    assert args["watch"]
+    assert args["backup_location"] == "backups"
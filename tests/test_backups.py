@@ -0,0 +1,122 @@
+"""Tests of the backups of cleaned-up FIT files and the ledger that skips processed ones."""
+
+from __future__ import annotations
+
+import gzip
+from contextlib import closing
+from pathlib import Path
+
+import pytest
+
+from mywhoosh import fit_files
+from mywhoosh.backups import (
+    BACKUP_OBJECTS_DIR,
+    archive_backup,
+    cleanup_and_save_fit_file,
+    prune_backup_objects,
+    store_backup,
+)
+from mywhoosh.fit_reader import verify_fit_file
+from mywhoosh.fit_rewriter import cleanup_fit_bytes
+from mywhoosh.upload_outbox import FitFileLedger
+
+
+@pytest.fixture(autouse=True)
+def scratch_index(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Keep the FIT file index of the tests out of the script directory."""
+    monkeypatch.setattr(fit_files, "fit_file_index", lambda: fit_files.FitFileIndex(tmp_path / "index.json"))
+
+
+def stored(backup_dir: Path, name: str, content: bytes) -> Path:
+    """Store a backup with the given content under a preferred name."""
+    tmp_path = backup_dir / f".{name}.tmp"
+    tmp_path.write_bytes(content)
+    return store_backup(tmp_path, backup_dir / name)
+
+
+def test_backups_with_the_same_name_get_numbered(tmp_path: Path) -> None:
+    first = stored(tmp_path, "ride_2024-11-21_090000.fit", b"first ride")
+    second = stored(tmp_path, "ride_2024-11-21_090000.fit", b"second ride")
+    third = stored(tmp_path, "ride_2024-11-21_090000.fit", b"third ride")
+    assert [first.name, second.name, third.name] == [
+        "ride_2024-11-21_090000.fit",
+        "ride_2024-11-21_090000_2.fit",
+        "ride_2024-11-21_090000_3.fit",
+    ]
+    assert [path.read_bytes() for path in (first, second, third)] == [b"first ride", b"second ride", b"third ride"]
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_backups_with_the_same_content_share_one_file(tmp_path: Path) -> None:
+    first = stored(tmp_path, "a.fit", b"same ride")
+    second = stored(tmp_path, "b.fit", b"same ride")
+    assert first.samefile(second)
+    assert len(list((tmp_path / BACKUP_OBJECTS_DIR).iterdir())) == 1
+
+
+def test_pruning_frees_the_content_of_deleted_backups(tmp_path: Path) -> None:
+    first = stored(tmp_path, "a.fit", b"same ride")
+    second = stored(tmp_path, "b.fit", b"same ride")
+    other = stored(tmp_path, "c.fit", b"other ride")
+    first.unlink()
+    other.unlink()
+    assert prune_backup_objects(tmp_path) == 1
+    # the content of b.fit is still linked
+    assert [path.read_bytes() for path in (tmp_path / BACKUP_OBJECTS_DIR).iterdir()] == [b"same ride"]
+    second.unlink()
+    assert prune_backup_objects(tmp_path) == 1
+    assert not list((tmp_path / BACKUP_OBJECTS_DIR).iterdir())
+
+
+def test_archive_backup(tmp_path: Path) -> None:
+    backup = stored(tmp_path, "ride.fit", b"ride")
+    archived = archive_backup(backup, "gzip")
+    assert archived == tmp_path / "archive" / "ride.fit.gz"
+    assert gzip.decompress(archived.read_bytes()) == b"ride"
+
+
+def test_cleanup_and_save_the_most_recent_fit_file(ride: bytes, tmp_path: Path) -> None:
+    fit_dir = tmp_path / "MyWhoosh"
+    backup_dir = tmp_path / "backup"
+    fit_dir.mkdir()
+    backup_dir.mkdir()
+    (fit_dir / "MyNewActivity-3.8.4.fit").write_bytes(b"an older ride")
+    (fit_dir / "MyNewActivity-3.8.10.fit").write_bytes(ride)
+    with closing(FitFileLedger(tmp_path / "ledger.db")) as ledger:
+        saved = cleanup_and_save_fit_file(fit_dir, backup_dir, ledger=ledger)
+        assert saved.name.startswith("MyNewActivity-3.8.10_")
+        assert saved.read_bytes() == cleanup_fit_bytes(ride)
+        assert verify_fit_file(saved) == []
+        # the ledger knows the file was cleaned up already
+        assert cleanup_and_save_fit_file(fit_dir, backup_dir, ledger=ledger) == saved
+    assert len(list(backup_dir.glob("*.fit"))) == 1
+
+
+def test_cleaning_up_again_keeps_the_upload_state(ride: bytes, tmp_path: Path) -> None:
+    fit_file = tmp_path / "MyNewActivity-3.8.5.fit"
+    fit_file.write_bytes(ride)
+    backup_dir = tmp_path / "backup"
+    backup_dir.mkdir()
+    with closing(FitFileLedger(tmp_path / "ledger.db")) as ledger:
+        saved = cleanup_and_save_fit_file(fit_file, backup_dir, ledger=ledger)
+        ledger.mark_uploaded(saved)
+        # the backup is deleted, so the ride is cleaned up again
+        saved.unlink()
+        saved_again = cleanup_and_save_fit_file(fit_file, backup_dir, ledger=ledger)
+        assert saved_again.exists()
+        assert ledger.is_uploaded(saved_again)
+        # a changed ride is a new one
+        fit_file.write_bytes(cleanup_fit_bytes(ride) or b"")
+        changed = cleanup_and_save_fit_file(fit_file, backup_dir, ledger=ledger)
+        assert not ledger.is_uploaded(changed)
+
+
+def test_cleanup_and_save_rejects_damaged_files_unless_repaired(ride: bytes, tmp_path: Path) -> None:
+    fit_file = tmp_path / "MyNewActivity-3.8.5.fit"
+    fit_file.write_bytes(ride[:-100])
+    backup_dir = tmp_path / "backup"
+    backup_dir.mkdir()
+    assert cleanup_and_save_fit_file(fit_file, backup_dir) == Path()
+    assert not list(backup_dir.glob("*.fit"))
+    repaired = cleanup_and_save_fit_file(fit_file, backup_dir, repair=True)
+    assert verify_fit_file(repaired) == []
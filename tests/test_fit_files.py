@@ -0,0 +1,69 @@
+"""Tests of the discovery of the MyWhoosh FIT files."""
+
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING
+
+from mywhoosh.fit_files import FitFileIndex, fit_file_version
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_fit_file_version() -> None:
+    assert fit_file_version("MyNewActivity-3.8.5.fit") == (3, 8, 5)
+    assert fit_file_version("MyNewActivity-3.10.0.fit") > fit_file_version("MyNewActivity-3.9.9.fit")
+
+
+def test_index_finds_the_highest_version(tmp_path: Path) -> None:
+    for version in ("3.8.5", "3.10.0", "3.9.9"):
+        (tmp_path / f"MyNewActivity-{version}.fit").touch()
+    (tmp_path / "notes.txt").touch()
+    index = FitFileIndex(tmp_path / "index.json")
+    assert index.most_recent(tmp_path) == tmp_path / "MyNewActivity-3.10.0.fit"
+
+
+def test_index_of_an_empty_directory(tmp_path: Path) -> None:
+    assert FitFileIndex(tmp_path / "index.json").most_recent(tmp_path).name == ""
+
+
+def test_index_is_saved_and_reloaded(tmp_path: Path) -> None:
+    fit_dir = tmp_path / "MyWhoosh"
+    fit_dir.mkdir()
+    (fit_dir / "MyNewActivity-3.8.5.fit").touch()
+    index = FitFileIndex(tmp_path / "index.json")
+    index.data_dir = fit_dir
+    index.files(fit_dir)
+    index.save()
+    reloaded = FitFileIndex(tmp_path / "index.json")
+    assert reloaded.data_dir == fit_dir
+    assert list(reloaded.files(fit_dir)) == ["MyNewActivity-3.8.5.fit"]
+
+
+def test_index_sees_files_overwritten_in_place(tmp_path: Path) -> None:
+    # both have the same version, so the newer one is the most recent
+    old, new = tmp_path / "MyNewActivity-3.8.5.fit", tmp_path / "MyNewActivity-3.8.5a.fit"
+    old.touch()
+    new.touch()
+    # an unchanged directory is not listed again
+    directory_mtime = tmp_path.stat().st_mtime_ns - 10**10
+    os.utime(tmp_path, ns=(directory_mtime, directory_mtime))
+    os.utime(old, ns=(10**18, 10**18))
+    os.utime(new, ns=(2 * 10**18, 2 * 10**18))
+    index = FitFileIndex(tmp_path / "index.json")
+    assert index.most_recent(tmp_path) == new
+    # rewriting a file in place leaves the directory mtime alone
+    os.utime(old, ns=(3 * 10**18, 3 * 10**18))
+    assert tmp_path.stat().st_mtime_ns == directory_mtime
+    assert index.files(tmp_path)[old.name][1] == 3 * 10**18
+    assert index.most_recent(tmp_path) == old
+
+
+def test_index_sees_removed_files(tmp_path: Path) -> None:
+    fit_file = tmp_path / "MyNewActivity-3.8.5.fit"
+    fit_file.touch()
+    index = FitFileIndex(tmp_path / "index.json")
+    assert index.most_recent(tmp_path) == fit_file
+    fit_file.unlink()
+    assert index.most_recent(tmp_path).name == ""
@@ -0,0 +1,25 @@
+"""Tests of the FIT CRC and field helpers."""
+
+from __future__ import annotations
+
+from mywhoosh.fit_protocol import calculate_avg, fit_crc16
+
+
+def test_fit_crc16_check_value() -> None:
+    # the FIT CRC is CRC-16/ARC, whose check value is the CRC of "123456789"
+    assert fit_crc16(b"123456789") == 0xBB3D
+
+
+def test_fit_crc16_continues_from_previous_crc() -> None:
+    data = bytes(range(256)) * 3
+    assert fit_crc16(data[100:], fit_crc16(data[:100])) == fit_crc16(data)
+
+
+def test_fit_crc16_accepts_memoryview() -> None:
+    data = bytearray(b"MyWhoosh2Garmin")
+    assert fit_crc16(memoryview(data)) == fit_crc16(bytes(data))
+
+
+def test_calculate_avg() -> None:
+    assert calculate_avg([150, 250, 200]) == 200
+    assert calculate_avg([]) == 0
@@ -0,0 +1,106 @@
+"""Tests of the indexed FIT reader, the verification and the repair of truncated files."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pytest
+
+from mywhoosh.fit_protocol import (
+    FIT_FIELD_RECORD_POWER,
+    FIT_FIELD_SUMMARY_START_TIME,
+    FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME,
+    FIT_MESG_LAP,
+    FIT_MESG_RECORD,
+    FIT_MESG_SESSION,
+)
+from mywhoosh.fit_reader import FitReader, checked_fit_data, repair_fit_data, verify_fit_data, verify_fit_file
+from tests.fit_data import RIDE_POWERS, RIDE_START
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+
+def test_reader_decodes_only_the_requested_messages(ride: bytes) -> None:
+    with FitReader(ride) as reader:
+        laps = list(reader.messages(FIT_MESG_LAP))
+        (session,) = reader.messages(FIT_MESG_SESSION)
+        powers = [record.fields[FIT_FIELD_RECORD_POWER] for record in reader.messages(FIT_MESG_RECORD)]
+    assert [lap.fields[FIT_FIELD_SUMMARY_START_TIME] for lap in laps] == [RIDE_START, RIDE_START + 60]
+    assert session.fields[FIT_FIELD_SUMMARY_TOTAL_TIMER_TIME] == 120 * 1000
+    assert powers == list(RIDE_POWERS) * 60
+
+
+def test_reader_maps_files(ride: bytes, tmp_path: Path) -> None:
+    fit_file = tmp_path / "MyNewActivity-3.8.5.fit"
+    fit_file.write_bytes(ride)
+    with FitReader(fit_file) as reader, FitReader(ride) as in_memory:
+        assert len(reader) == len(in_memory)
+        assert reader.name == fit_file.name
+
+
+def test_reader_rejects_truncated_data_unless_partial(ride: bytes) -> None:
+    with pytest.raises(ValueError, match="Unexpected end of FIT data"):
+        FitReader(ride[:-100])
+    with FitReader(ride[:-100], partial=True) as reader:
+        assert reader.truncated
+        assert list(reader.messages(FIT_MESG_SESSION)) == []
+
+
+def test_verify_accepts_intact_data(ride: bytes) -> None:
+    assert verify_fit_data(ride) == []
+
+
+@pytest.mark.parametrize(
+    ("damage", "problem"),
+    [
+        (lambda _: b"", "empty"),
+        (lambda data: data[:-100], "truncated"),
+        (lambda data: data[:-3] + bytes([data[-3] ^ 0xFF]) + data[-2:], "file CRC mismatch"),
+        (lambda data: data[:12] + bytes([data[12] ^ 0xFF]) + data[13:], "header CRC mismatch"),
+        (lambda _: b"not a FIT file at all", "no FIT header"),
+    ],
+)
+def test_verify_reports_damaged_data(ride: bytes, damage: Callable[[bytes], bytes], problem: str) -> None:
+    problems = verify_fit_data(damage(ride))
+    assert any(problem in found for found in problems)
+
+
+def test_repair_closes_a_killed_recording(make_ride: Callable[..., bytes]) -> None:
+    # a recording that was killed has no session and its last message is cut off
+    killed = make_ride(session=False)[:-5]
+    assert verify_fit_data(killed)
+    repaired = repair_fit_data(killed)
+    assert verify_fit_data(repaired) == []
+    with FitReader(repaired) as reader:
+        records = list(reader.messages(FIT_MESG_RECORD))
+        (session,) = reader.messages(FIT_MESG_SESSION)
+    assert len(records) == 120
+    assert session.fields[FIT_FIELD_SUMMARY_START_TIME] == RIDE_START
+
+
+def test_repair_keeps_an_existing_session(ride: bytes) -> None:
+    # only the file CRC is missing
+    repaired = repair_fit_data(ride[:-2])
+    assert verify_fit_data(repaired) == []
+    assert repaired[14:] == ride[14:]
+
+
+def test_repair_rejects_data_without_fit_header() -> None:
+    with pytest.raises(ValueError, match="not a valid FIT file"):
+        repair_fit_data(b"not a FIT file at all")
+
+
+def test_checked_fit_data(ride: bytes, tmp_path: Path) -> None:
+    intact = tmp_path / "intact.fit"
+    intact.write_bytes(ride)
+    damaged = tmp_path / "damaged.fit"
+    damaged.write_bytes(ride[:-100])
+    assert verify_fit_file(intact) == []
+    assert checked_fit_data(intact) is None
+    with pytest.raises(ValueError, match="Use --repair"):
+        checked_fit_data(damaged)
+    repaired = checked_fit_data(damaged, repair=True)
+    assert repaired is not None
+    assert verify_fit_data(repaired) == []
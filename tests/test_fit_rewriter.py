@@ -0,0 +1,175 @@
+"""Tests of the FIT rewriter and its transform profiles."""
+
+from __future__ import annotations
+
+import itertools
+import json
+from io import BytesIO
+from typing import TYPE_CHECKING
+
+import pytest
+
+from mywhoosh.fit_profile import DEFAULT_TRANSFORM_PROFILE, FitTransformProfile, load_transform_profile
+from mywhoosh.fit_protocol import (
+    FIT_FIELD_FILE_ID_MANUFACTURER,
+    FIT_FIELD_FILE_ID_PRODUCT,
+    FIT_FIELD_RECORD_POWER,
+    FIT_FIELD_RECORD_TEMPERATURE,
+    FIT_FIELD_SUMMARY_TOTAL_DISTANCE,
+    FIT_FIELD_TIMESTAMP,
+    FIT_MESG_FILE_ID,
+    FIT_MESG_LAP,
+    FIT_MESG_RECORD,
+    FIT_MESG_SESSION,
+    FIT_SUMMARY_FIELDS,
+    GARMIN_MANUFACTURER_ID,
+    GARMIN_PRODUCT_ID,
+    SMART_RECORDING_MAX_INTERVAL,
+)
+from mywhoosh.fit_reader import FitReader, verify_fit_data
+from mywhoosh.fit_rewriter import cleanup_fit_bytes, cleanup_fit_stream, stream_cleanup_fit_file
+from tests.fit_data import RIDE_CADENCE, RIDE_HEART_RATE, RIDE_POWERS, RIDE_SPEED
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+
+def summary(data: bytes, global_id: int, statistic: str) -> list[int | bytes | None]:
+    """Return a statistic of every lap or session message in FIT data."""
+    number = FIT_SUMMARY_FIELDS[global_id][statistic][0]
+    with FitReader(data) as reader:
+        return [message.fields.get(number) for message in reader.messages(global_id)]
+
+
+def record_timestamps(data: bytes) -> list[int]:
+    """Return the timestamps of the record messages in FIT data."""
+    with FitReader(data) as reader:
+        timestamps = [record.fields[FIT_FIELD_TIMESTAMP] for record in reader.messages(FIT_MESG_RECORD)]
+    return [timestamp for timestamp in timestamps if isinstance(timestamp, int)]
+
+
+def test_cleanup_fills_in_the_averages(ride: bytes) -> None:
+    cleaned = cleanup_fit_bytes(ride)
+    assert cleaned is not None
+    assert verify_fit_data(cleaned) == []
+    assert summary(cleaned, FIT_MESG_SESSION, "avg_power") == [sum(RIDE_POWERS) // len(RIDE_POWERS)]
+    assert summary(cleaned, FIT_MESG_SESSION, "max_power") == [max(RIDE_POWERS)]
+    assert summary(cleaned, FIT_MESG_SESSION, "avg_heart_rate") == [RIDE_HEART_RATE]
+    assert summary(cleaned, FIT_MESG_SESSION, "avg_cadence") == [RIDE_CADENCE]
+    assert summary(cleaned, FIT_MESG_SESSION, "avg_speed") == [RIDE_SPEED]
+    assert summary(cleaned, FIT_MESG_LAP, "avg_power") == [sum(RIDE_POWERS) // len(RIDE_POWERS)] * 2
+
+
+def test_cleanup_removes_the_temperature_and_sets_the_device(ride: bytes) -> None:
+    cleaned = cleanup_fit_bytes(ride)
+    assert cleaned is not None
+    with FitReader(cleaned) as reader:
+        records = list(reader.messages(FIT_MESG_RECORD))
+        (file_id,) = reader.messages(FIT_MESG_FILE_ID)
+    assert len(records) == 120
+    assert all(FIT_FIELD_RECORD_TEMPERATURE not in record.fields for record in records)
+    assert all(record.fields[FIT_FIELD_RECORD_POWER] in RIDE_POWERS for record in records)
+    assert file_id.fields[FIT_FIELD_FILE_ID_MANUFACTURER] == GARMIN_MANUFACTURER_ID
+    assert file_id.fields[FIT_FIELD_FILE_ID_PRODUCT] == GARMIN_PRODUCT_ID
+
+
+def test_cleanup_of_bytes_streams_and_files_is_identical(ride: bytes, tmp_path: Path) -> None:
+    cleaned = cleanup_fit_bytes(ride)
+    from_memoryview = cleanup_fit_bytes(memoryview(ride))
+    from_stream = BytesIO()
+    cleanup_fit_stream(BytesIO(ride), from_stream)
+    source = tmp_path / "MyNewActivity-3.8.5.fit"
+    source.write_bytes(ride)
+    stream_cleanup_fit_file(source, tmp_path / "cleaned.fit")
+    assert from_memoryview == cleaned
+    assert from_stream.getvalue() == cleaned
+    assert (tmp_path / "cleaned.fit").read_bytes() == cleaned
+
+
+def test_cleanup_rejects_truncated_data(ride: bytes) -> None:
+    with pytest.raises(ValueError, match="Unexpected end of FIT data"):
+        cleanup_fit_bytes(ride[: len(ride) // 2])
+
+
+def test_cleanup_writes_to_an_output_stream(ride: bytes) -> None:
+    output = BytesIO()
+    assert cleanup_fit_bytes(ride, output) is None
+    assert output.getvalue() == cleanup_fit_bytes(ride)
+
+
+def test_downsampling_keeps_one_record_per_interval(make_ride: Callable[..., bytes]) -> None:
+    ride = make_ride(seconds=600, lap_length=300)
+    cleaned = cleanup_fit_bytes(ride, profile=DEFAULT_TRANSFORM_PROFILE.downsampled(5))
+    assert cleaned is not None
+    assert verify_fit_data(cleaned) == []
+    timestamps = record_timestamps(cleaned)
+    with FitReader(cleaned) as reader:
+        (session,) = reader.messages(FIT_MESG_SESSION)
+    # plus the last record before each of the two laps
+    assert len(timestamps) <= 600 // 5 + 2
+    assert all(0 < later - earlier <= 5 for earlier, later in itertools.pairwise(timestamps))
+    # summaries are still computed from every record
+    assert summary(cleaned, FIT_MESG_SESSION, "avg_power") == [sum(RIDE_POWERS) // len(RIDE_POWERS)]
+    assert session.fields[FIT_FIELD_SUMMARY_TOTAL_DISTANCE] == 600 * RIDE_SPEED // 10
+
+
+def test_smart_recording_drops_records_of_a_steady_ride(make_ride: Callable[..., bytes]) -> None:
+    ride = make_ride(seconds=600, lap_length=300, powers=(200, 205))
+    cleaned = cleanup_fit_bytes(ride, profile=DEFAULT_TRANSFORM_PROFILE.downsampled("smart"))
+    assert cleaned is not None
+    timestamps = record_timestamps(cleaned)
+    # the power stays within the threshold, so only one record every few seconds remains
+    assert len(timestamps) <= 600 // SMART_RECORDING_MAX_INTERVAL + 2
+    assert all(later - earlier <= SMART_RECORDING_MAX_INTERVAL for earlier, later in itertools.pairwise(timestamps))
+    assert len(cleaned) < len(cleanup_fit_bytes(ride) or b"")
+
+
+@pytest.mark.parametrize("downsample", ["0", "11", "fast"])
+def test_invalid_downsampling_is_rejected(downsample: str) -> None:
+    with pytest.raises(ValueError, match="Invalid downsampling"):
+        DEFAULT_TRANSFORM_PROFILE.downsampled(downsample)
+
+
+def test_transform_profile_drops_messages_and_fields(ride: bytes, tmp_path: Path) -> None:
+    profile_file = tmp_path / "profile.json"
+    profile_file.write_text(json.dumps({"drop_messages": ["lap"], "drop_fields": {"record": ["power"]}}))
+    profile = load_transform_profile(profile_file)
+    cleaned = cleanup_fit_bytes(ride, profile=profile)
+    assert cleaned is not None
+    assert verify_fit_data(cleaned) == []
+    with FitReader(cleaned) as reader:
+        assert list(reader.messages(FIT_MESG_LAP)) == []
+        assert all(FIT_FIELD_RECORD_POWER not in record.fields for record in reader.messages(FIT_MESG_RECORD))
+        # the temperature is kept, as the profile replaces the default drop_fields
+        assert all(FIT_FIELD_RECORD_TEMPERATURE in record.fields for record in reader.messages(FIT_MESG_RECORD))
+
+
+def test_transform_profile_drops_summary_fields(ride: bytes, tmp_path: Path) -> None:
+    profile_file = tmp_path / "profile.json"
+    # summary fields have no names in profiles, only numbers
+    avg_power = FIT_SUMMARY_FIELDS[FIT_MESG_SESSION]["avg_power"][0]
+    max_power = FIT_SUMMARY_FIELDS[FIT_MESG_LAP]["max_power"][0]
+    profile_file.write_text(json.dumps({"drop_fields": {"session": [avg_power], "lap": [max_power]}}))
+    # the summaries of a file cleaned up before already hold the dropped fields
+    cleaned = cleanup_fit_bytes(cleanup_fit_bytes(ride) or b"", profile=load_transform_profile(profile_file))
+    assert cleaned is not None
+    assert verify_fit_data(cleaned) == []
+    assert summary(cleaned, FIT_MESG_SESSION, "avg_power") == [None]
+    assert summary(cleaned, FIT_MESG_SESSION, "max_power") == [max(RIDE_POWERS)]
+    assert summary(cleaned, FIT_MESG_LAP, "max_power") == [None, None]
+
+
+def test_transform_profile_rejects_unknown_names(tmp_path: Path) -> None:
+    profile_file = tmp_path / "profile.json"
+    profile_file.write_text(json.dumps({"drop_messages": ["no_such_message"]}))
+    with pytest.raises(ValueError, match="no_such_message"):
+        load_transform_profile(profile_file)
+
+
+def test_profile_without_changes_copies_the_messages(ride: bytes) -> None:
+    profile = FitTransformProfile(drop_fields={}, set_fields={}, fill_summaries=False)
+    cleaned = cleanup_fit_bytes(ride, profile=profile)
+    assert cleaned is not None
+    # only the header may differ
+    assert cleaned[14:-2] == ride[14:-2]
@@ -0,0 +1,62 @@
+"""Tests of the shared Garmin Connect session."""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import pytest
+import requests
+
+from mywhoosh import garmin
+from mywhoosh.garmin import UPLOAD_POOL_SIZE, GarminAccount, GarminSession
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+class FreshToken:
+    """Stands in for an OAuth2 token that expires in an hour."""
+
+    expires_at = time.time() + 3600
+
+
+@pytest.fixture
+def session(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> GarminSession:
+    """Return the session of an account whose authentication always succeeds."""
+    monkeypatch.setattr(garmin, "authenticate_to_garmin", lambda *_: None)
+    session = GarminSession({}, account=GarminAccount("alice", "alice@example.com", tmp_path / ".garth-alice"))
+    session.client.oauth2_token = FreshToken()  # type: ignore[assignment]
+    return session
+
+
+def test_connect_keeps_the_retries_of_garth(session: GarminSession) -> None:
+    session.connect()
+    session.connect()
+    session.close()
+    adapter = session.client.sess.get_adapter("https://connect.garmin.com")
+    assert adapter.max_retries.total == session.client.retries  # type: ignore[attr-defined]
+    assert adapter._pool_maxsize == UPLOAD_POOL_SIZE  # type: ignore[attr-defined]  # noqa: SLF001
+    # the response hook is registered once, however often the session connects
+    assert session.client.sess.hooks["response"].count(session._count_response) == 1  # noqa: SLF001
+
+
+def test_token_refresh_survives_connection_errors(session: GarminSession, monkeypatch: pytest.MonkeyPatch) -> None:
+    attempts = []
+
+    def refresh() -> None:
+        attempts.append(time.monotonic())
+        if len(attempts) == 3:
+            session._stop.set()  # noqa: SLF001
+        msg = "connection reset"
+        raise requests.ConnectionError(msg)
+
+    monkeypatch.setattr(session, "seconds_until_refresh", lambda: 0.0)
+    monkeypatch.setattr(session, "refresh_if_needed", refresh)
+    session.refresh_margin = 0
+    refresher = threading.Thread(target=session._refresh_loop)  # noqa: SLF001
+    refresher.start()
+    refresher.join(timeout=10)
+    assert not refresher.is_alive()
+    assert len(attempts) == 3
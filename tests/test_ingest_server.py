@@ -0,0 +1,81 @@
+"""Tests of the HTTP ingest service."""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from typing import TYPE_CHECKING
+
+import pytest
+
+from mywhoosh.fit_rewriter import cleanup_fit_bytes
+from mywhoosh.ingest_server import IngestService, ingest_handler
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+
+class BrokenOutbox:
+    """Stands in for an UploadOutbox whose database cannot be written."""
+
+    def enqueue(self, output_path: Path) -> None:
+        """Fail like a locked database."""
+        msg = f"database is locked, cannot queue {output_path.name}"
+        raise sqlite3.OperationalError(msg)
+
+
+@pytest.fixture
+def service(tmp_path: Path) -> Iterator[IngestService]:
+    """Return a service with one worker that stores jobs in ``tmp_path``."""
+    service = IngestService(tmp_path, max_workers=1)
+    yield service
+    service.close()
+
+
+@pytest.fixture
+def server(service: IngestService) -> Iterator[HTTPConnection]:
+    """Serve ``service`` on a free local port and return a connection to it."""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ingest_handler(service))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    connection = HTTPConnection("127.0.0.1", httpd.server_address[1], timeout=30)
+    yield connection
+    connection.close()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(connection: HTTPConnection, content_length: str | None, body: bytes = b"") -> int:
+    """Post a body to ``/fit`` with the given Content-Length header and return the status."""
+    connection.putrequest("POST", "/fit")
+    if content_length is not None:
+        connection.putheader("Content-Length", content_length)
+    connection.endheaders(body)
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def test_server_cleans_up_posted_files(server: HTTPConnection, ride: bytes) -> None:
+    server.request("POST", "/fit?name=ride.fit", body=ride)
+    response = server.getresponse()
+    assert response.status == 200
+    assert response.read() == cleanup_fit_bytes(ride)
+
+
+@pytest.mark.parametrize(("content_length", "status"), [(None, 411), ("many", 400), ("-1", 400), ("", 400)])
+def test_server_rejects_invalid_content_length(server: HTTPConnection, content_length: str | None, status: int) -> None:
+    assert post(server, content_length) == status
+
+
+def test_job_fails_when_its_upload_cannot_be_queued(service: IngestService, ride: bytes) -> None:
+    service.outboxes = {"": BrokenOutbox()}  # type: ignore[dict-item]
+    job = service.enqueue(ride, "ride.fit")
+    service.close()
+    status = service.job_status(job.id)
+    assert status is not None
+    assert status["status"] == "failed"
+    assert "database is locked" in status["error"]
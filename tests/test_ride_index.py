@@ -0,0 +1,60 @@
+"""Tests of the ride summary index of the backup directory."""
+
+from __future__ import annotations
+
+import os
+from contextlib import closing
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from mywhoosh.fit_rewriter import cleanup_fit_bytes
+from mywhoosh.ride_index import RideIndex
+from tests.fit_data import RIDE_POWERS
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+
+def backup(backup_dir: Path, name: str, ride: bytes) -> Path:
+    """Write a cleaned-up ride to the backup directory."""
+    backup_dir.mkdir(exist_ok=True)
+    path = backup_dir / name
+    path.write_bytes(cleanup_fit_bytes(ride) or b"")
+    return path
+
+
+def test_update_reads_only_new_and_changed_files(ride: bytes, tmp_path: Path) -> None:
+    first = backup(tmp_path / "backup", "first.fit", ride)
+    with closing(RideIndex(tmp_path / "index.db")) as rides:
+        assert rides.update(tmp_path / "backup") == (1, 0)
+        second = backup(tmp_path / "backup", "second.fit", ride)
+        assert rides.update(tmp_path / "backup") == (1, 0)
+        first.unlink()
+        assert rides.update(tmp_path / "backup") == (0, 1)
+        assert [summary.path for summary in rides.query()] == [str(second.resolve())]
+
+
+def test_refresh_skips_indexed_files(make_ride: Callable[..., bytes], tmp_path: Path) -> None:
+    first = backup(tmp_path, "first.fit", make_ride())
+    with closing(RideIndex(tmp_path / "index.db")) as rides:
+        assert rides.refresh([first]) == 1
+        second = backup(tmp_path, "second.fit", make_ride())
+        assert rides.refresh([first, second]) == 1
+        # a file rewritten in place is read again
+        backup(tmp_path, "first.fit", make_ride(powers=(300,)))
+        stat = first.stat()
+        os.utime(first, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert rides.refresh([first, second]) == 1
+        powers = {Path(summary.path).name: summary.avg_power for summary in rides.query()}
+        assert powers == {"first.fit": 300, "second.fit": sum(RIDE_POWERS) // len(RIDE_POWERS)}
+
+
+def test_query_is_scoped_to_the_backup_directory(ride: bytes, tmp_path: Path) -> None:
+    old = backup(tmp_path / "old", "ride.fit", ride)
+    new = backup(tmp_path / "new", "ride.fit", ride)
+    with closing(RideIndex(tmp_path / "index.db")) as rides:
+        rides.update(tmp_path / "old")
+        rides.update(tmp_path / "new")
+        assert [summary.path for summary in rides.query(tmp_path / "new")] == [str(new.resolve())]
+        assert [summary.path for summary in rides.query(tmp_path / "old")] == [str(old.resolve())]
+        assert len(rides.query()) == 2
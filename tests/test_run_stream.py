@@ -0,0 +1,63 @@
+"""Tests of the single-file mode of the command line."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pytest
+
+import myWhoosh2Garmin as mw2g  # noqa: N813
+from mywhoosh.fit_profile import DEFAULT_TRANSFORM_PROFILE
+from mywhoosh.fit_reader import verify_fit_file
+from mywhoosh.fit_rewriter import cleanup_fit_bytes
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def stream_args(source: Path, target: Path, **args: object) -> dict:
+    """Return the command line arguments of ``myWhoosh2Garmin.py <source> <target>``."""
+    return {
+        "source": str(source),
+        "target": str(target),
+        "repair": False,
+        "transform_profile": None,
+        "downsample": None,
+        **args,
+    }
+
+
+def test_stream_mode_writes_the_cleaned_up_file(ride: bytes, tmp_path: Path) -> None:
+    source = tmp_path / "ride.fit"
+    source.write_bytes(ride)
+    mw2g.run_stream(stream_args(source, tmp_path / "cleaned.fit"))
+    assert (tmp_path / "cleaned.fit").read_bytes() == cleanup_fit_bytes(ride)
+
+
+def test_stream_mode_downsamples(ride: bytes, tmp_path: Path) -> None:
+    source = tmp_path / "ride.fit"
+    source.write_bytes(ride)
+    mw2g.run_stream(stream_args(source, tmp_path / "cleaned.fit", downsample="5"))
+    expected = cleanup_fit_bytes(ride, profile=DEFAULT_TRANSFORM_PROFILE.downsampled(5))
+    assert (tmp_path / "cleaned.fit").read_bytes() == expected
+
+
+@pytest.mark.parametrize("content", [None, b"", b"not a FIT file at all"])
+def test_stream_mode_exits_on_unreadable_input(content: bytes | None, tmp_path: Path) -> None:
+    source = tmp_path / "ride.fit"
+    if content is not None:
+        source.write_bytes(content)
+    with pytest.raises(SystemExit) as exit_info:
+        mw2g.run_stream(stream_args(source, tmp_path / "cleaned.fit"))
+    assert exit_info.value.code == 1
+
+
+def test_stream_mode_repairs_damaged_input_only_when_asked(ride: bytes, tmp_path: Path) -> None:
+    source = tmp_path / "ride.fit"
+    source.write_bytes(ride[:-100])
+    with pytest.raises(SystemExit) as exit_info:
+        mw2g.run_stream(stream_args(source, tmp_path / "cleaned.fit"))
+    assert exit_info.value.code == 1
+    assert not (tmp_path / "cleaned.fit").exists()
+    mw2g.run_stream(stream_args(source, tmp_path / "cleaned.fit", repair=True))
+    assert verify_fit_file(tmp_path / "cleaned.fit") == []
@@ -0,0 +1,162 @@
+"""Tests of the classification of upload outcomes and the retries of the upload outbox."""
+
+from __future__ import annotations
+
+import sqlite3
+from contextlib import closing
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, BinaryIO
+
+import pytest
+import requests
+from garth.exc import GarthHTTPError
+
+from mywhoosh import upload_outbox
+from mywhoosh.garmin import UPLOAD_BACKOFF_MAX, UPLOAD_MAX_ATTEMPTS, upload_backoff, upload_with_outcome
+from mywhoosh.upload_outbox import FitFileLedger, UploadOutbox
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def http_error(status: int, headers: dict[str, str] | None = None) -> GarthHTTPError:
+    """Return the error garth raises for a response with the given status."""
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return GarthHTTPError(msg="Upload failed", error=requests.HTTPError(response=response))
+
+
+class FakeSession:
+    """Stands in for a GarminSession, failing with the given errors before it succeeds."""
+
+    account = None
+
+    def __init__(self, *errors: Exception) -> None:
+        """Fail the first uploads with ``errors``, in order."""
+        self.errors = list(errors)
+        self.uploads: list[str] = []
+
+    def upload(self, fp: BinaryIO) -> dict[str, Any]:
+        """Record the upload and raise the next error, if any."""
+        self.uploads.append(getattr(fp, "name", ""))
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"detailedImportResult": {}}
+
+
+@pytest.mark.parametrize(
+    ("error", "outcome"),
+    [
+        (None, ("uploaded", 0.0)),
+        (http_error(409), ("duplicate", 0.0)),
+        (http_error(429, {"Retry-After": "7"}), ("retry", 7.0)),
+        (http_error(503), ("retry", 0.0)),
+        (http_error(400), ("failed", 0.0)),
+        (requests.ConnectionError("connection reset"), ("retry", 0.0)),
+    ],
+)
+def test_upload_outcomes(ride: bytes, error: Exception | None, outcome: tuple[str, float]) -> None:
+    session = FakeSession(*([error] if error else []))
+    status, _, delay = upload_with_outcome(session, BytesIO(ride))  # type: ignore[arg-type]
+    assert (status, delay) == outcome
+
+
+def test_damaged_files_are_not_uploaded(ride: bytes) -> None:
+    session = FakeSession()
+    status, error, _ = upload_with_outcome(session, BytesIO(ride[:-100]))  # type: ignore[arg-type]
+    assert status == "failed"
+    assert "truncated" in error
+    assert session.uploads == []
+
+
+def test_upload_backoff() -> None:
+    assert [upload_backoff(attempts) for attempts in (1, 2, 3)] == [2.0, 4.0, 8.0]
+    assert upload_backoff(100) == UPLOAD_BACKOFF_MAX
+    assert upload_backoff(1, requested=30.0) == 30.0
+
+
+@pytest.fixture
+def cleaned_file(ride: bytes, tmp_path: Path) -> Path:
+    """Return a cleaned-up file recorded in the ledger of ``tmp_path``."""
+    source = tmp_path / "MyNewActivity-3.8.5.fit"
+    source.write_bytes(ride)
+    output = tmp_path / "MyNewActivity-3.8.5_2024-11-21_090000.fit"
+    output.write_bytes(ride)
+    with closing(FitFileLedger(tmp_path / "ledger.db")) as ledger:
+        ledger.record_processed(source, output)
+    return output
+
+
+def drain(outbox: UploadOutbox, *paths: Path) -> None:
+    """Queue files and wait until the outbox gave every one of them its final outcome."""
+    for path in paths:
+        outbox.enqueue(path)
+    outbox.start()
+    outbox.join()
+    outbox.close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Retry failed uploads right away."""
+    monkeypatch.setattr(upload_outbox, "upload_backoff", lambda *_: 0.0)
+
+
+def test_outbox_retries_until_the_upload_succeeds(cleaned_file: Path, tmp_path: Path) -> None:
+    session = FakeSession(http_error(503), requests.ConnectionError("connection reset"))
+    outbox = UploadOutbox(tmp_path / "ledger.db", session)  # type: ignore[arg-type]
+    drain(outbox, cleaned_file)
+    assert len(session.uploads) == 3
+    assert outbox.status(cleaned_file) is None
+    assert outbox.pending() == 0
+    with closing(FitFileLedger(tmp_path / "ledger.db")) as ledger:
+        assert ledger.is_uploaded(cleaned_file)
+
+
+def test_outbox_gives_up_after_the_last_attempt(cleaned_file: Path, tmp_path: Path) -> None:
+    session = FakeSession(*[http_error(503)] * UPLOAD_MAX_ATTEMPTS)
+    outbox = UploadOutbox(tmp_path / "ledger.db", session)  # type: ignore[arg-type]
+    drain(outbox, cleaned_file)
+    assert len(session.uploads) == UPLOAD_MAX_ATTEMPTS
+    assert outbox.status(cleaned_file) == "failed"
+    with closing(FitFileLedger(tmp_path / "ledger.db")) as ledger:
+        assert not ledger.is_uploaded(cleaned_file)
+
+
+def test_outbox_does_not_retry_rejected_files(cleaned_file: Path, tmp_path: Path) -> None:
+    session = FakeSession(http_error(400))
+    outbox = UploadOutbox(tmp_path / "ledger.db", session)  # type: ignore[arg-type]
+    drain(outbox, cleaned_file)
+    assert len(session.uploads) == 1
+    assert outbox.status(cleaned_file) == "failed"
+    # a failed file can be queued again
+    drain(outbox, cleaned_file)
+    assert outbox.status(cleaned_file) is None
+
+
+def test_outbox_retries_unexpected_errors(cleaned_file: Path, tmp_path: Path) -> None:
+    session = FakeSession(RuntimeError("unexpected"))
+    outbox = UploadOutbox(tmp_path / "ledger.db", session)  # type: ignore[arg-type]
+    drain(outbox, cleaned_file)
+    assert len(session.uploads) == 2
+    assert outbox.status(cleaned_file) is None
+
+
+def test_outbox_treats_duplicates_as_uploaded(cleaned_file: Path, tmp_path: Path) -> None:
+    outbox = UploadOutbox(tmp_path / "ledger.db", FakeSession(http_error(409)))  # type: ignore[arg-type]
+    drain(outbox, cleaned_file)
+    with closing(FitFileLedger(tmp_path / "ledger.db")) as ledger:
+        assert ledger.is_uploaded(cleaned_file)
+
+
+def test_outbox_resumes_uploads_interrupted_by_a_crash(cleaned_file: Path, tmp_path: Path) -> None:
+    outbox = UploadOutbox(tmp_path / "ledger.db", FakeSession())  # type: ignore[arg-type]
+    outbox.enqueue(cleaned_file)
+    with closing(sqlite3.connect(tmp_path / "ledger.db")) as conn, conn:
+        conn.execute("UPDATE upload_outbox SET status = 'uploading'")
+    session = FakeSession()
+    resumed = UploadOutbox(tmp_path / "ledger.db", session)  # type: ignore[arg-type]
+    assert resumed.status(cleaned_file) == "pending"
+    drain(resumed)
+    assert session.uploads == [str(cleaned_file)]